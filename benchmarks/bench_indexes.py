@@ -0,0 +1,122 @@
+"""
+Benchmark of the indexes added by the schema migrations in database_handler.MIGRATIONS.
+
+Builds a synthetic database (100k transactions by default), processes it and then times the hot queries of
+process_transactions and StatCalculator without and with the indexes, printing the query plan of each.
+The newest transactions are marked unprocessed again to mimic an incremental import.
+
+Usage: python benchmarks/bench_indexes.py [--rows 100000] [--repeat 500] [--db path]
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from database_handler import DatabaseHandler, MIGRATIONS
+from data_parser import DataParser
+from generate_data import generate_transactions, write_csv
+
+# Hot queries as (name, sql, function returning the parameters of the i:th execution)
+QUERIES = [
+    ("unprocessed transactions",
+     "SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC",
+     lambda sample, i: ()),
+    ("available_capital",
+     "SELECT month, capital FROM cohort_data WHERE account = ? AND capital > 0 ORDER BY month ASC",
+     lambda sample, i: (sample["accounts"][i % len(sample["accounts"])],)),
+    ("available_asset",
+     "SELECT month, amount FROM cohort_assets WHERE amount > 0 AND asset_id = ? AND account = ? ORDER BY month ASC",
+     lambda sample, i: sample["holdings"][i % len(sample["holdings"])]),
+    ("cohort cash flows",
+     "SELECT transaction_month, amount FROM cohort_cash_flows WHERE cohort_month = ? AND account = ?",
+     lambda sample, i: sample["cohorts"][i % len(sample["cohorts"])]),
+]
+
+def build_database(db_file: str, rows: int, unprocessed: int) -> None:
+    """
+    Imports and processes synthetic transactions, then marks the newest transactions as unprocessed.
+    """
+    csv_file = db_file + ".csv"
+    write_csv(csv_file, generate_transactions(rows))
+    parser = DataParser(DatabaseHandler(db_file))
+    parser.add_data(csv_file)
+    parser.process_transactions(in_memory=True)
+    os.remove(csv_file)
+    parser.db.conn.execute("UPDATE transactions SET processed = 0 WHERE rowid > (SELECT MAX(rowid) FROM transactions) - ?", (unprocessed,))
+    parser.db.commit()
+    parser.db.disconnect()
+
+def index_names() -> list:
+    """
+    Returns:
+    list: Names of the indexes created by MIGRATIONS.
+    """
+    return [match.group(1) for statements in MIGRATIONS for statement in statements
+            for match in [re.search(r"INDEX IF NOT EXISTS (\w+)", statement)] if match]
+
+def run_queries(conn, sample: dict, repeat: int) -> dict:
+    """
+    Returns:
+    dict: Query name -> (query plan, milliseconds per execution)
+    """
+    results = {}
+    for name, sql, params in QUERIES:
+        plan = "; ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params(sample, 0)))
+        start = time.perf_counter()
+        for i in range(repeat):
+            conn.execute(sql, params(sample, i)).fetchall()
+        results[name] = (plan, (time.perf_counter() - start) * 1000 / repeat)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot path indexes")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of synthetic transactions (default: 100000)")
+    parser.add_argument("--unprocessed", type=int, default=500, help="Number of newest transactions marked unprocessed (default: 500)")
+    parser.add_argument("--repeat", type=int, default=500, help="Executions per query (default: 500)")
+    parser.add_argument("--db", help="Existing benchmark database to reuse instead of building one")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.db:
+        db_file = args.db
+    else:
+        db_file = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        start = time.perf_counter()
+        build_database(db_file, args.rows, args.unprocessed)
+        print("Built database with {} transactions in {:.1f}s".format(args.rows, time.perf_counter() - start))
+
+    db = DatabaseHandler(db_file)
+    db.connect()
+    conn = db.conn
+    sample = {
+        "accounts": [row[0] for row in conn.execute("SELECT DISTINCT account FROM cohort_data")],
+        "holdings": conn.execute("SELECT DISTINCT asset_id, account FROM cohort_assets").fetchall(),
+        "cohorts": conn.execute("SELECT month, account FROM cohort_data").fetchall(),
+    }
+
+    for name in index_names():
+        conn.execute("DROP INDEX IF EXISTS {}".format(name))
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    before = run_queries(conn, sample, args.repeat)
+
+    db.migrate()
+    conn.commit()
+    after = run_queries(conn, sample, args.repeat)
+    db.disconnect()
+
+    for name, _, _ in QUERIES:
+        (plan_before, ms_before), (plan_after, ms_after) = before[name], after[name]
+        print()
+        print(name)
+        print("  without indexes: {:9.3f} ms  {}".format(ms_before, plan_before))
+        print("  with indexes:    {:9.3f} ms  {}".format(ms_after, plan_after))
+        print("  speedup:         {:9.1f}x".format(ms_before / ms_after if ms_after > 0 else float("inf")))
+
+if __name__ == "__main__":
+    main()
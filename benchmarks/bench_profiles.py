@@ -0,0 +1,109 @@
+"""
+Benchmark of the connection profiles in database_handler.CONNECTION_PROFILES.
+
+Builds a synthetic database (20k transactions by default) and times a full replay, resetting and processing all transactions
+again, once per configuration: the safe profile committing as the code does, the safe profile inside DatabaseHandler.bulk()
+and the bulk profile inside bulk(). Each configuration starts from a copy of the same database file.
+The replay commits only a few times, so it also times metadata writes, which commit once per call outside of bulk().
+
+Usage: python benchmarks/bench_profiles.py [--rows 20000] [--engine sql] [--repeat 3] [--writes 500]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from generate_data import generate_transactions, write_csv
+
+# Configurations as (name, connection profile, replay inside bulk())
+CONFIGURATIONS = [
+    ("safe", "safe", False),
+    ("safe + bulk()", "safe", True),
+    ("bulk + bulk()", "bulk", True),
+]
+
+def build_database(db_file: str, rows: int) -> None:
+    """
+    Imports synthetic transactions without processing them.
+    """
+    csv_file = db_file + ".csv"
+    write_csv(csv_file, generate_transactions(rows))
+    DataParser(DatabaseHandler(db_file)).add_data(csv_file)
+    os.remove(csv_file)
+
+def replay(db_file: str, profile: str, use_bulk: bool, in_memory: bool) -> float:
+    """
+    Returns:
+    float: Seconds to reset and process all transactions.
+    """
+    db = DatabaseHandler(db_file, profile=profile)
+    parser = DataParser(db)
+    start = time.perf_counter()
+    with db.bulk() if use_bulk else nullcontext():
+        parser.reset_processed_transactions()
+        parser.process_transactions(in_memory=in_memory)
+    elapsed = time.perf_counter() - start
+    db.disconnect()
+    return elapsed
+
+def metadata_writes(db_file: str, profile: str, use_bulk: bool, writes: int) -> float:
+    """
+    Returns:
+    float: Milliseconds per set_metadata call.
+    """
+    db = DatabaseHandler(db_file, profile=profile)
+    db.connect()
+    start = time.perf_counter()
+    with db.bulk() if use_bulk else nullcontext():
+        for i in range(writes):
+            db.set_metadata("benchmark_{}".format(i % 10), str(i))
+    elapsed = time.perf_counter() - start
+    db.disconnect()
+    return elapsed * 1000 / writes
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite connection profiles on a full replay")
+    parser.add_argument("--rows", type=int, default=20000, help="Number of synthetic transactions (default: 20000)")
+    parser.add_argument("--engine", choices=["memory", "sql"], default="sql", help="Transaction processing engine (default: sql)")
+    parser.add_argument("--repeat", type=int, default=3, help="Replays per configuration, the fastest is reported (default: 3)")
+    parser.add_argument("--writes", type=int, default=500, help="Metadata writes per configuration (default: 500)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "source.db")
+    start = time.perf_counter()
+    build_database(source, args.rows)
+    print("Built database with {} transactions in {:.1f}s".format(args.rows, time.perf_counter() - start))
+
+    results = {}
+    for name, profile, use_bulk in CONFIGURATIONS:
+        times = []
+        for i in range(args.repeat):
+            db_file = os.path.join(directory, "replay.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_file + suffix):
+                    os.remove(db_file + suffix)
+            shutil.copyfile(source, db_file)
+            times.append(replay(db_file, profile, use_bulk, args.engine == "memory"))
+        results[name] = (min(times), metadata_writes(db_file, profile, use_bulk, args.writes))
+    shutil.rmtree(directory)
+
+    replay_baseline, write_baseline = results[CONFIGURATIONS[0][0]]
+    print()
+    print("{:15s} {:>18s} {:>22s}".format("", "full replay", "metadata write"))
+    for name, _, _ in CONFIGURATIONS:
+        replay_seconds, write_ms = results[name]
+        print("{:15s} {:8.3f} s  {:5.2f}x {:10.4f} ms  {:6.1f}x".format(
+            name, replay_seconds, replay_baseline / replay_seconds, write_ms, write_baseline / write_ms))
+
+if __name__ == "__main__":
+    main()
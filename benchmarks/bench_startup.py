@@ -0,0 +1,159 @@
+"""
+Benchmark of the CLI startup time.
+
+Builds a small synthetic database, then runs each CLI command in a new interpreter with python -X importtime and reports
+the wall time of the command, the total import time and the modules with the largest cumulative import time.
+The report can be written as JSON to track it over time. --compare checks the results against an earlier report,
+by default the baseline checked in as benchmarks/results/startup.json, and exits with status 1 if a command got slower
+than --max-ratio times the baseline, loads more modules with the same Python version, or started loading numpy or requests.
+Bytecode caching affects the numbers, compare runs made with the same PYTHONDONTWRITEBYTECODE setting.
+
+Usage: python benchmarks/bench_startup.py [--repeat 5] [--top 5] [--json startup.json] [--compare [baseline.json]] [--max-ratio 1.5]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "startup.json")
+sys.path.insert(0, ROOT)
+
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from generate_data import generate_transactions, write_csv
+
+# CLI commands to time, the stats are calculated while building the database and prices are never fetched,
+# so the commands only read from the database
+COMMANDS = [
+    ["status"],
+    ["settings", "account-nickname", "--list"],
+    ["accounts", "--update-prices", "never", "--account", "all"],
+    ["stats", "--update-prices", "never", "--account", "all"],
+]
+
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Returns:
+    list: (module, self microseconds, cumulative microseconds, nesting level) for each line of -X importtime output.
+    """
+    return [(match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2)
+            for match in map(IMPORTTIME.match, stderr.splitlines()) if match]
+
+def build_database(db_file: str, rows: int) -> None:
+    """
+    Imports and processes synthetic transactions and calculates the stats.
+    """
+    from calculate_stats import StatCalculator
+    csv_file = db_file + ".csv"
+    write_csv(csv_file, generate_transactions(rows))
+    parser = DataParser(DatabaseHandler(db_file))
+    parser.add_data(csv_file)
+    parser.process_transactions(in_memory=True)
+    os.remove(csv_file)
+    # Stats are not calculated for future months, the synthetic transactions can extend past today
+    parser.db.conn.execute("DELETE FROM transactions WHERE date >= date('now', 'start of month')")
+    parser.reset_processed_transactions()
+    parser.process_transactions(in_memory=True)
+    StatCalculator(parser.db).calculate_stats()
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    parser.db.set_metadata("last_stats_calculation", now)
+    parser.db.set_metadata("last_processed", now)
+    parser.db.disconnect()
+
+def run_command(db_file: str, command: list) -> tuple:
+    """
+    Returns:
+    tuple: Wall time in seconds and the parsed -X importtime output.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, "cli.py"), "--database", db_file] + command,
+                            capture_output=True, text=True, cwd=ROOT)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError("{} failed: {}".format(" ".join(command), result.stderr[-2000:]))
+    return elapsed, parse_importtime(result.stderr)
+
+def compare(results: dict, baseline: dict, max_ratio: float) -> list:
+    """
+    Returns:
+    list: Descriptions of the regressions of results against the baseline report.
+    """
+    same_python = baseline["python"].split(".")[:2] == sys.version.split()[0].split(".")[:2]
+    regressions = []
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for key in ("wall_ms", "import_ms"):
+            if result[key] > max_ratio * old[key]:
+                regressions.append("{}: {} {:.1f} ms, baseline {:.1f} ms".format(name, key, result[key], old[key]))
+        # The standard library modules differ between Python versions
+        if same_python and result["modules"] > old["modules"]:
+            regressions.append("{}: {} modules, baseline {}".format(name, result["modules"], old["modules"]))
+        for module in ("numpy", "requests"):
+            if result[module] and not old[module]:
+                regressions.append("{}: imports {}".format(name, module))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CLI startup and import time")
+    parser.add_argument("--rows", type=int, default=2000, help="Number of synthetic transactions (default: 2000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the fastest is reported (default: 5)")
+    parser.add_argument("--top", type=int, default=5, help="Number of top-level imports to list (default: 5)")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs="?", const=BASELINE, help="JSON report to check the results against (default: the checked in baseline)")
+    parser.add_argument("--max-ratio", type=float, default=1.5, help="Allowed slowdown against the compared report (default: 1.5)")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    db_file = os.path.join(tempfile.mkdtemp(), "startup.db")
+    build_database(db_file, args.rows)
+
+    results = {}
+    for command in COMMANDS:
+        name = " ".join(command[:2] if command[0] == "settings" else command[:1])
+        runs = [run_command(db_file, command) for _ in range(args.repeat)]
+        elapsed, imports = min(runs, key=lambda run: run[0])
+        top_level = sorted((imp for imp in imports if imp[3] == 0), key=lambda imp: -imp[2])
+        results[name] = {
+            "wall_ms": round(elapsed * 1000, 1),
+            "import_ms": round(sum(imp[1] for imp in imports) / 1000, 1),
+            "modules": len(imports),
+            "top_imports": {module: round(cumulative / 1000, 1) for module, _, cumulative, _ in top_level[:args.top]},
+            "numpy": any(imp[0] == "numpy" for imp in imports),
+            "requests": any(imp[0] == "requests" for imp in imports),
+        }
+
+    for name, result in results.items():
+        print()
+        print("{}: {:.1f} ms wall, {:.1f} ms importing {} modules (numpy: {}, requests: {})".format(
+            name, result["wall_ms"], result["import_ms"], result["modules"],
+            "yes" if result["numpy"] else "no", "yes" if result["requests"] else "no"))
+        for module, cumulative in result["top_imports"].items():
+            print("  {:30s} {:8.1f} ms".format(module, cumulative))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_ratio)
+        print()
+        if regressions:
+            print("Regressions compared with {}:".format(args.compare))
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions compared with {}".format(args.compare))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark suite of the import and stats pipeline at several scales.
+
+For each scale, generates a synthetic export spread over --years years ending today and times DataParser.add_data,
+DataParser.process_transactions, StatCalculator.calculate_cohort_stats and calculate_year_stats on a new database,
+then get_stats and get_accumulated on the result. The timings are written as JSON together with the git commit,
+and --compare prints them next to the results of an earlier run so regressions are visible between commits.
+
+Usage: python benchmarks/bench_suite.py [--scales 1000,10000,100000,1000000] [--json results.json] [--compare old.json]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from calculate_stats import StatCalculator
+from generate_data import generate_transactions, write_csv
+
+# Steps as (name, function running the step), run in this order on the same database
+STEPS = [
+    ("add_data", lambda run: run.parser.add_data(run.csv_file)),
+    ("process_transactions", lambda run: run.parser.process_transactions(in_memory=run.in_memory)),
+    ("calculate_cohort_stats", lambda run: run.stats.calculate_cohort_stats()),
+    ("calculate_year_stats", lambda run: run.stats.calculate_year_stats()),
+    ("get_stats", lambda run: run.stats.get_stats()),
+    ("get_accumulated", lambda run: run.stats.get_accumulated()),
+]
+# Steps that only read from the database, the fastest of --repeat runs is reported
+READ_ONLY = {"get_stats", "get_accumulated"}
+
+class Run:
+    """
+    State shared by the steps of one scale.
+    """
+    def __init__(self, directory: str, csv_file: str, in_memory: bool):
+        self.csv_file = csv_file
+        self.in_memory = in_memory
+        self.db = DatabaseHandler(os.path.join(directory, "suite.db"))
+        self.parser = DataParser(self.db)
+        self.stats = StatCalculator(self.db)
+
+def git_commit() -> str:
+    """
+    Returns:
+    str: The abbreviated commit of the working tree, or None outside of a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_scale(rows: int, args) -> dict:
+    """
+    Returns:
+    dict: Seconds per step for a synthetic export with the given number of rows.
+    """
+    directory = tempfile.mkdtemp()
+    csv_file = os.path.join(directory, "suite.csv")
+    start_date = date.today() - timedelta(days=int(args.years * 365.25))
+    write_csv(csv_file, generate_transactions(rows, args.accounts, args.assets, args.seed, start_date, args.years))
+    run = Run(directory, csv_file, args.engine == "memory")
+    results = {}
+    for name, step in STEPS:
+        times = []
+        for _ in range(args.repeat if name in READ_ONLY else 1):
+            start = time.perf_counter()
+            step(run)
+            times.append(time.perf_counter() - start)
+        results[name] = min(times)
+    run.db.disconnect()
+    shutil.rmtree(directory)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import and stats pipeline at several scales")
+    parser.add_argument("--scales", default="1000,10000,100000", help="Comma separated numbers of transactions (default: 1000,10000,100000)")
+    parser.add_argument("--accounts", type=int, default=5, help="Number of accounts (default: 5)")
+    parser.add_argument("--assets", type=int, default=50, help="Number of assets (default: 50)")
+    parser.add_argument("--years", type=float, default=10, help="Years the transactions are spread over (default: 10)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--engine", choices=["memory", "sql"], default="memory", help="Transaction processing engine (default: memory)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the read only steps, the fastest is reported (default: 3)")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+
+    results = {}
+    for rows in (int(scale) for scale in args.scales.split(",")):
+        results[str(rows)] = run_scale(rows, args)
+        print()
+        print("{} transactions{}".format(rows, " (compared with {})".format(args.compare) if str(rows) in previous else ""))
+        for name, seconds in results[str(rows)].items():
+            old = previous.get(str(rows), {}).get(name)
+            change = "  {:6.2f}x".format(seconds / old) if old else ""
+            print("  {:24s} {:10.4f} s{}".format(name, seconds, change))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": sys.version.split()[0],
+                "parameters": {"accounts": args.accounts, "assets": args.assets, "years": args.years, "seed": args.seed, "engine": args.engine},
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
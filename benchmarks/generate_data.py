@@ -0,0 +1,185 @@
+"""
+Deterministic generator for synthetic Avanza transaction exports, used by the benchmarks.
+
+The generated transactions are consistent: purchases, withdrawals, fees and outgoing transfers never exceed
+the cash of the account and sales never exceed the holdings, so every transaction can be processed.
+Listing changes (Byte) rename an asset held by a single account, optionally with a split, since
+DataParser.handle_listing_change renames the asset for all accounts. Transactions of the same day are processed in the
+reverse order of the export, so a listing change is the first transaction of its day and the asset is not traded again that day.
+"""
+import argparse
+import csv
+import random
+
+from datetime import date, timedelta
+
+HEADER = ["Datum", "Konto", "Typ av transaktion", "Värdepapper/beskrivning", "Antal", "Kurs", "Belopp", "Courtage", "Valuta", "ISIN", "Resultat"]
+
+def format_number(number: float) -> str:
+    """
+    Formats a number the way Avanza does, with comma as decimal separator.
+    """
+    return ("%.6f" % number).rstrip("0").rstrip(".").replace(".", ",")
+
+def generate_transactions(rows: int, accounts: int = 3, assets: int = 20, seed: int = 0, start_date: date = date(2015, 1, 2),
+                          years: float = None, listing_changes: float = 0.01) -> list:
+    """
+    Generates synthetic transactions.
+
+    Parameters:
+    rows (int): Number of transactions to generate.
+    accounts (int): Number of accounts.
+    assets (int): Number of assets.
+    seed (int): Seed for the random generator. The same arguments always give the same transactions.
+    start_date (date): Date of the first transaction.
+    years (float): Number of years the transactions are spread over. If None, there are about three transactions per day.
+    listing_changes (float): Probability of a listing change (Byte) at the start of each day.
+
+    Returns:
+    list: Transactions as lists of csv fields, newest first like Avanza exports.
+    """
+    rng = random.Random(seed)
+    account_names = [str(1000 + i) for i in range(accounts)]
+    asset_names = ["Asset {}".format(i) for i in range(assets)]
+    isins = {asset: "SE{:010d}".format(i) for i, asset in enumerate(asset_names)}
+    price = {asset: rng.uniform(10, 200) for asset in asset_names}
+    cash = {account: 0.0 for account in account_names}
+    # Cash at the start of the day. Interest is divided over the capital of the account, which is processed
+    # before the earlier transactions of its day, so it is only paid to accounts that had cash at the start of the day
+    opening_cash = dict(cash)
+    holdings = {(account, asset): 0.0 for account in account_names for asset in asset_names}
+    day = start_date
+    transactions = []
+    renamed = 0
+    # Assets renamed today, not traded until the next day
+    frozen = set()
+
+    def add(account, transaction_type, asset, amount, price, total, isin=""):
+        transactions.append([day.isoformat(), account, transaction_type, asset, amount, price, total, "0", "SEK", isin, "-"])
+
+    def next_day():
+        nonlocal day
+        day += timedelta(days=1)
+        frozen.clear()
+        opening_cash.update(cash)
+        for asset in asset_names:
+            price[asset] *= rng.uniform(0.98, 1.0205)
+
+    while len(transactions) < rows:
+        if years is None:
+            # A few transactions per day on average
+            if rng.random() < 0.3:
+                next_day()
+        else:
+            while day < start_date + timedelta(days=int(len(transactions) * years * 365.25 / rows)):
+                next_day()
+        new_day = not transactions or transactions[-1][0] != day.isoformat()
+        if new_day and len(transactions) + 2 <= rows and rng.random() < listing_changes:
+            # Only assets held by a single account can be renamed, see the module docstring
+            owners = {}
+            for (owner, asset), amount in holdings.items():
+                if amount > 0.01:
+                    owners.setdefault(asset, []).append(owner)
+            candidates = [asset for asset in asset_names if len(owners.get(asset, ())) == 1]
+            if candidates:
+                asset = rng.choice(candidates)
+                owner = owners[asset][0]
+                split = rng.choice([1, 1, 2, 10])
+                if price[asset] / split < 5:
+                    split = 1
+                renamed += 1
+                new_asset = "{} B{}".format(asset.split(" B")[0], renamed)
+                amount = holdings.pop((owner, asset))
+                add(owner, "Byte", asset, format_number(-amount), "-", "-", isins[asset])
+                add(owner, "Byte", new_asset, format_number(amount * split), "-", "-", "SE{:010d}".format(assets + renamed))
+                for account in account_names:
+                    holdings[(account, new_asset)] = holdings.pop((account, asset), 0.0)
+                holdings[(owner, new_asset)] = amount * split
+                asset_names[asset_names.index(asset)] = new_asset
+                isins[new_asset] = "SE{:010d}".format(assets + renamed)
+                price[new_asset] = price.pop(asset) / split
+                frozen.add(new_asset)
+                continue
+        account = rng.choice(account_names)
+        held = [asset for asset in asset_names if holdings[(account, asset)] > 0.01 and asset not in frozen]
+        r = rng.random()
+        if r < 0.15 or cash[account] < 50:
+            amount = round(rng.uniform(100, 5000), 2)
+            cash[account] += amount
+            add(account, rng.choice(["Insättning", "Autogiroinsättning"]), "Insättning", "-", "-", format_number(amount))
+        elif r < 0.45:
+            asset = rng.choice([asset for asset in asset_names if asset not in frozen] if frozen else asset_names)
+            total = round(min(cash[account], rng.uniform(50, 3000)), 2)
+            if total < 1:
+                continue
+            amount = total / price[asset]
+            cash[account] -= total
+            holdings[(account, asset)] += amount
+            add(account, "Köp", asset, format_number(amount), format_number(price[asset]), format_number(-total), isins[asset])
+        elif r < 0.65:
+            if not held:
+                continue
+            asset = rng.choice(held)
+            amount = holdings[(account, asset)] * rng.choice([1.0, 0.5, 0.25])
+            total = round(amount * price[asset], 2)
+            holdings[(account, asset)] -= amount
+            cash[account] += total
+            add(account, "Sälj", asset, format_number(-amount), format_number(price[asset]), format_number(total), isins[asset])
+        elif r < 0.75:
+            if not held:
+                continue
+            asset = rng.choice(held)
+            dividend_per_share = round(rng.uniform(0.5, 3), 2)
+            amount = holdings[(account, asset)]
+            cash[account] += amount * dividend_per_share
+            add(account, "Utdelning", asset, format_number(amount), format_number(dividend_per_share), format_number(amount * dividend_per_share), isins[asset])
+        elif r < 0.82:
+            amount = round(rng.uniform(1, 20), 2)
+            if rng.random() < 0.5:
+                if opening_cash[account] < 1:
+                    continue
+                cash[account] += amount
+                add(account, "Inlåningsränta", "", "-", "-", format_number(amount))
+            elif cash[account] >= amount:
+                cash[account] -= amount
+                add(account, rng.choice(["Ränta", "Preliminärskatt", "Utländsk källskatt"]), "", "-", "-", format_number(-amount))
+        elif r < 0.90:
+            amount = round(min(cash[account], rng.uniform(10, 2000)), 2)
+            if amount < 1:
+                continue
+            cash[account] -= amount
+            add(account, "Uttag", "", "-", "-", format_number(-amount))
+        elif accounts > 1 and len(transactions) + 2 <= rows:
+            other = rng.choice([a for a in account_names if a != account])
+            amount = round(min(cash[account], rng.uniform(10, 2000)), 2)
+            if amount < 1:
+                continue
+            cash[account] -= amount
+            cash[other] += amount
+            add(account, "Intern överföring", "Överföring till " + other, "-", "-", format_number(-amount))
+            add(other, "Intern överföring", "Överföring från " + account, "-", "-", format_number(amount))
+
+    # Avanza exports are ordered newest first
+    transactions.reverse()
+    return transactions
+
+def write_csv(file_path: str, transactions: list) -> None:
+    """
+    Writes transactions to a csv file in the Avanza export format.
+    """
+    with open(file_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file, delimiter=";")
+        writer.writerow(HEADER)
+        writer.writerows(transactions)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Avanza export")
+    parser.add_argument("file", help="Path of the csv file to write")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of transactions (default: 10000)")
+    parser.add_argument("--accounts", type=int, default=3, help="Number of accounts (default: 3)")
+    parser.add_argument("--assets", type=int, default=20, help="Number of assets (default: 20)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--years", type=float, help="Spread the transactions over this many years, ending today (default: about three per day from 2015)")
+    args = parser.parse_args()
+    start_date = date(2015, 1, 2) if args.years is None else date.today() - timedelta(days=int(args.years * 365.25))
+    write_csv(args.file, generate_transactions(args.rows, args.accounts, args.assets, args.seed, start_date, args.years))
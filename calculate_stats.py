@@ -1,12 +1,20 @@
 from datetime import datetime, timedelta, date
+import calendar
 from database_handler import DatabaseHandler
-import requests
 import json
 import logging
-import time
+
+# numpy, return_engine and price_fetcher (requests) are imported by the methods that use them,
+# so that reading stats and CLI commands that do not calculate stay fast to start
 
 logging.basicConfig(level=logging.INFO)
 
+# Entries of the holdings (see StatCalculator._load_holdings) that are lists instead of arrays,
+# and the lists of dates and of optional floats among them
+HOLDINGS_LISTS = ("accounts", "months", "closed_returns", "cf_dates", "cf_amounts", "asset_ids", "account_starts", "year_starts", "year_closed_returns")
+HOLDINGS_DATES = ("months", "cf_dates")
+HOLDINGS_OPTIONAL = ("closed_returns", "year_closed_returns")
+
 class StatCalculator:
     """
     Class for getting monthly and yearly stats such as capital transfers and gain/loss.
@@ -17,6 +25,8 @@ class StatCalculator:
         db (DatabaseHandler): Database handler.
         """
         self.db = db
+        # Price independent inputs of the stats, see _load_holdings
+        self._holdings = None
 
     @staticmethod
     def _modified_dietz_hpr(deposit, total_gainloss, value, start_date, parsed_cfs, today):
@@ -68,425 +78,313 @@ class StatCalculator:
         if (1 + hpr) >= 0 and years_elapsed > 0:
             return 100 * ((1 + hpr) ** (1 / years_elapsed) - 1)
         return None
-    
-    def _ensure_per_account_tables(self):
-        """Create per-account statistics tables if they don't exist."""
-        self.db.connect()
-        cur = self.db.get_cursor()
-        
-        # Drop old global cached tables first
-        tables_to_drop = ['cohort_stats', 'year_stats']
-        for table in tables_to_drop:
-            cur.execute(f"DROP TABLE IF EXISTS {table}")
-        
-        # Check if per-account tables exist
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='account_cohort_stats'")
-        if cur.fetchone():
-            # Tables exist
-            return
-        
-        # Create account_cohort_stats
-        cur.execute("""
-            CREATE TABLE account_cohort_stats (
-                account TEXT NOT NULL,
-                month DATE NOT NULL,
-                deposit REAL,
-                withdrawal REAL,
-                value REAL,
-                total_gainloss REAL,
-                realized_gainloss REAL,
-                unrealized_gainloss REAL,
-                total_gainloss_per REAL,
-                realized_gainloss_per REAL,
-                unrealized_gainloss_per REAL,
-                annual_per_yield REAL,
-                acc_net_deposit REAL,
-                acc_deposit REAL,
-                acc_value REAL,
-                acc_unrealized_gainloss REAL,
-                acc_total_gainloss REAL,
-                PRIMARY KEY (account, month)
-            )
-        """)
-        
-        # Create account_year_stats
-        cur.execute("""
-            CREATE TABLE account_year_stats (
-                account TEXT NOT NULL,
-                year DATE NOT NULL,
-                deposit REAL,
-                withdrawal REAL,
-                value REAL,
-                total_gainloss REAL,
-                realized_gainloss REAL,
-                unrealized_gainloss REAL,
-                total_gainloss_per REAL,
-                realized_gainloss_per REAL,
-                unrealized_gainloss_per REAL,
-                annual_per_yield REAL,
-                acc_net_deposit REAL,
-                acc_deposit REAL,
-                acc_value REAL,
-                acc_unrealized_gainloss REAL,
-                acc_total_gainloss REAL,
-                PRIMARY KEY (account, year)
-            )
-        """)
-        
-        self.db.commit()
-        # Ensure updated table state exists locally to prevent KeyError exceptions
-        if 'account_cohort_stats' not in self.db.tables:
-            self.db.tables.extend(['account_cohort_stats', 'account_year_stats'])
-        logging.info("Created per-account statistics tables (dropped old global tables)")
-    
-    def _drop_old_tables(self):
-        """Drop old global cached tables if they exist."""
-        self.db.connect()
-        cur = self.db.get_cursor()
-        
-        tables_to_drop = ['cohort_stats', 'year_stats']
-        for table in tables_to_drop:
-            cur.execute(f"DROP TABLE IF EXISTS {table}")
-        
-        self.db.commit()
-        logging.info("Dropped old global cached tables")
-    
-    def _calc_apy(self, apy_mode, active_base, value, deposit, total_gainloss,
-                   month_str, account, start_date, today, cur, closed_return=None):
+
+    @staticmethod
+    def _year_range(year) -> tuple:
         """
-        Calculate APY using the specified mode.
-        
+        Returns the first day of a year and of the following year as ISO date strings,
+        for filtering date columns with month >= ? AND month < ? so that indexes can be used.
+
         Parameters:
-        apy_mode (str): 'modified-dietz' or 'twrr'
-        active_base (float): TWRR active base value
-        value (float): Current position value
-        deposit (float): Total deposits
-        total_gainloss (float): Total gain/loss
-        month_str (str): Cohort month string for DB queries
-        account (str or None): Account for single-account queries, None for multi-account
-        start_date (date): Start date for time-weighting
-        today (date): Current date
-        cur: Database cursor
-        closed_return (float or None): Snapshot of value/active_base at time of closure
-        
+        year (str or int): The year, e.g. "2020".
+
         Returns:
-        float or None: APY percentage
+        tuple: (start, end) such as ("2020-01-01", "2021-01-01").
         """
-        if apy_mode == 'twrr':
-            if active_base > 1e-4 and value > 0:
-                total_return = value / active_base
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (total_return ** (365.0 / total_days) - 1)
-            elif closed_return is not None and closed_return > 0:
-                # Closed position: use snapshot taken at time of full withdrawal
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (closed_return ** (365.0 / total_days) - 1)
-            return 0.0
-        
-        # Modified Dietz
-        if deposit <= 0:
-            return 0.0
-        
-        if account is not None:
-            # Single account query
-            cur.execute("""
-                SELECT transaction_month, amount
-                FROM cohort_cash_flows
-                WHERE cohort_month = ? AND account = ?
-            """, (month_str, account))
-        else:
-            # This shouldn't be called with account=None for single-account path
-            return 0.0
-        
-        parsed_cfs = [
-            (datetime.strptime(r[0], "%Y-%m-%d").date() if isinstance(r[0], str) else r[0], r[1])
-            for r in cur.fetchall()
-        ]
-        
-        hpr, total_days = self._modified_dietz_hpr(
-            deposit, total_gainloss, value, start_date, parsed_cfs, today)
-        return self._annualize_hpr(hpr, total_days)
-
-    def _calc_apy_multi(self, apy_mode, accounts, value, deposit, total_gainloss,
-                        month_str, start_date, today, cur):
+        year = int(year)
+        return (f"{year:04d}-01-01", f"{year + 1:04d}-01-01")
+    
+    def _merged_apys(self, apy_mode, accounts, period, periods, deposits, values, total_gainlosses, today, cur) -> list:
         """
-        Calculate APY for merged multi-account stats.
-        
+        Calculate the APY of merged multi-account stats for all periods at once.
+        The active bases and closed returns (TWRR) or the cash flows (Modified Dietz) of the accounts are read with one
+        grouped query and the APYs are computed in a single pass with return_engine.cohort_apy.
+
         Parameters:
         apy_mode (str): 'modified-dietz' or 'twrr'
         accounts (list): List of account strings
-        Other params: same as _calc_apy
-        
+        period (str): "month" or "year".
+        periods (list): Month of the cohorts of each period, the last day of the month, or the first day of each year (date).
+        deposits, values, total_gainlosses (list): Merged stats of each period.
+        today (date): Current date used as end date for open positions.
+        cur (sqlite3.Cursor): Cursor to query with.
+
         Returns:
-        float or None: APY percentage
-        """
-        placeholders = ",".join("?" * len(accounts))
-        
-        if apy_mode == 'twrr':
-            cur.execute(f"""
-                SELECT SUM(active_base)
-                FROM cohort_data
-                WHERE month = ? AND account IN ({placeholders})
-            """, (month_str,) + tuple(accounts))
-            ab_row = cur.fetchone()
-            active_base = ab_row[0] if ab_row and ab_row[0] else 0.0
-            
-            if active_base > 1e-4 and value > 0:
-                total_return = value / active_base
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (total_return ** (365.0 / total_days) - 1)
-            
-            # Check for closed positions with snapshot
-            cur.execute(f"""
-                SELECT SUM(deposit * closed_return), SUM(deposit)
-                FROM cohort_data
-                WHERE month = ? AND account IN ({placeholders}) AND closed_return IS NOT NULL
-            """, (month_str,) + tuple(accounts))
-            cr_row = cur.fetchone()
-            if cr_row and cr_row[0] and cr_row[1] and cr_row[1] > 0:
-                weighted_cr = cr_row[0] / cr_row[1]
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (weighted_cr ** (365.0 / total_days) - 1)
-            return 0.0
-        
-        # Modified Dietz for multi-account
-        if deposit <= 0:
-            return 0.0
-        
-        cur.execute(f"""
-            SELECT transaction_month, amount
-            FROM cohort_cash_flows
-            WHERE cohort_month = ? AND account IN ({placeholders})
-        """, (month_str,) + tuple(accounts))
-        parsed_cfs = [
-            (datetime.strptime(r[0], "%Y-%m-%d").date() if isinstance(r[0], str) else r[0], r[1])
-            for r in cur.fetchall()
-        ]
-        
-        hpr, total_days = self._modified_dietz_hpr(
-            deposit, total_gainloss, value, start_date, parsed_cfs, today)
-        return self._annualize_hpr(hpr, total_days)
-
-    def _calc_apy_year_multi(self, apy_mode, accounts, value, deposit, total_gainloss,
-                             year_str, start_date, today, cur):
-        """
-        Calculate APY for merged multi-account yearly stats.
+        list: APY percentage (float) of each period, or None where it is not computable.
         """
+        from return_engine import cohort_apy
         placeholders = ",".join("?" * len(accounts))
+        # Cohorts are grouped by their month or by the first day of their year, as text to match the periods
+        key = "CAST({} AS TEXT)" if period == "month" else "substr({}, 1, 4) || '-01-01'"
+        index = {p.isoformat(): i for i, p in enumerate(periods)}
+        if period == "month":
+            start_dates = [p.replace(day=15) for p in periods]
+        else:
+            start_dates = [p.replace(month=7) for p in periods]
         
+        active_bases = [0.0] * len(periods)
+        closed_returns = [None] * len(periods)
+        cf_periods, cf_dates, cf_amounts = [], [], []
         if apy_mode == 'twrr':
-            cur.execute(f"""
-                SELECT SUM(active_base)
-                FROM cohort_data
-                WHERE strftime('%Y', month) = ? AND account IN ({placeholders})
-            """, (year_str,) + tuple(accounts))
-            ab_row = cur.fetchone()
-            active_base = ab_row[0] if ab_row and ab_row[0] else 0.0
-            
-            if active_base > 1e-4 and value > 0:
-                total_return = value / active_base
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (total_return ** (365.0 / total_days) - 1)
-            
-            # Check for closed positions with snapshot
-            cur.execute(f"""
-                SELECT SUM(deposit * closed_return), SUM(deposit)
+            for group, active_base, closed_sum, closed_deposit in cur.execute(f"""
+                SELECT {key.format("month")}, SUM(active_base),
+                       SUM(CASE WHEN closed_return IS NOT NULL THEN deposit * closed_return END),
+                       SUM(CASE WHEN closed_return IS NOT NULL THEN deposit END)
                 FROM cohort_data
-                WHERE strftime('%Y', month) = ? AND account IN ({placeholders}) AND closed_return IS NOT NULL
-            """, (year_str,) + tuple(accounts))
-            cr_row = cur.fetchone()
-            if cr_row and cr_row[0] and cr_row[1] and cr_row[1] > 0:
-                weighted_cr = cr_row[0] / cr_row[1]
-                total_days = (today - start_date).days
-                if total_days > 0:
-                    return 100 * (weighted_cr ** (365.0 / total_days) - 1)
-            return 0.0
-        
-        # Modified Dietz for multi-account year
-        if deposit <= 0:
-            return 0.0
-        
-        cur.execute(f"""
-            SELECT transaction_month, amount
-            FROM cohort_cash_flows
-            WHERE strftime('%Y', cohort_month) = ? AND account IN ({placeholders})
-        """, (year_str,) + tuple(accounts))
-        parsed_cfs = [
-            (datetime.strptime(r[0], "%Y-%m-%d").date() if isinstance(r[0], str) else r[0], r[1])
-            for r in cur.fetchall()
-        ]
-        
-        hpr, total_days = self._modified_dietz_hpr(
-            deposit, total_gainloss, value, start_date, parsed_cfs, today)
-        return self._annualize_hpr(hpr, total_days)
-
-    def calculate_cohort_stats(self, apy_mode='modified-dietz'):
+                WHERE account IN ({placeholders})
+                GROUP BY 1
+            """, tuple(accounts)):
+                if group in index:
+                    active_bases[index[group]] = active_base or 0.0
+                    if closed_sum and closed_deposit and closed_deposit > 0:
+                        closed_returns[index[group]] = closed_sum / closed_deposit
+        else:
+            # The weight of a cash flow only depends on its period and month, so the flows of each month are summed
+            for group, transaction_month, amount in cur.execute(f"""
+                SELECT {key.format("cohort_month")}, transaction_month, SUM(amount)
+                FROM cohort_cash_flows
+                WHERE account IN ({placeholders})
+                GROUP BY 1, transaction_month
+                ORDER BY 1, transaction_month
+            """, tuple(accounts)):
+                if group in index:
+                    cf_periods.append(index[group])
+                    cf_dates.append(datetime.strptime(transaction_month, "%Y-%m-%d").date()
+                                    if isinstance(transaction_month, str) else transaction_month)
+                    cf_amounts.append(amount)
+        
+        # cohort_apy takes the cash flows ordered by period, the flows of each period keep their query order
+        order = sorted(range(len(cf_periods)), key=cf_periods.__getitem__)
+        counts = [0] * len(periods)
+        for i in cf_periods:
+            counts[i] += 1
+        cf_offsets = [0]
+        for count in counts:
+            cf_offsets.append(cf_offsets[-1] + count)
+        return cohort_apy(apy_mode, start_dates, deposits, values, total_gainlosses, active_bases, closed_returns,
+                          cf_offsets, [cf_dates[i] for i in order], [cf_amounts[i] for i in order], today)
+
+    def calculate_cohort_stats(self, apy_mode='modified-dietz', dirty: dict = None):
         """
         Calculate monthly stats such as capital transfers and gain/loss.
         Stores results in account_cohort_stats table (per account).
+        Cohorts, asset values and cash flows are loaded for all accounts with one query each,
+        the APY of all cohorts is computed with one call to return_engine.cohort_apy
+        and the stats are written with a single executemany.
         
         Parameters:
         apy_mode (str): 'modified-dietz' or 'twrr'
+        dirty (dict): Only recalculate these accounts, from the first day of the given month on, see get_dirty_accounts.
+            The running totals continue from the stored stats of the month before. None recalculates everything.
         """
-        self._ensure_per_account_tables()
+        from return_engine import cohort_apy
         self.db.connect()
-        
-        # Reset account_cohort_stats table
-        self.db.reset_table("account_cohort_stats")
-        
         cur = self.db.get_cursor()
         today = datetime.today().date()
+        # The cohorts changed, the holdings are loaded again on the next revaluation
+        self._holdings = None
+        cur.execute("DELETE FROM stats_holdings")
+        
+        if dirty is None:
+            # Reset account_cohort_stats table
+            self.db.reset_table("account_cohort_stats")
+            account_filter, account_params = "", ()
+        else:
+            cur.executemany("DELETE FROM account_cohort_stats WHERE account = ? AND month >= ?", dirty.items())
+            account_filter = f"WHERE account IN ({','.join('?' * len(dirty))})"
+            account_params = tuple(dirty)
+        
+        # All cohorts in chronological order per account
+        cohort_rows = cur.execute(f"""
+            SELECT account, month, deposit, withdrawal, capital, active_base, closed_return, transfer_net
+            FROM cohort_data
+            {account_filter}
+            ORDER BY account, month
+        """, account_params).fetchall()
+        
+        # Value of the asset holdings of each cohort, keyed by (account, ISO month string).
+        # The months are cast to TEXT to skip the date conversion and the order follows the primary key.
+        asset_values = {}
+        for account, month, amount, price in cur.execute(f"""
+            SELECT ma.account, CAST(ma.month AS TEXT), ma.amount, a.latest_price
+            FROM cohort_assets ma
+            JOIN assets a ON ma.asset_id = a.asset_id
+            WHERE ma.amount > 0.001 AND a.latest_price IS NOT NULL {account_filter.replace("WHERE account", "AND ma.account")}
+            ORDER BY ma.month, ma.asset_id
+        """, account_params):
+            asset_values[(account, month)] = asset_values.get((account, month), 0.0) + amount * price
+        
+        # Cash flows of each cohort, only used by Modified Dietz
+        cash_flows = {}
+        if apy_mode != 'twrr':
+            for account, month, transaction_month, amount in cur.execute(f"""
+                SELECT account, CAST(cohort_month AS TEXT), transaction_month, amount
+                FROM cohort_cash_flows
+                {account_filter}
+                ORDER BY cohort_month, account, transaction_month
+            """, account_params):
+                cash_flows.setdefault((account, month), []).append((transaction_month, amount))
+        
+        # Running totals of the stats that are kept, the remaining stats of the account continue from them
+        stored_totals = {}
+        if dirty is not None:
+            for account, since in dirty.items():
+                stored_totals[account] = cur.execute("""
+                    SELECT acc_net_deposit, acc_deposit, acc_value, acc_unrealized_gainloss, acc_total_gainloss
+                    FROM account_cohort_stats
+                    WHERE account = ? AND month < ?
+                    ORDER BY month DESC
+                    LIMIT 1
+                """, (account, since)).fetchone()
         
-        # Get all accounts
-        accounts = [row[0] for row in cur.execute(
-            "SELECT DISTINCT account FROM cohort_data ORDER BY account"
-        ).fetchall()]
-        
+        accounts = sorted({row[0] for row in cohort_rows})
         logging.info(f"Calculating monthly stats for {len(accounts)} accounts")
         
-        for account in accounts:
-            # Get all months for this account in chronological order
-            cur.execute("""
-                SELECT month, deposit, withdrawal, capital, active_base, closed_return, transfer_net
-                FROM cohort_data
-                WHERE account = ?
-                ORDER BY month ASC
-            """, (account,))
-            month_rows = cur.fetchall()
+        stats_rows = []
+        # Inputs to cohort_apy, one entry per cohort and a flattened cash flow table
+        start_dates, deposits, values, total_gainlosses, active_bases, closed_returns = [], [], [], [], [], []
+        cf_offsets, cf_dates, cf_amounts = [0], [], []
+        previous_account = None
+        for account, month_str, deposit, withdrawal, capital, active_base, closed_return, transfer_net in cohort_rows:
+            if account != previous_account:
+                # Initialize accumulators (PER ACCOUNT)
+                previous_account = account
+                since = dirty[account] if dirty is not None else None
+                acc_deposit = 0.0
+                acc_value = 0.0
+                acc_withdrawal = 0.0
+                acc_net_deposit = 0.0
+                acc_total_gainloss = 0.0
+                acc_realized_gainloss = 0.0
+                acc_unrealized_gainloss = 0.0
+                if stored_totals.get(account):
+                    acc_net_deposit, acc_deposit, acc_value, acc_unrealized_gainloss, acc_total_gainloss = stored_totals[account]
             
-            if not month_rows:
+            # Stats before the first dirty month are kept
+            if since is not None and month_str < since:
                 continue
             
-            # Initialize accumulators (PER ACCOUNT)
-            acc_deposit = 0.0
-            acc_value = 0.0
-            acc_withdrawal = 0.0
-            acc_net_deposit = 0.0
-            acc_total_gainloss = 0.0
-            acc_realized_gainloss = 0.0
-            acc_unrealized_gainloss = 0.0
+            # Handle NULL values
+            deposit = deposit or 0.0
+            withdrawal = withdrawal or 0.0
+            capital = capital or 0.0
+            transfer_net = transfer_net or 0.0
             
-            for month_str, deposit, withdrawal, capital, active_base, closed_return, transfer_net in month_rows:
-                # Handle NULL values
-                deposit = deposit or 0.0
-                withdrawal = withdrawal or 0.0
-                capital = capital or 0.0
-                transfer_net = transfer_net or 0.0
-                
-                # Get asset holdings for this account in this month
-                cur.execute("""
-                    SELECT ma.asset_id, ma.amount, a.latest_price
-                    FROM cohort_assets ma
-                    JOIN assets a ON ma.asset_id = a.asset_id
-                    WHERE ma.account = ? AND ma.month = ? AND ma.amount > 0.001
-                    AND a.latest_price IS NOT NULL
-                """, (account, month_str))
-                asset_rows = cur.fetchall()
-                
-                # Calculate asset value
-                asset_value = 0.0
-                for asset_id, amount, price in asset_rows:
-                    if price is not None:
-                        asset_value += amount * price
-                
-                # Total value = cash + assets
-                value = capital + asset_value
-                
-                # Calculate gain/loss - subtract transfer_net to neutralize phantom gains/losses
-                # from internal transfers between accounts
-                total_gainloss = withdrawal + value - deposit - transfer_net
-                
-                # Calculate realized gain/loss
-                if (withdrawal + capital >= deposit + transfer_net) or (withdrawal + capital < deposit + transfer_net and value <= 0):
-                    realized_gainloss = withdrawal + capital - deposit - transfer_net
-                else:
-                    realized_gainloss = 0.0
-                
-                unrealized_gainloss = total_gainloss - realized_gainloss
-                
-                # Calculate percentages
-                if deposit > 0:
-                    total_gainloss_per = 100 * total_gainloss / deposit
-                    realized_gainloss_per = 100 * realized_gainloss / deposit
-                    unrealized_gainloss_per = 100 * unrealized_gainloss / deposit
-                else:
-                    total_gainloss_per = 0.0
-                    realized_gainloss_per = 0.0
-                    unrealized_gainloss_per = 0.0
-                
-                # Calculate APY
-                if isinstance(month_str, str):
-                    month_date = datetime.strptime(month_str, "%Y-%m-%d").date()
-                else:
-                    month_date = month_str
+            month_key = (account, str(month_str))
+            
+            # Total value = cash + assets
+            value = capital + asset_values.get(month_key, 0.0)
+            
+            # Calculate gain/loss - subtract transfer_net to neutralize phantom gains/losses
+            # from internal transfers between accounts
+            total_gainloss = withdrawal + value - deposit - transfer_net
+            
+            # Calculate realized gain/loss
+            if (withdrawal + capital >= deposit + transfer_net) or (withdrawal + capital < deposit + transfer_net and value <= 0):
+                realized_gainloss = withdrawal + capital - deposit - transfer_net
+            else:
+                realized_gainloss = 0.0
+            
+            unrealized_gainloss = total_gainloss - realized_gainloss
+            
+            # Calculate percentages
+            if deposit > 0:
+                total_gainloss_per = 100 * total_gainloss / deposit
+                realized_gainloss_per = 100 * realized_gainloss / deposit
+                unrealized_gainloss_per = 100 * unrealized_gainloss / deposit
+            else:
+                total_gainloss_per = 0.0
+                realized_gainloss_per = 0.0
+                unrealized_gainloss_per = 0.0
+            
+            # Calculate APY
+            if isinstance(month_str, str):
+                month_date = datetime.strptime(month_str, "%Y-%m-%d").date()
+            else:
+                month_date = month_str
 
-                active_base = active_base or 0.0
-                start_date = month_date.replace(day=15)
-                annual_per_yield = self._calc_apy(
-                    apy_mode, active_base, value, deposit, total_gainloss,
-                    month_str, account, start_date, today, cur, closed_return=closed_return)
-                
-                # Update accumulators (same logic as original)
-                acc_deposit += deposit
-                acc_value += value
-                acc_withdrawal += withdrawal
-                net_deposit = deposit - withdrawal
-                if net_deposit > 0:
-                    acc_net_deposit += net_deposit
-                acc_total_gainloss += total_gainloss
-                acc_realized_gainloss += realized_gainloss
-                acc_unrealized_gainloss += unrealized_gainloss
-                
-                # Adjust month if it's in the future (same as original)
-                if month_date >= today.replace(day=1):
-                    month_date = today
-                
-                # Insert into per-account table
-                cur.execute("""
-                    INSERT INTO account_cohort_stats (
-                        account, month, deposit, withdrawal, value,
-                        total_gainloss, realized_gainloss, unrealized_gainloss,
-                        total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
-                        annual_per_yield, acc_net_deposit, acc_deposit, acc_value,
-                        acc_unrealized_gainloss, acc_total_gainloss
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    account, month_date, deposit, withdrawal, value,
-                    total_gainloss, realized_gainloss, unrealized_gainloss,
-                    total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
-                    annual_per_yield, acc_net_deposit, acc_deposit, acc_value,
-                    acc_unrealized_gainloss, acc_total_gainloss
-                ))
+            start_dates.append(month_date.replace(day=15))
+            deposits.append(deposit)
+            values.append(value)
+            total_gainlosses.append(total_gainloss)
+            active_bases.append(active_base or 0.0)
+            closed_returns.append(closed_return)
+            for transaction_month, amount in cash_flows.get(month_key, ()):
+                cf_dates.append(transaction_month)
+                cf_amounts.append(amount)
+            cf_offsets.append(len(cf_dates))
+            
+            # Update accumulators (same logic as original)
+            acc_deposit += deposit
+            acc_value += value
+            acc_withdrawal += withdrawal
+            net_deposit = deposit - withdrawal
+            if net_deposit > 0:
+                acc_net_deposit += net_deposit
+            acc_total_gainloss += total_gainloss
+            acc_realized_gainloss += realized_gainloss
+            acc_unrealized_gainloss += unrealized_gainloss
+            
+            # Adjust month if it's in the future (same as original)
+            if month_date >= today.replace(day=1):
+                month_date = today
+            
+            stats_rows.append([
+                account, month_date, deposit, withdrawal, value,
+                total_gainloss, realized_gainloss, unrealized_gainloss,
+                total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
+                None, acc_net_deposit, acc_deposit, acc_value,
+                acc_unrealized_gainloss, acc_total_gainloss
+            ])
+        
+        # Calculate APY for all cohorts at once
+        annual_per_yields = cohort_apy(
+            apy_mode, start_dates, deposits, values, total_gainlosses, active_bases, closed_returns,
+            cf_offsets, cf_dates, cf_amounts, today)
+        for stats_row, annual_per_yield in zip(stats_rows, annual_per_yields):
+            stats_row[11] = annual_per_yield
+        
+        # Insert into per-account table
+        cur.executemany("""
+            INSERT INTO account_cohort_stats (
+                account, month, deposit, withdrawal, value,
+                total_gainloss, realized_gainloss, unrealized_gainloss,
+                total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
+                annual_per_yield, acc_net_deposit, acc_deposit, acc_value,
+                acc_unrealized_gainloss, acc_total_gainloss
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, stats_rows)
         
         self.db.commit()
         logging.info(f"Monthly stats calculated for {len(accounts)} accounts")
             
-    def calculate_year_stats(self, apy_mode='modified-dietz'):
+    def calculate_year_stats(self, apy_mode='modified-dietz', dirty: dict = None):
         """
         Calculate yearly stats from monthly stats.
         Stores results in account_year_stats table (per account).
         
         Parameters:
         apy_mode (str): 'modified-dietz' or 'twrr'
+        dirty (dict): Only recalculate these accounts, from the year of the given month on, see get_dirty_accounts.
+            None recalculates everything.
         """
-        self._ensure_per_account_tables()
         self.db.connect()
-        
-        # Reset account_year_stats table
-        self.db.reset_table("account_year_stats")
-        
         cur = self.db.get_cursor()
         today = datetime.today().date()
         
-        # Get all accounts
-        accounts = [row[0] for row in cur.execute(
-            "SELECT DISTINCT account FROM account_cohort_stats ORDER BY account"
-        ).fetchall()]
+        if dirty is None:
+            # Reset account_year_stats table
+            self.db.reset_table("account_year_stats")
+            
+            # Get all accounts
+            accounts = [row[0] for row in cur.execute(
+                "SELECT DISTINCT account FROM account_cohort_stats ORDER BY account"
+            ).fetchall()]
+        else:
+            # Later years include the running totals of the dirty months
+            first_years = {account: f"{since.year:04d}-01-01" for account, since in dirty.items()}
+            cur.executemany("DELETE FROM account_year_stats WHERE account = ? AND year >= ?", first_years.items())
+            accounts = sorted(dirty)
         
         logging.info(f"Calculating yearly stats for {len(accounts)} accounts")
         
@@ -495,18 +393,19 @@ class StatCalculator:
             cur.execute("""
                 SELECT DISTINCT strftime('%Y', month) as year
                 FROM account_cohort_stats
-                WHERE account = ?
+                WHERE account = ? AND month >= ?
                 ORDER BY year
-            """, (account,))
+            """, (account, first_years[account] if dirty is not None else "0001-01-01"))
             years = [row[0] for row in cur.fetchall()]
             
             for year_str in years:
+                year_start, year_end = self._year_range(year_str)
                 # Sum cohort deposits, withdrawals, and cash capital for the entire year
                 cur.execute("""
                     SELECT SUM(deposit), SUM(withdrawal), SUM(capital), SUM(active_base), SUM(transfer_net)
                     FROM cohort_data
-                    WHERE account = ? AND strftime('%Y', month) = ?
-                """, (account, year_str))
+                    WHERE account = ? AND month >= ? AND month < ?
+                """, (account, year_start, year_end))
                 dep_row = cur.fetchone()
                 deposit = dep_row[0] or 0.0
                 withdrawal = dep_row[1] or 0.0
@@ -518,8 +417,8 @@ class StatCalculator:
                 cur.execute("""
                     SELECT SUM(deposit * closed_return), SUM(deposit)
                     FROM cohort_data
-                    WHERE account = ? AND strftime('%Y', month) = ? AND closed_return IS NOT NULL
-                """, (account, year_str))
+                    WHERE account = ? AND month >= ? AND month < ? AND closed_return IS NOT NULL
+                """, (account, year_start, year_end))
                 cr_row = cur.fetchone()
                 if cr_row and cr_row[0] and cr_row[1] and cr_row[1] > 0:
                     weighted_closed_return = cr_row[0] / cr_row[1]
@@ -531,10 +430,10 @@ class StatCalculator:
                     SELECT ma.asset_id, SUM(ma.amount), a.latest_price
                     FROM cohort_assets ma
                     JOIN assets a ON ma.asset_id = a.asset_id
-                    WHERE ma.account = ? AND strftime('%Y', ma.month) = ? AND ma.amount > 0.001
+                    WHERE ma.account = ? AND ma.month >= ? AND ma.month < ? AND ma.amount > 0.001
                     AND a.latest_price IS NOT NULL
                     GROUP BY ma.asset_id
-                """, (account, year_str))
+                """, (account, year_start, year_end))
                 
                 asset_value = 0.0
                 for asset_id, amount, price in cur.fetchall():
@@ -566,10 +465,10 @@ class StatCalculator:
                 cur.execute("""
                     SELECT acc_net_deposit, acc_deposit, acc_value, acc_unrealized_gainloss, acc_total_gainloss
                     FROM account_cohort_stats
-                    WHERE account = ? AND strftime('%Y', month) = ?
+                    WHERE account = ? AND month >= ? AND month < ?
                     ORDER BY month DESC
                     LIMIT 1
-                """, (account, year_str))
+                """, (account, year_start, year_end))
                 last_month = cur.fetchone()
                 
                 if last_month:
@@ -600,8 +499,8 @@ class StatCalculator:
                             cur.execute("""
                                 SELECT transaction_month, amount
                                 FROM cohort_cash_flows
-                                WHERE strftime('%Y', cohort_month) = ? AND account = ?
-                            """, (year_str, account))
+                                WHERE cohort_month >= ? AND cohort_month < ? AND account = ?
+                            """, (year_start, year_end, account))
                             parsed_cfs = [
                                 (datetime.strptime(r[0], "%Y-%m-%d").date() if isinstance(r[0], str) else r[0], r[1])
                                 for r in cur.fetchall()
@@ -641,6 +540,331 @@ class StatCalculator:
         """
         self.calculate_cohort_stats(apy_mode=apy_mode)
         self.calculate_year_stats(apy_mode=apy_mode)
+        self._clear_dirty()
+
+    def get_dirty_accounts(self) -> dict:
+        """
+        Get the accounts with stats that are out of date. Cohorts are marked dirty by DataParser when processing changes their
+        cohort_data, cohort_assets or cohort_cash_flows rows, and assets by a trigger when their latest_price changes,
+        which makes every cohort holding them dirty.
+
+        Returns:
+        dict: Account mapped to the first day of its earliest dirty month.
+        """
+        self.db.connect()
+        cur = self.db.get_cursor()
+        # MIN returns strings even with PARSE_DECLTYPES
+        rows = cur.execute("""
+            SELECT account, MIN(month)
+            FROM (
+                SELECT account, month FROM dirty_cohorts
+                UNION ALL
+                SELECT ma.account, ma.month
+                FROM cohort_assets ma
+                JOIN dirty_assets d ON ma.asset_id = d.asset_id
+            )
+            GROUP BY account
+        """).fetchall()
+        return {account: date.fromisoformat(month).replace(day=1) for account, month in rows}
+
+    def update_stats(self, apy_mode='modified-dietz') -> dict:
+        """
+        Recalculate the monthly and yearly stats of the dirty accounts, from their earliest dirty month on.
+        When only prices changed, the stats are revalued with revalue_stats instead.
+        The APY of the stats that are kept is not updated to the current date, use calculate_stats for that.
+
+        Parameters:
+        apy_mode (str): 'modified-dietz' or 'twrr', has to be the mode of the stored stats.
+
+        Returns:
+        dict: The recalculated accounts, see get_dirty_accounts.
+        """
+        dirty = self.get_dirty_accounts()
+        if dirty:
+            (prices_only,) = self.db.get_cursor().execute("SELECT NOT EXISTS(SELECT 1 FROM dirty_cohorts)").fetchone()
+            if prices_only:
+                self.revalue_stats(apy_mode=apy_mode, dirty=dirty)
+            else:
+                self.calculate_cohort_stats(apy_mode=apy_mode, dirty=dirty)
+                self.calculate_year_stats(apy_mode=apy_mode, dirty=dirty)
+        self._clear_dirty()
+        return dirty
+
+    def _load_holdings(self) -> dict:
+        """
+        Load the inputs of the stats that do not depend on prices: the cash columns and cash flows of all cohorts
+        in (account, month) order, the years they are grouped in and the holdings matrix, the asset amounts of each
+        cohort in coordinate form. The holdings are kept, and stored by _write_holdings, until calculate_cohort_stats runs because cohorts changed.
+
+        Returns:
+        dict: Arrays of the cohorts, years and holdings.
+        """
+        import numpy as np
+        self.db.connect()
+        cur = self.db.get_cursor()
+        cohort_rows = cur.execute("""
+            SELECT account, month, deposit, withdrawal, capital, active_base, closed_return, transfer_net
+            FROM cohort_data
+            ORDER BY account, month
+        """).fetchall()
+        n = len(cohort_rows)
+        index = {(row[0], str(row[1])): i for i, row in enumerate(cohort_rows)}
+        accounts = [row[0] for row in cohort_rows]
+        months = [row[1] for row in cohort_rows]
+        deposit, withdrawal, capital, active_base, transfer_net = (
+            np.array([row[column] or 0.0 for row in cohort_rows], dtype=np.float64)
+            for column in (2, 3, 4, 5, 7))
+        closed_returns = [row[6] for row in cohort_rows]
+        
+        # Holdings matrix, same order as the asset values of calculate_cohort_stats so the values are summed alike
+        asset_ids = {}
+        rows, columns, amounts = [], [], []
+        for account, month, asset_id, amount in cur.execute("""
+            SELECT account, CAST(month AS TEXT), asset_id, amount
+            FROM cohort_assets
+            WHERE amount > 0.001
+            ORDER BY month, asset_id
+        """):
+            rows.append(index[(account, month)])
+            columns.append(asset_ids.setdefault(asset_id, len(asset_ids)))
+            amounts.append(amount)
+        
+        # Cash flows ordered by cohort, the flows of cohort i are cf_dates[cf_offsets[i]:cf_offsets[i + 1]]
+        cf_cohorts, cf_dates, cf_amounts = [], [], []
+        for account, month, transaction_month, amount in cur.execute("""
+            SELECT account, CAST(cohort_month AS TEXT), transaction_month, amount
+            FROM cohort_cash_flows
+            ORDER BY account, cohort_month, transaction_month
+        """):
+            if (account, month) in index:
+                cf_cohorts.append(index[(account, month)])
+                cf_dates.append(transaction_month)
+                cf_amounts.append(amount)
+        cf_offsets = np.concatenate(([0], np.cumsum(np.bincount(cf_cohorts, minlength=n)))).astype(np.int64)
+        
+        # Cohorts are ordered by account and month, so accounts and years are consecutive runs of cohorts
+        account_starts = [i for i in range(n) if i == 0 or accounts[i] != accounts[i - 1]]
+        year_starts = [i for i in range(n) if i == 0 or (accounts[i], months[i].year) != (accounts[i - 1], months[i - 1].year)]
+        year_of_cohort = np.repeat(np.arange(len(year_starts)), np.diff(year_starts + [n]))
+        starts = np.array(year_starts, dtype=np.int64)
+        
+        # Deposit weighted closed return of the closed cohorts of each year
+        closed_return = np.array([np.nan if r is None else r for r in closed_returns], dtype=np.float64)
+        closed = ~np.isnan(closed_return)
+        closed_sum = np.add.reduceat(np.where(closed, deposit * np.where(closed, closed_return, 0.0), 0.0), starts) if n else np.zeros(0)
+        closed_deposit = np.add.reduceat(np.where(closed, deposit, 0.0), starts) if n else np.zeros(0)
+        year_closed_returns = [s / d if s and d > 0 else None for s, d in zip(closed_sum.tolist(), closed_deposit.tolist())]
+        
+        # Holdings of each year, the amounts of an asset are summed over the cohorts of the year before they are valued
+        year_keys = year_of_cohort[np.asarray(rows, dtype=np.int64)] * max(len(asset_ids), 1) + np.asarray(columns, dtype=np.int64)
+        year_keys, year_key_index = np.unique(year_keys, return_inverse=True)
+        year_amounts = np.bincount(year_key_index, weights=np.asarray(amounts, dtype=np.float64), minlength=len(year_keys))
+        
+        return {
+            "accounts": accounts,
+            "months": months,
+            "deposit": deposit,
+            "withdrawal": withdrawal,
+            "capital": capital,
+            "active_base": active_base,
+            "transfer_net": transfer_net,
+            "closed_returns": closed_returns,
+            "cf_offsets": cf_offsets,
+            "cf_dates": cf_dates,
+            "cf_amounts": cf_amounts,
+            "asset_ids": list(asset_ids),
+            "rows": np.asarray(rows, dtype=np.int64),
+            "columns": np.asarray(columns, dtype=np.int64),
+            "amounts": np.asarray(amounts, dtype=np.float64),
+            "account_starts": account_starts,
+            "year_starts": year_starts,
+            "year_closed_returns": year_closed_returns,
+            "year_rows": year_keys // max(len(asset_ids), 1),
+            "year_columns": year_keys % max(len(asset_ids), 1),
+            "year_amounts": year_amounts,
+        }
+
+    def _write_holdings(self, holdings: dict):
+        """
+        Store the holdings in stats_holdings as an npz archive, so that the revaluations of later runs do not load them again.
+        Lists of dates and of optional floats are stored as datetime64 and NaN arrays. Does not commit.
+
+        Parameters:
+        holdings (dict): See _load_holdings.
+        """
+        import io
+        import numpy as np
+        arrays = {}
+        for name, value in holdings.items():
+            if name in HOLDINGS_DATES:
+                arrays[name] = np.array(value, dtype="datetime64[D]")
+            elif name in HOLDINGS_OPTIONAL:
+                arrays[name] = np.array([np.nan if v is None else v for v in value], dtype=np.float64)
+            else:
+                arrays[name] = np.asarray(value)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        cur = self.db.get_cursor()
+        cur.execute("DELETE FROM stats_holdings")
+        cur.execute("INSERT INTO stats_holdings(holdings) VALUES (?)", (buffer.getvalue(),))
+
+    def _read_holdings(self):
+        """
+        Read the holdings stored by _write_holdings. They are only valid while no cohort is dirty, since calculate_cohort_stats
+        removes them before the dirty cohorts are cleared.
+
+        Returns:
+        dict: See _load_holdings, or None if there are no valid stored holdings.
+        """
+        import io
+        import math
+        import numpy as np
+        self.db.connect()
+        row = self.db.get_cursor().execute(
+            "SELECT holdings FROM stats_holdings WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts)").fetchone()
+        if row is None:
+            return None
+        holdings = {}
+        with np.load(io.BytesIO(row[0]), allow_pickle=False) as arrays:
+            for name in arrays.files:
+                value = arrays[name]
+                if name in HOLDINGS_DATES:
+                    holdings[name] = value.astype(object).tolist()
+                elif name in HOLDINGS_OPTIONAL:
+                    holdings[name] = [None if math.isnan(v) else v for v in value.tolist()]
+                elif name in HOLDINGS_LISTS:
+                    holdings[name] = value.tolist()
+                else:
+                    holdings[name] = value
+        return holdings
+
+    @staticmethod
+    def _gainloss_columns(deposit, withdrawal, capital, transfer_net, value) -> tuple:
+        """
+        Array version of the gain/loss calculation of calculate_cohort_stats and calculate_year_stats.
+
+        Returns:
+        tuple: Arrays of total_gainloss, realized_gainloss, unrealized_gainloss and their percentages of deposit.
+        """
+        import numpy as np
+        total_gainloss = withdrawal + value - deposit - transfer_net
+        realized = (withdrawal + capital >= deposit + transfer_net) | (value <= 0)
+        realized_gainloss = np.where(realized, withdrawal + capital - deposit - transfer_net, 0.0)
+        unrealized_gainloss = total_gainloss - realized_gainloss
+        has_deposit = deposit > 0
+        safe_deposit = np.where(has_deposit, deposit, 1.0)
+        percentages = tuple(np.where(has_deposit, 100 * column / safe_deposit, 0.0)
+                            for column in (total_gainloss, realized_gainloss, unrealized_gainloss))
+        return (total_gainloss, realized_gainloss, unrealized_gainloss) + percentages
+
+    def revalue_stats(self, apy_mode='modified-dietz', dirty: dict = None):
+        """
+        Patch the stats after price changes, when deposits, withdrawals, capital and cash flows are unchanged.
+        The values of all cohorts are the holdings matrix multiplied by the latest prices, from which value, gain/loss,
+        percentages, APY and the accumulated value and gain/loss are updated in account_cohort_stats and account_year_stats.
+        Deposit columns are left as they are.
+
+        Parameters:
+        apy_mode (str): 'modified-dietz' or 'twrr'
+        dirty (dict): Only patch these accounts, from the first day of the given month on, see get_dirty_accounts.
+            None patches all stats.
+        """
+        import numpy as np
+        from return_engine import cohort_apy
+        if self._holdings is None:
+            self._holdings = self._read_holdings()
+        if self._holdings is None:
+            self._holdings = self._load_holdings()
+            self._write_holdings(self._holdings)
+        holdings = self._holdings
+        self.db.connect()
+        cur = self.db.get_cursor()
+        today = datetime.today().date()
+        n = len(holdings["months"])
+        if n == 0:
+            return
+        
+        # Price vector in the column order of the holdings matrix, assets without a price have no value
+        latest_prices = dict(cur.execute("SELECT asset_id, latest_price FROM assets WHERE latest_price IS NOT NULL").fetchall())
+        prices = np.array([latest_prices.get(asset_id, 0.0) for asset_id in holdings["asset_ids"]], dtype=np.float64)
+        
+        # Monthly stats
+        asset_value = np.bincount(holdings["rows"], weights=holdings["amounts"] * prices[holdings["columns"]], minlength=n)
+        value = holdings["capital"] + asset_value
+        columns = self._gainloss_columns(holdings["deposit"], holdings["withdrawal"], holdings["capital"],
+                                         holdings["transfer_net"], value)
+        total_gainloss, unrealized_gainloss = columns[0], columns[2]
+        account_ends = holdings["account_starts"][1:] + [n]
+        acc_value, acc_unrealized_gainloss, acc_total_gainloss = (
+            np.concatenate([np.cumsum(column[start:end]) for start, end in zip(holdings["account_starts"], account_ends)])
+            for column in (value, unrealized_gainloss, total_gainloss))
+        annual_per_yields = cohort_apy(
+            apy_mode, [month.replace(day=15) for month in holdings["months"]], holdings["deposit"], value, total_gainloss,
+            holdings["active_base"], holdings["closed_returns"], holdings["cf_offsets"], holdings["cf_dates"],
+            holdings["cf_amounts"], today)
+        
+        current_month = today.replace(day=1)
+        updates = []
+        for i, row in enumerate(zip(value.tolist(), *(column.tolist() for column in columns), annual_per_yields,
+                                    acc_value.tolist(), acc_unrealized_gainloss.tolist(), acc_total_gainloss.tolist())):
+            account, month = holdings["accounts"][i], holdings["months"][i]
+            if dirty is not None and (account not in dirty or month < dirty[account]):
+                continue
+            # The current month is stored with the date of the calculation, see calculate_cohort_stats
+            if month >= current_month:
+                updates.append((today,) + row + (account, current_month, month))
+            else:
+                updates.append((month,) + row + (account, month.replace(day=1), month))
+        cur.executemany("""
+            UPDATE account_cohort_stats
+            SET month = ?, value = ?, total_gainloss = ?, realized_gainloss = ?, unrealized_gainloss = ?,
+                total_gainloss_per = ?, realized_gainloss_per = ?, unrealized_gainloss_per = ?, annual_per_yield = ?,
+                acc_value = ?, acc_unrealized_gainloss = ?, acc_total_gainloss = ?
+            WHERE account = ? AND month >= ? AND month <= ?
+        """, updates)
+        
+        # Yearly stats, the accumulated columns are those of the last month of the year
+        starts = np.array(holdings["year_starts"], dtype=np.int64)
+        ends = np.append(starts[1:], n) - 1
+        year_asset_value = np.bincount(holdings["year_rows"], weights=holdings["year_amounts"] * prices[holdings["year_columns"]],
+                                       minlength=len(starts))
+        year_deposit, year_withdrawal, year_capital, year_active_base, year_transfer_net = (
+            np.add.reduceat(holdings[column], starts)
+            for column in ("deposit", "withdrawal", "capital", "active_base", "transfer_net"))
+        year_value = year_capital + year_asset_value
+        year_columns = self._gainloss_columns(year_deposit, year_withdrawal, year_capital, year_transfer_net, year_value)
+        year_cf_offsets = np.append(holdings["cf_offsets"][starts], holdings["cf_offsets"][-1])
+        year_annual_per_yields = cohort_apy(
+            apy_mode, [date(holdings["months"][start].year, 7, 1) for start in holdings["year_starts"]], year_deposit,
+            year_value, year_columns[0], year_active_base, holdings["year_closed_returns"], year_cf_offsets,
+            holdings["cf_dates"], holdings["cf_amounts"], today)
+        
+        updates = []
+        for i, row in enumerate(zip(year_value.tolist(), *(column.tolist() for column in year_columns), year_annual_per_yields,
+                                    acc_value[ends].tolist(), acc_unrealized_gainloss[ends].tolist(), acc_total_gainloss[ends].tolist())):
+            start = holdings["year_starts"][i]
+            account, year = holdings["accounts"][start], holdings["months"][start].year
+            if dirty is not None and (account not in dirty or year < dirty[account].year):
+                continue
+            updates.append(row + (account, f"{year:04d}-01-01"))
+        cur.executemany("""
+            UPDATE account_year_stats
+            SET value = ?, total_gainloss = ?, realized_gainloss = ?, unrealized_gainloss = ?,
+                total_gainloss_per = ?, realized_gainloss_per = ?, unrealized_gainloss_per = ?, annual_per_yield = ?,
+                acc_value = ?, acc_unrealized_gainloss = ?, acc_total_gainloss = ?
+            WHERE account = ? AND year = ?
+        """, updates)
+        
+        self.db.commit()
+        logging.info(f"Revalued stats of {len(dirty) if dirty is not None else len(holdings['account_starts'])} accounts")
+
+    def _clear_dirty(self):
+        """Clear the dirty cohorts and assets once the stats are up to date."""
+        self.db.connect()
+        cur = self.db.get_cursor()
+        cur.execute("DELETE FROM dirty_cohorts")
+        cur.execute("DELETE FROM dirty_assets")
+        self.db.commit()
 
     def get_stats(self, accounts=None, period: str = "month", deposits: str = "current", apy_mode: str = "modified-dietz") -> list:
         """
@@ -659,7 +883,6 @@ class StatCalculator:
         Returns:
         list: List of stats:     
         """
-        self._ensure_per_account_tables()
         self.db.connect()
         cur = self.db.get_cursor()
         
@@ -728,7 +951,7 @@ class StatCalculator:
             cur.execute(query, accounts)
             rows = cur.fetchall()
             
-            # Recalculate percentages and APY
+            # Recalculate percentages, the APY is added once all months are known
             stats = []
             today = datetime.today().date()
             
@@ -755,18 +978,18 @@ class StatCalculator:
                     month_date = datetime.strptime(month, "%Y-%m-%d").date()
                 else:
                     month_date = month
-
-                start_date = month_date.replace(day=15)
-                annual_per_yield = self._calc_apy_multi(
-                    apy_mode, accounts, value, deposit, total_gainloss,
-                    month, start_date, today, cur)
                 
                 stats.append((
                     month_date, deposit, withdrawal, value,
                     total_gainloss, realized_gainloss, unrealized_gainloss,
-                    total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
-                    annual_per_yield
+                    total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per
                 ))
+            
+            # The current month is stored with the date of the calculation, its cohorts with the last day of the month
+            annual_per_yields = self._merged_apys(
+                apy_mode, accounts, period, [row[0].replace(day=calendar.monthrange(row[0].year, row[0].month)[1]) for row in stats],
+                [row[1] for row in stats], [row[3] for row in stats], [row[4] for row in stats], today, cur)
+            stats = [row + (annual_per_yield,) for row, annual_per_yield in zip(stats, annual_per_yields)]
 
         else:  # period == "year"
             # Merge yearly stats
@@ -786,7 +1009,7 @@ class StatCalculator:
             cur.execute(query, accounts)
             rows = cur.fetchall()
             
-            # Recalculate percentages and APY
+            # Recalculate percentages, the APY is added once all years are known
             stats = []
             today = datetime.today().date()
             
@@ -816,17 +1039,16 @@ class StatCalculator:
                     realized_gainloss_per = 0.0
                     unrealized_gainloss_per = 0.0
                 
-                start_date = datetime(year=year, month=7, day=1).date()
-                annual_per_yield = self._calc_apy_year_multi(
-                    apy_mode, accounts, value, deposit, total_gainloss,
-                    str(year), start_date, today, cur)
-                
                 stats.append((
                     date(year, 1, 1), deposit, withdrawal, value,
                     total_gainloss, realized_gainloss, unrealized_gainloss,
-                    total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per,
-                    annual_per_yield
+                    total_gainloss_per, realized_gainloss_per, unrealized_gainloss_per
                 ))
+            
+            annual_per_yields = self._merged_apys(
+                apy_mode, accounts, period, [row[0] for row in stats],
+                [row[1] for row in stats], [row[3] for row in stats], [row[4] for row in stats], today, cur)
+            stats = [row + (annual_per_yield,) for row, annual_per_yield in zip(stats, annual_per_yields)]
         
         # Filter by deposits parameter
         if deposits == "current":
@@ -842,7 +1064,6 @@ class StatCalculator:
         Accumulated stats are returned as a list in the following order:
         month, deposit, value, gainloss
         """
-        self._ensure_per_account_tables()
         self.db.connect()
         cur = self.db.get_cursor()
         
@@ -1109,9 +1330,175 @@ class StatCalculator:
                 
             total = asset_value + cash
             summaries.append((account, cash, asset_value, total))
-            
+
         return summaries
 
+    def get_prices_as_of(self, as_of: date) -> dict:
+        """
+        Get the price of every asset as of a date from the asset_prices history,
+        i.e. the last price recorded on or before that date.
+
+        Parameters:
+        as_of (date): Valuation date.
+
+        Returns:
+        dict: asset_id -> price, for assets with a price on or before as_of.
+        """
+        self.db.connect()
+        cur = self.db.get_cursor()
+        rows = cur.execute("""
+            SELECT a.asset_id, (
+                SELECT p.price FROM asset_prices p
+                WHERE p.asset_id = a.asset_id AND p.date <= ?
+                ORDER BY p.date DESC, p.rowid DESC
+                LIMIT 1
+            )
+            FROM assets a
+        """, (as_of,)).fetchall()
+        return {asset_id: price for asset_id, price in rows if price is not None}
+
+    def get_holdings_as_of(self, dates: list) -> dict:
+        """
+        Rebuild the cash and holdings of every cohort as they were at the end of each date, by processing the
+        processed transactions again with a LotEngine that is never written to the database.
+        Processing starts from the latest checkpoint covering the first date, or from the first transaction
+        if there is none. Rows are taken from the scheduler one at a time, so the state of a date is copied
+        once every transaction on or before it, including the retried ones, has been handled.
+        Asset ids are assigned in processing order as in the database, so the holdings can be valued with asset_prices.
+
+        Parameters:
+        dates (list): Dates to rebuild the holdings for.
+
+        Returns:
+        dict: date -> (cash, holdings), with cash as {(month, account): capital}
+            and holdings as {(month, asset_id, account): amount} for lots with more than 0.001.
+        """
+        # Imported here since they are only needed for valuations as of a date
+        from data_parser import DataParser
+        from lot_engine import LotEngine, CAPITAL, AMOUNT
+
+        dates = sorted(set(dates))
+        if not dates:
+            return {}
+        self.db.connect()
+        cur = self.db.get_cursor()
+        # No checkpoints are saved by the engine
+        engine = LotEngine(DataParser(self.db, max_checkpoints=0))
+        # A checkpoint holds the state before its month, the end of as_of is the start of the next day
+        checkpoint = cur.execute("SELECT checkpoint_id, date FROM checkpoints WHERE date <= ? ORDER BY date DESC LIMIT 1",
+                                 (dates[0] + timedelta(days=1),)).fetchone()
+        conditions = ["processed = 1", "date <= ?"]
+        params = [dates[-1]]
+        if checkpoint is not None:
+            engine.load(checkpoint[0])
+            conditions.append("date >= ?")
+            params.append(checkpoint[1])
+        rows = cur.execute(f"SELECT *, rowid FROM transactions WHERE {' AND '.join(conditions)} ORDER BY date ASC, rowid ASC", params).fetchall()
+
+        snapshots = {}
+        pending = iter(dates)
+        next_date = next(pending)
+
+        def snapshot(as_of):
+            snapshots[as_of] = ({key: cohort[CAPITAL] for key, cohort in engine.cohorts.items()},
+                                {key: lot[AMOUNT] for key, lot in engine.lots.items() if lot[AMOUNT] > 0.001})
+
+        def feed():
+            nonlocal next_date
+            for row in rows:
+                while next_date is not None and row[0] > next_date:
+                    snapshot(next_date)
+                    next_date = next(pending, None)
+                yield row
+
+        engine.run(feed())
+        while next_date is not None:
+            snapshot(next_date)
+            next_date = next(pending, None)
+        return snapshots
+
+    @staticmethod
+    def _value_holdings(cash: dict, holdings: dict, prices: dict, accounts=None, cohort_month: date = None) -> tuple:
+        """
+        Value cash and holdings from get_holdings_as_of with prices, leaving out holdings without a price.
+
+        Returns:
+        tuple: (cash, asset_value, total_value)
+        """
+        def included(month, account):
+            return (accounts is None or account in accounts) and (cohort_month is None or month == cohort_month)
+
+        cash_value = sum(capital for (month, account), capital in cash.items() if included(month, account))
+        asset_value = sum(amount * prices[asset_id] for (month, asset_id, account), amount in holdings.items()
+                          if asset_id in prices and included(month, account))
+        return (cash_value, asset_value, cash_value + asset_value)
+
+    def get_value_as_of(self, as_of: date, accounts=None, cohort_month: date = None) -> tuple:
+        """
+        Get the value of accounts, or of a single cohort, as of a date.
+        The cash and holdings as they were on as_of, from get_holdings_as_of, are valued
+        with the prices from get_prices_as_of. Holdings without a price on or before as_of are not counted.
+
+        Parameters:
+        as_of (date): Valuation date.
+        accounts (list or None): List of account strings to include, or None for all.
+        cohort_month (date or None): Only value this cohort, or None for all cohorts.
+
+        Returns:
+        tuple: (cash, asset_value, total_value)
+        """
+        cash, holdings = self.get_holdings_as_of([as_of])[as_of]
+        return self._value_holdings(cash, holdings, self.get_prices_as_of(as_of), accounts, cohort_month)
+
+    def get_month_end_values(self, start: date, end: date, accounts=None) -> list:
+        """
+        Get a month-end valuation series between two dates, valued like get_value_as_of.
+        The holdings of all month ends are rebuilt by one get_holdings_as_of run, and the price history
+        is read with one range query and walked forward month by month instead of looking up the prices
+        of every month separately.
+
+        Parameters:
+        start (date): Any date in the first month of the series.
+        end (date): Any date in the last month of the series.
+        accounts (list or None): List of account strings to include, or None for all.
+
+        Returns:
+        list: List of tuples: (month_end, cash, asset_value, total_value)
+        """
+        month_ends = []
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            month_ends.append(date(year, month, calendar.monthrange(year, month)[1]))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        if not month_ends:
+            return []
+
+        snapshots = self.get_holdings_as_of(month_ends)
+        cur = self.db.get_cursor()
+
+        # Price history up to the last month end in date order per asset
+        price_history = {}
+        for asset_id, price_date, price in cur.execute("""
+            SELECT asset_id, date, price FROM asset_prices
+            WHERE date <= ?
+            ORDER BY asset_id, date, rowid
+        """, (month_ends[-1],)):
+            price_history.setdefault(asset_id, []).append((price_date, price))
+
+        series = []
+        prices = {}
+        next_price = {asset_id: 0 for asset_id in price_history}
+        for month_end in month_ends:
+            for asset_id, history in price_history.items():
+                j = next_price[asset_id]
+                while j < len(history) and history[j][0] <= month_end:
+                    prices[asset_id] = history[j][1]
+                    j += 1
+                next_price[asset_id] = j
+            cash, holdings = snapshots[month_end]
+            series.append((month_end, *self._value_holdings(cash, holdings, prices, accounts)))
+        return series
+
     def print_account_summary(self, accounts=None):
         """
         Print account summaries in table format.
@@ -1159,13 +1546,14 @@ class StatCalculator:
                     display_name = get_display_name(account)
                     print(f"  {display_name}: {percentage:.1f}%")
 
-    def update_prices(self, force: bool = False):
+    def update_prices(self, force: bool = False, fetcher: 'PriceFetcher' = None):
         """
-        Update prices in database. Prices are fetched from external site. 
+        Update prices in database. Prices are fetched from external site concurrently and written in one batch.
         Prices are only updated if they are older than 1 day, unless force is True.
 
         Parameters:
         force (bool): If True, update prices even if they are already up to date.
+        fetcher (PriceFetcher): Fetcher to use, for example with another url or rate limit. Defaults to PriceFetcher().
         """
         self.db.connect()
         cur = self.db.get_cursor()
@@ -1199,45 +1587,15 @@ class StatCalculator:
 
         assets = cur.execute("SELECT asset,asset_id FROM assets WHERE amount > 0").fetchall()
         
-        # Current working endpoint (discovered 2026-02-27)
-        url = "https://www.avanza.se/_api/search/filtered-search"
-        headers = {
-            "User-Agent": (
-                "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
-            ),
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-
-        for (asset,asset_id) in assets:
-            r = requests.post(url, headers=headers, json={"query": asset, "limit": 5}, timeout=10)
-
-            if r.status_code == 200:
-                resp = r.json()
-                # Check if we have hits and price data
-                if "hits" in resp and len(resp["hits"]) > 0:
-                    hit = resp["hits"][0]
-                    if "price" in hit and hit["price"] and "last" in hit["price"]:
-                        price_str = hit["price"]["last"]
-                        # Strip non-breaking spaces used as thousands separator, spaces, replace comma with dot
-                        raw_price = price_str.replace("\u00a0", "").replace(" ", "").replace(",", ".")
-                        try:
-                            price = float(raw_price)
-                            cur.execute("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?",
-                                        (price, today, asset_id))
-                        except ValueError:
-                            logging.warning(f"Could not parse price '{price_str}' for asset {asset}")
-                    else:
-                        logging.warning(f"No price field in response for asset {asset}")
-                else:
-                    logging.warning(f"No hits in response for asset {asset}")
-            else:
-                logging.warning(f"HTTP {r.status_code} for asset {asset}")
-            
-            # Be polite to the API
-            time.sleep(0.05)
-
+        if fetcher is None:
+            from price_fetcher import PriceFetcher
+            fetcher = PriceFetcher()
+        prices = fetcher.fetch_prices(assets)
+        
+        cur.executemany("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?",
+                        [(price, today, asset_id) for asset_id, price in prices.items()])
+        cur.executemany("INSERT INTO asset_prices(asset_id, date, price, source) VALUES (?,?,?,'update_prices')",
+                        [(asset_id, today, price) for asset_id, price in prices.items()])
         self.db.commit()
 
 if __name__ == "__main__":
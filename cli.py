@@ -8,22 +8,22 @@ price updates, and statistics calculation.
 
 import argparse
 import sys
+import time
 import logging
 from datetime import datetime, timedelta
 
-from database_handler import DatabaseHandler
-from data_parser import DataParser, SpecialCases
-from calculate_stats import StatCalculator
+from database_handler import DatabaseHandler, CONNECTION_PROFILES
+
+# data_parser and calculate_stats are imported by the commands that use them, so that
+# status and settings start without loading numpy and requests
 
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 
 def get_db(args):
-    """Get database handler with connection."""
-    db = DatabaseHandler(args.database)
-    db.connect()
-    return db
+    """Get database handler, its connection is kept open for the whole command."""
+    return DatabaseHandler(args.database, profile=args.db_profile)
 
 
 def prices_are_fresh(db, max_age_days=1):
@@ -72,6 +72,7 @@ def stats_need_recalculation(db):
     1. Never calculated before
     2. Transactions processed since last calculation
     3. Prices updated since last calculation
+    4. Cohorts or asset prices changed since last calculation (dirty tracking)
     """
     last_stats = db.get_metadata('last_stats_calculation')
     last_processed = db.get_metadata('last_processed')
@@ -79,12 +80,16 @@ def stats_need_recalculation(db):
     if not last_stats:
         return True  # Never calculated
     
+    # Check if cohorts or prices changed since last calculation
+    cur = db.get_cursor()
+    if cur.execute("SELECT EXISTS(SELECT 1 FROM dirty_cohorts) OR EXISTS(SELECT 1 FROM dirty_assets)").fetchone()[0]:
+        return True
+    
     # Check if transactions processed since last calculation
     if last_processed and last_processed > last_stats:
         return True
     
     # Check if prices updated since last calculation
-    cur = db.get_cursor()
     result = cur.execute(
         "SELECT MAX(latest_price_date) FROM assets WHERE latest_price_date IS NOT NULL"
     ).fetchone()
@@ -99,26 +104,41 @@ def stats_need_recalculation(db):
 
 def import_data(args):
     """Import CSV data and process transactions."""
+    from data_parser import DataParser, SpecialCases, AssetDeficit
     db = get_db(args)
     special_cases = SpecialCases(args.special_cases) if args.special_cases else None
-    data_parser = DataParser(db, special_cases)
+    profiler = None
+    if args.profile or args.profile_json:
+        from profiler import ProcessingProfiler
+        profiler = ProcessingProfiler()
+    data_parser = DataParser(db, special_cases, profiler=profiler)
     
     try:
         # Import data
+        start = time.perf_counter()
         rows_added = data_parser.add_data(args.file)
-        logging.info(f"Added {rows_added} rows to the database")
-        
-        # Process transactions
-        data_parser.process_transactions()
-        logging.info("Transactions processed")
-        
-        # Update metadata
-        now = datetime.now().isoformat()
-        db.set_metadata('last_import', now)
-        db.set_metadata('last_processed', now)
+        elapsed = time.perf_counter() - start
+        rate = data_parser.rows_read / elapsed if elapsed > 0 else 0
+        logging.info(f"Added {rows_added} rows to the database ({data_parser.rows_read} rows read in {elapsed:.2f}s, {rate:.0f} rows/sec)")
         
-        # Clear stats timestamp since we have new data
-        db.set_metadata('last_stats_calculation', '')
+        # Process transactions and update metadata in one transaction
+        deficit = None
+        with db.bulk():
+            try:
+                data_parser.process_transactions(in_memory=(args.engine == 'memory'))
+                logging.info("Transactions processed")
+            except AssetDeficit as e:
+                # The transactions before processed_until are kept, the bulk block would roll them back if the exception left it
+                if e.processed_until is None:
+                    raise
+                deficit = e
+            
+            # Update metadata
+            now = datetime.now().isoformat()
+            db.set_metadata('last_import', now)
+            db.set_metadata('last_processed', now)
+        if deficit is not None:
+            raise deficit
         
         logging.info("Import completed")
         return 0
@@ -127,6 +147,14 @@ def import_data(args):
         logging.error(f"Import failed: {e}")
         return 1
 
+    finally:
+        # Also shown when processing failed, to see where it spent its time
+        if profiler is not None and profiler.runs:
+            print("\nProcessing profile:")
+            print(profiler.summary())
+            if args.profile_json:
+                profiler.dump(args.profile_json)
+
 
 
 
@@ -139,6 +167,7 @@ def import_data(args):
 
 def stats(args):
     """Smart statistics command with automatic updates."""
+    from calculate_stats import StatCalculator
     db = get_db(args)
     
     # Parse account filter
@@ -172,9 +201,6 @@ def stats(args):
             now = datetime.now().isoformat()
             db.set_metadata('last_price_update', now)
             
-            # Clear stats timestamp since prices changed
-            db.set_metadata('last_stats_calculation', '')
-            
             logging.info("Prices updated successfully")
         except Exception as e:
             logging.error(f"Failed to update prices: {e}")
@@ -198,9 +224,6 @@ def stats(args):
                 now = datetime.now().isoformat()
                 db.set_metadata('last_price_update', now)
                 
-                # Clear stats timestamp since prices changed
-                db.set_metadata('last_stats_calculation', '')
-                
                 logging.info("Prices updated successfully")
             except Exception as e:
                 logging.error(f"Failed to update prices: {e}")
@@ -211,16 +234,25 @@ def stats(args):
     # Force recalculation if APY mode changed
     last_apy_mode = db.get_metadata('last_apy_mode') or 'modified-dietz'
     apy_mode_changed = (apy_mode != last_apy_mode)
-    if args.force or apy_mode_changed or stats_need_recalculation(db):
+    # Only the dirty accounts are recalculated, unless the stored stats are from an earlier month.
+    # The current month is stored with the date of the calculation.
+    last_stats = db.get_metadata('last_stats_calculation')
+    full_recalculation = (args.force or apy_mode_changed or not last_stats
+                          or last_stats[:7] != datetime.now().isoformat()[:7])
+    if full_recalculation or stats_need_recalculation(db):
         try:
             stat_calc = StatCalculator(db)
-            stat_calc.calculate_cohort_stats(apy_mode=apy_mode)
-            stat_calc.calculate_year_stats(apy_mode=apy_mode)
-            
-            # Update metadata
-            now = datetime.now().isoformat()
-            db.set_metadata('last_stats_calculation', now)
-            db.set_metadata('last_apy_mode', apy_mode)
+            with db.bulk():
+                if full_recalculation:
+                    stat_calc.calculate_stats(apy_mode=apy_mode)
+                else:
+                    dirty = stat_calc.update_stats(apy_mode=apy_mode)
+                    logging.info(f"Recalculated statistics for {len(dirty)} account(s)")
+                
+                # Update metadata
+                now = datetime.now().isoformat()
+                db.set_metadata('last_stats_calculation', now)
+                db.set_metadata('last_apy_mode', apy_mode)
             
             logging.info("Statistics calculated")
         except Exception as e:
@@ -294,16 +326,18 @@ def status(args):
 
 def reset(args):
     """Reset database state."""
+    from data_parser import DataParser, SpecialCases
     db = get_db(args)
     special_cases = SpecialCases(args.special_cases) if args.special_cases else None
     data_parser = DataParser(db, special_cases)
     
     try:
-        data_parser.reset_processed_transactions()
-        
-        # Clear metadata
-        for key in ['last_processed', 'last_stats_calculation']:
-            db.set_metadata(key, '')
+        with db.bulk():
+            data_parser.reset_processed_transactions()
+            
+            # Clear metadata
+            for key in ['last_processed', 'last_stats_calculation']:
+                db.set_metadata(key, '')
         
         logging.info("Database reset successfully")
         return 0
@@ -383,6 +417,7 @@ def settings_account_nickname(args):
 
 def accounts_summary(args):
     """Show account summaries with asset values and cash."""
+    from calculate_stats import StatCalculator
     db = get_db(args)
     
     # Parse account filter (same logic as stats)
@@ -462,6 +497,8 @@ def main():
         epilog="""
 Examples:
   %(prog)s import transactions.csv
+  %(prog)s --db-profile bulk import transactions.csv
+  %(prog)s import transactions.csv --profile
   %(prog)s stats --update-prices auto
   %(prog)s status
         """
@@ -477,12 +514,34 @@ Examples:
         default='data/special_cases.json',
         help='Path to special cases JSON file (default: data/special_cases.json)'
     )
+    parser.add_argument(
+        '--db-profile',
+        choices=list(CONNECTION_PROFILES),
+        default='safe',
+        help='SQLite connection profile: "bulk" uses WAL, synchronous=NORMAL and a larger cache for imports and resets (default: safe)'
+    )
     
     subparsers = parser.add_subparsers(dest='command', help='Command to execute')
     
     # Import command
     import_parser = subparsers.add_parser('import', help='Import CSV data and process transactions')
     import_parser.add_argument('file', help='Path to CSV file')
+    import_parser.add_argument(
+        '--engine',
+        choices=['memory', 'sql'],
+        default='memory',
+        help='Transaction processing engine: in-memory FIFO lots written back in bulk, or SQL per lot (default: memory)'
+    )
+    import_parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print handler timings, SQL statement counts, lot walk lengths and deferrals after processing'
+    )
+    import_parser.add_argument(
+        '--profile-json',
+        metavar='PATH',
+        help='Write the processing profile to a JSON file (implies --profile)'
+    )
     import_parser.set_defaults(func=import_data)
     
     # Stats command
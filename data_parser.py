@@ -4,10 +4,13 @@ import logging
 import csv
 import operator
 import json
+import heapq
 
+from contextlib import contextmanager, nullcontext
 from datetime import date, datetime
 from functools import reduce
-from database_handler import DatabaseHandler
+from itertools import islice
+from database_handler import DatabaseHandler, CHECKPOINT_TABLES, DIRTY_COHORT_TABLES, transaction_key
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,20 +18,30 @@ class AssetDeficit(Exception):
     """
     Exception that is raised when there is a mismatch between the amount of assets in the database and the amount of assets in the transactions
     """
-    def __init__(self, message, data_parser: 'DataParser') -> None:
+    def __init__(self, message, data_parser: 'DataParser', unprocessed_rows: list = None, processed_until: date = None) -> None:
         """
         Parameters:
         message (str): The error message to be displayed.
         data_parser (DataParser): The DataParser instance where the error occurred.
+        unprocessed_rows (list, optional): Rows that could not be processed. If None, they are read from the database.
+        processed_until (date, optional): If given, the transactions before this date were processed and committed
+            and the database is not rolled back.
         """
         super().__init__(message)
         self.data_parser = data_parser
+        self.processed_until = processed_until
         logging.error(message)
-        data_parser.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        if unprocessed_rows is None:
+            data_parser.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            unprocessed_rows = data_parser.transaction_cur.fetchall()
         logging.error("Unprocessed transactions:")
-        for row in data_parser.transaction_cur.fetchall():
+        for row in unprocessed_rows:
             logging.error(row)
+        if processed_until is not None:
+            logging.error("Transactions before {} were processed, later transactions are left unprocessed".format(processed_until))
+            return
         data_parser.db.conn.rollback()
+        data_parser._asset_ids = None
 
 class SpecialCases:
     """
@@ -73,8 +86,13 @@ class SpecialCases:
         # and a list of functions that replace a row with a new row
         special_conditions = []
         special_replacements = []
-        for case in special_cases:
+        # (column index, value) -> positions of the cases with that equality condition, in file order
+        # Each case is indexed by its first equality condition, cases without one are candidates for every row
+        self._index = {}
+        self._unindexed = []
+        for position, case in enumerate(special_cases):
             conditions = []
+            key = None
             for condition in case["condition"]:
                 index = condition["index"]
                 value = condition["value"]
@@ -82,10 +100,16 @@ class SpecialCases:
                 if index == 0:
                     value = datetime.strptime(value, "%Y-%m-%d").date()
                 op_func = ops.get(condition.get("operator", "=="))  # default to "=="
+                if key is None and op_func is operator.eq:
+                    key = (index, value)
                 # Create a function that checks if a row matches a condition
                 # Default values are used to avoid late binding
                 conditions.append(lambda x, index=index, op_func=op_func, value=value: op_func(x[index], value))
             special_conditions.append(lambda x, conditions=conditions: all(condition(x) for condition in conditions))
+            if key is None:
+                self._unindexed.append(position)
+            else:
+                self._index.setdefault(key, []).append(position)
             replacements = []
             for replacement in case["replacement"]:
                 index = replacement["index"]
@@ -102,11 +126,25 @@ class SpecialCases:
 
         # Combine special_conditions and special_replacements into a single list
         self.special_cases = list(zip(special_conditions, special_replacements))
+        self._indexed_columns = sorted({index for index, _ in self._index})
+
+    def _candidates(self, row: list, after: int = -1) -> list:
+        """
+        Returns:
+        list: Positions of the special cases that can match the row, in file order, only the ones after the given position.
+        """
+        candidates = [position for position in self._unindexed if position > after]
+        for index in self._indexed_columns:
+            if index < len(row):
+                candidates.extend(position for position in self._index.get((index, row[index]), ()) if position > after)
+        return sorted(candidates)
 
     #Check if a row matches a special case
     def handle_special_cases(self, row: list):
         """
         Takes a row from the csv file as a list and does replacements if the row matches a special case.
+        Only the cases whose indexed equality condition matches the row are checked, in the order of the file.
+        A replacement can make the row match later cases, so the candidates are looked up again after each replacement.
 
         Parameters:
         row (list): A row from the csv file.
@@ -114,29 +152,146 @@ class SpecialCases:
         Returns:
         list: The same row after replacements have been made.
         """
-        for i in range(len(self.special_cases)):
+        candidates = self._candidates(row)
+        i = 0
+        while i < len(candidates):
+            position = candidates[i]
+            i += 1
             #Special conditions are functions that check if a row matches a special case
             #They are stored in the first element of the special_cases list
-            if self.special_cases[i][0](row):
+            if self.special_cases[position][0](row):
                 #Special replacements are functions that replace a row with a new row
                 #They are stored in the second element of the special_cases list
-                row = self.special_cases[i][1](row)
+                row = self.special_cases[position][1](row)
+                candidates = self._candidates(row, position)
+                i = 0
         return row
 
+class TransactionScheduler:
+    """
+    Feeds unprocessed transactions to the handle_* methods in date order, reading each row only once.
+    Rows that cannot be processed yet are kept in a pending queue keyed by the resource they are waiting for,
+    ("capital", account) or ("asset", account, asset), and are retried in their original order as soon as
+    a processed transaction releases that resource.
+    When the month of the next row differs from the previous one and no dispatched row is waiting,
+    the processing state covers exactly the transactions before that month and handler.checkpoint is called.
+    Rows that are processed stay processed, so rows that can not be processed are all dated after the latest such month.
+    """
+    def __init__(self, data_parser: 'DataParser'):
+        """
+        Parameters:
+        data_parser (DataParser): The DataParser used to dispatch rows to the handlers.
+        """
+        self.data_parser = data_parser
+        self.processed = set()
+        self._rows = iter(())
+        # rowid -> (position, row) for dispatched rows that are not processed yet
+        self._unprocessed = {}
+        # resource key -> list of (position, row) waiting for that resource
+        self._pending = {}
+        # Heap of (position, row) that have been released and should be retried
+        self._ready = []
+        # First days of the months at which no dispatched row was waiting, in order
+        self.boundaries = []
+
+    def run(self, handler, rows) -> list:
+        """
+        Dispatches rows to handler. After each row, the rows released by it are retried before continuing.
+
+        Parameters:
+        handler (DataParser or LotEngine): Object implementing the handle_* methods.
+        rows (iterable): Unprocessed rows from the transactions table ordered by date and rowid, with rowid as the last element.
+
+        Returns:
+        list: Rows that could not be processed.
+        """
+        self._rows = iter(rows)
+        month = None
+        for position, row in enumerate(self._rows):
+            if row[0].replace(day=1) != month:
+                month = row[0].replace(day=1)
+                if not self._unprocessed:
+                    self.boundaries.append(month)
+                    handler.checkpoint(month)
+            self._dispatch(handler, position, row)
+            while self._ready:
+                position, row = heapq.heappop(self._ready)
+                if row[-1] not in self.processed:
+                    if self.data_parser.profiler is not None:
+                        self.data_parser.profiler.retries += 1
+                    self._dispatch(handler, position, row)
+        return self.unprocessed_rows()
+
+    def _dispatch(self, handler, position: int, row: tuple) -> None:
+        self._unprocessed[row[-1]] = (position, row)
+        self.data_parser.dispatch(handler, row)
+
+    def unprocessed_rows(self) -> list:
+        """
+        Returns:
+        list: Rows that have not been processed, including rows that have not been dispatched yet.
+        """
+        return [row for (_, row) in sorted(self._unprocessed.values(), key=operator.itemgetter(0))] + list(self._rows)
+
+    def mark_processed(self, *rowids) -> None:
+        """
+        Marks transactions as processed.
+        """
+        self.processed.update(rowids)
+        for rowid in rowids:
+            self._unprocessed.pop(rowid, None)
+
+    def defer(self, key: tuple, *rows) -> None:
+        """
+        Puts rows in the pending queue until key is released.
+
+        Parameters:
+        key (tuple): The resource the rows are waiting for, ("capital", account) or ("asset", account, asset).
+        rows (tuple): The rows that could not be processed.
+        """
+        self._pending.setdefault(key, []).extend(self._unprocessed[row[-1]] for row in rows)
+        if self.data_parser.profiler is not None:
+            self.data_parser.profiler.deferrals += len(rows)
+
+    def release(self, key: tuple) -> None:
+        """
+        Schedules the rows waiting for key for a retry.
+
+        Parameters:
+        key (tuple): The resource that has become available.
+        """
+        for item in self._pending.pop(key, ()):
+            heapq.heappush(self._ready, item)
+
 class DataParser:
     """
     DataParser class handles the processing of transactions in the database.
     """
-    def __init__(self, db: DatabaseHandler, special_cases: SpecialCases = None):
+    def __init__(self, db: DatabaseHandler, special_cases: SpecialCases = None, max_checkpoints: int = 24, profiler: 'ProcessingProfiler' = None):
         """
         Parameters:
         database (DatabaseHandler): The database to add data to.
         special_cases (SpecialCases): SpecialCases object that handles special rules when adding data to the database.
+        max_checkpoints (int): Number of monthly checkpoints to keep, covering the latest months of the transactions. 0 disables checkpoints.
+        profiler (ProcessingProfiler): Records handler timings and counters of process_transactions if given.
         """
         self.listing_change = {"to_asset":None,"to_asset_amount":None,"to_rowid":None}
-        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None}
+        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+        self.scheduler = TransactionScheduler(self)
         self.db = db
         self.special_cases = special_cases
+        self.profiler = profiler
+        self.rows_read = 0
+        self.max_checkpoints = max_checkpoints
+        # Set by _prepare_checkpoints before each processing run
+        self._last_processed = None
+        self._checkpoint_from = None
+        # True while the SQL processing run has a savepoint at the latest month boundary
+        self._savepoint = False
+        # Set by process_transactions, False for a run from the first transaction, which marks all cohorts dirty at the end
+        self._track_dirty = False
+        # Asset name -> asset_id of the assets table, loaded when first needed and cleared whenever the table may have changed
+        self._asset_ids = None
         # Two cursors are used, one for handling writing processed lines and one responsible for keeping track of unprocessed lines
         self._data_cur = None
         self._transaction_cur = None
@@ -178,86 +333,120 @@ class DataParser:
         """
         return 0.0 if number_string in ("-", "") else float(number_string.replace(",","."))
     
-    def add_data(self, file_path: str) -> int:
+    def read_data(self, file_path: str):
         """
-        Takes a path to a csv file downloaded from Avanza and adds the data to the database.
+        Generator that reads a csv file downloaded from Avanza one row at a time.
+        Rows are converted to transactions table rows, special cases are applied and the natural key is appended.
+
+        Identical transactions are numbered by their occurrence within the same date. Avanza exports are grouped by date,
+        so only the occurrence counts of the current date are kept in memory.
 
         Parameters:
         file_path (str): Path to csv file downloaded from Avanza.
 
-        Returns:
-        int: Number of rows added to the database.
+        Yields:
+        tuple: date, account, transaction_type, asset_name, amount, price, total, courtage, currency, isin, natural_key
         """
-        # file_path = ./data/newdata.csv
         with open(file_path, "r") as avanza_data_file:
             avanza_data = csv.reader(avanza_data_file, delimiter=';')
             # Detect CSV format version from header row
             avanza_header_row = next(avanza_data)
             new_format = "Transaktionsvaluta" in avanza_header_row
-            avanza_data = list(avanza_data)
 
-        # Find overlapping transactions to avoid adding douplicates
-        max_date = max([datetime.strptime(row[0],"%Y-%m-%d") for row in avanza_data]).date()
-        min_date = min([datetime.strptime(row[0],"%Y-%m-%d") for row in avanza_data]).date()
-        logging.debug("Date range of transactions to be added: {} - {}".format(min_date,max_date))
+            # Number of times each transaction has been seen on current_date, so that identical transactions get different keys
+            occurrences = {}
+            current_date = None
+            seen_dates = set()
+            for transaction in avanza_data:
+                if new_format:
+                    # New format: Datum;Konto;Typ;Värdepapper;Antal;Kurs;Belopp;Transaktionsvaluta;Courtage;Valutakurs;Instrumentvaluta;ISIN;Resultat
+                    row = (\
+                        date.fromisoformat(transaction[0]),\
+                        transaction[1],transaction[2],transaction[3],\
+                        self.convert_number(transaction[4]),self.convert_number(transaction[5]),\
+                        self.convert_number(transaction[6]),self.convert_number(transaction[8]),\
+                        transaction[7],transaction[11]
+                        )
+                else:
+                    # Old format: Datum;Konto;Typ;Värdepapper;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat
+                    row = (\
+                        date.fromisoformat(transaction[0]),\
+                        transaction[1],transaction[2],transaction[3],\
+                        self.convert_number(transaction[4]),self.convert_number(transaction[5]),\
+                        self.convert_number(transaction[6]),self.convert_number(transaction[7]),\
+                        transaction[8],transaction[9]
+                        )
+                # If special_cases is not None, handle special cases
+                if self.special_cases != None:
+                    row = self.special_cases.handle_special_cases(row)
+
+                if row[0] != current_date:
+                    if row[0] in seen_dates:
+                        logging.warning("Transactions dated {} are not grouped together in {}, identical transactions on that date may be skipped".format(row[0], file_path))
+                    seen_dates.add(row[0])
+                    current_date = row[0]
+                    occurrences = {}
+                natural_key = transaction_key(row)
+                occurrence = occurrences.get(natural_key, 0)
+                occurrences[natural_key] = occurrence + 1
+                if occurrence > 0:
+                    natural_key = transaction_key(row, occurrence)
+                yield row + (natural_key,)
+
+    def add_data(self, file_path: str, batch_size: int = 1000) -> int:
+        """
+        Takes a path to a csv file downloaded from Avanza and adds the data to the database.
+        The file is streamed with read_data and inserted in batches of batch_size rows within a single transaction.
+        Transactions already in the database have the same natural key and are ignored by its unique index.
+
+        Parameters:
+        file_path (str): Path to csv file downloaded from Avanza.
+        batch_size (int): Number of rows per executemany call.
 
-        # Variable to keep track of number of rows added to the database
-        rows_added = 0
+        Returns:
+        int: Number of rows added to the database.
+        """
+        # Number of rows read from the file, used to report the import rate
+        self.rows_read = 0
 
         # Connect to database
         self.db.connect()
         cur = self.db.conn.cursor()
-        existing_rows = cur.execute("SELECT date, account, transaction_type, asset_name, amount, price FROM transactions WHERE date >= ? and date <= ?",(min_date,max_date)).fetchall()
-
-        #Add transactions to database
-        for transaction in avanza_data:
-            if new_format:
-                # New format: Datum;Konto;Typ;Värdepapper;Antal;Kurs;Belopp;Transaktionsvaluta;Courtage;Valutakurs;Instrumentvaluta;ISIN;Resultat
-                row = (\
-                    datetime.strptime(transaction[0], "%Y-%m-%d").date(),\
-                    transaction[1],transaction[2],transaction[3],\
-                    self.convert_number(transaction[4]),self.convert_number(transaction[5]),\
-                    self.convert_number(transaction[6]),self.convert_number(transaction[8]),\
-                    transaction[7],transaction[11]
-                    )
-            else:
-                # Old format: Datum;Konto;Typ;Värdepapper;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat
-                row = (\
-                    datetime.strptime(transaction[0], "%Y-%m-%d").date(),\
-                    transaction[1],transaction[2],transaction[3],\
-                    self.convert_number(transaction[4]),self.convert_number(transaction[5]),\
-                    self.convert_number(transaction[6]),self.convert_number(transaction[7]),\
-                    transaction[8],transaction[9]
-                    )
-            # If special_cases is not None, handle special cases
-            if self.special_cases != None:
-                row = self.special_cases.handle_special_cases(row)
-            # If row is not in existing_rows, add it to the database
-            if row[0:6] not in existing_rows:
-                logging.debug("Adding row to database: {}".format(row))
-                cur.execute('INSERT INTO transactions(date, account, transaction_type,asset_name,amount,price,total,courtage,currency,isin) VALUES(?,?,?,?,?,?,?,?,?,?);',row)
-                rows_added += 1
-            else:
-                logging.debug("Row already in database: {}".format(row))
-
-        # Commit changes to database and disconnect
-        self.db.conn.commit()
-        self.db.disconnect()
+        changes_before = self.db.conn.total_changes
+
+        rows = self.read_data(file_path)
+        try:
+            for batch in iter(lambda: list(islice(rows, batch_size)), []):
+                cur.executemany('INSERT OR IGNORE INTO transactions(date, account, transaction_type,asset_name,amount,price,total,courtage,currency,isin,natural_key) VALUES(?,?,?,?,?,?,?,?,?,?,?);',batch)
+                self.rows_read += len(batch)
+        except Exception:
+            self.db.conn.rollback()
+            raise
+        rows_added = self.db.conn.total_changes - changes_before
+
+        # Commit changes to database
+        self.db.commit()
 
         # Return number of rows added to the database
-        logging.info("Added {} rows to the database".format(rows_added))
+        logging.info("Added {} of {} rows to the database".format(rows_added, self.rows_read))
         return rows_added
     
     def reset_processed_transactions(self) -> None:
         """
-        Resets the processed flag for all transactions in the database. Also resets cohort_data, cohort_assets, assets and cohort_cash_flows tables.
+        Resets the processed flag for all transactions in the database. Also resets cohort_data, cohort_assets, assets, asset_prices and cohort_cash_flows tables
+        and removes all checkpoints. The removed cohorts are marked dirty.
+        asset_prices is reset since asset ids are reassigned when the transactions are processed again.
         """
+        self._mark_dirty()
         self.data_cur.execute("UPDATE transactions SET processed = 0")
         self.db.reset_table("cohort_data")
         self.db.reset_table("cohort_assets")
+        self.db.reset_table("asset_prices")
         self.db.reset_table("assets")
         self.db.reset_table("cohort_cash_flows")
+        self._delete_checkpoints()
         self.db.commit()
+        self._asset_ids = None
 
     def allocate_to_month(self, transaction_date: date) -> date:
         """
@@ -285,6 +474,57 @@ class DataParser:
         day = calendar.monthrange(year,month)[1]
         return date(year,month,day)
 
+    def _load_asset_ids(self) -> dict:
+        """
+        Returns:
+        dict: Asset name -> asset_id for all assets in the assets table. The mapping is read once and kept up to date by the handlers.
+        """
+        if self._asset_ids is None:
+            self._asset_ids = dict(self.data_cur.execute("SELECT asset, asset_id FROM assets").fetchall())
+        return self._asset_ids
+
+    def _asset_id(self, asset: str) -> int:
+        """
+        Equivalent of INSERT OR IGNORE INTO assets (asset) followed by SELECT asset_id, but known assets are resolved without SQL statements.
+
+        Parameters:
+        asset (str): Name of the asset.
+
+        Returns:
+        int: The asset_id of the asset, which is added to the assets table if it is new.
+        """
+        asset_ids = self._load_asset_ids()
+        asset_id = asset_ids.get(asset)
+        if asset_id is None:
+            self.data_cur.execute("INSERT INTO assets (asset) VALUES (?)", (asset,))
+            asset_id = self.data_cur.lastrowid
+            asset_ids[asset] = asset_id
+        return asset_id
+
+    def set_latest_price(self, asset_id: int, price: float, date: date) -> None:
+        """
+        Sets the latest price of an asset. The price is added to the asset_prices history by record_price
+        once the transaction has been processed.
+
+        Parameters:
+        asset_id (int): The asset.
+        price (float): Price of the transaction.
+        date (date): Date of the transaction.
+        """
+        self.data_cur.execute("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?", (price, date, asset_id))
+
+    def record_price(self, asset_id: int, price: float, date: date) -> None:
+        """
+        Appends the price of a processed transaction to the asset_prices history.
+        Deferred transactions are only recorded when they are processed, so each transaction adds one row.
+
+        Parameters:
+        asset_id (int): The asset.
+        price (float): Price of the transaction.
+        date (date): Date of the transaction.
+        """
+        self.data_cur.execute("INSERT INTO asset_prices(asset_id, date, price, source) VALUES (?,?,?,'transaction')", (asset_id, date, price))
+
     def cohort_value(self, cohort_month, account: str) -> float:
         """
         Calculate the estimated current value of a cohort (month + account).
@@ -298,20 +538,17 @@ class DataParser:
         Returns:
         float: Estimated cohort value.
         """
-        # Get cash for this cohort
-        row = self.data_cur.execute(
-            "SELECT capital FROM cohort_data WHERE month = ? AND account = ?",
-            (cohort_month, account)
-        ).fetchone()
-        cash = row[0] if row else 0.0
-
-        # Get asset values for this cohort using latest_price from assets table
-        asset_value = self.data_cur.execute("""
-            SELECT COALESCE(SUM(ma.amount * COALESCE(a.latest_price, ma.average_price)), 0)
-            FROM cohort_assets ma
-            JOIN assets a ON ma.asset_id = a.asset_id
-            WHERE ma.month = ? AND ma.account = ? AND ma.amount > 0
-        """, (cohort_month, account)).fetchone()[0]
+        # Get cash and asset values for this cohort, using latest_price from assets table, in one statement
+        cash, asset_value = self.data_cur.execute("""
+            SELECT
+                (SELECT capital FROM cohort_data WHERE month = ?1 AND account = ?2),
+                (SELECT COALESCE(SUM(ma.amount * COALESCE(a.latest_price, ma.average_price)), 0)
+                 FROM cohort_assets ma
+                 JOIN assets a ON ma.asset_id = a.asset_id
+                 WHERE ma.month = ?1 AND ma.account = ?2 AND ma.amount > 0)
+        """, (cohort_month, account)).fetchone()
+        if cash is None:
+            cash = 0.0
 
         return cash + asset_value
 
@@ -365,9 +602,9 @@ class DataParser:
         account = row[1]
         self.data_cur.execute("INSERT OR IGNORE INTO cohort_data(month, account) VALUES(?,?)", (month, account))
         self.data_cur.execute("UPDATE cohort_data SET capital = capital + ?, deposit = deposit + ?, active_base = active_base + ? WHERE month = ? AND account = ?", (amount, amount, amount, month, account))
-        # Reset transaction_cur since new funds are available
-        self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-        self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        # New funds are available, retry transactions waiting for capital in this account
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
 
     def handle_withdrawal(self, row: tuple) -> None:
         """
@@ -424,8 +661,11 @@ class DataParser:
                 
                 remaining_amount -= month_amount
                 i += 1
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_withdrawal", i)
+            self.scheduler.mark_processed(row[-1])
+        else:
+            self.scheduler.defer(("capital", account), row)
 
     def handle_purchase(self, row: tuple) -> None: 
         """
@@ -439,32 +679,44 @@ class DataParser:
         """
         asset = row[3]
         account = row[1]
-        self.data_cur.execute("INSERT OR IGNORE INTO assets (asset) VALUES (?) ",(asset,))
-        asset_id = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()[0]
+        asset_id = self._asset_id(asset)
         asset_amount = row[4]
         price = row[5]
         total_amount = -row[6]
         date = row[0]
-        self.data_cur.execute("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?", (price, date, asset_id))
+        self.set_latest_price(asset_id, price, date)
         remaining_amount = total_amount
         month_capital = self.available_capital(account)
         total_capital = sum(e[1] for e in month_capital)
         if total_capital + 1e-3 >= total_amount:
+            capital_updates = []
+            lot_updates = []
             i = 0
             while remaining_amount > 1e-3:
                 (oldest_available,capital) = month_capital[i]
                 month_amount = min(remaining_amount,capital)
                 month_asset_amount = month_amount / total_amount * asset_amount
-                self.data_cur.execute("UPDATE cohort_data SET capital = capital - ? WHERE month = ? AND account = ?", (month_amount, oldest_available, account))
-                self.data_cur.execute("INSERT OR IGNORE INTO cohort_assets(month,asset_id,account) VALUES (?,?,?)",(oldest_available,asset_id,account))
-                self.data_cur.execute("UPDATE cohort_assets SET average_price = ?/(amount+?)*?+amount/(amount+?)*average_price WHERE month = ? AND asset_id = ? AND account = ?",(month_amount,month_amount,price,month_amount,oldest_available,asset_id,account))
-                self.data_cur.execute("UPDATE cohort_assets SET average_purchase_price = ?/(purchased_amount+?)*?+purchased_amount/(purchased_amount+?)*average_purchase_price WHERE month = ? AND asset_id = ? AND account = ?",(month_amount,month_amount,price,month_amount,oldest_available,asset_id,account))
-                self.data_cur.execute("UPDATE cohort_assets SET amount = amount + ?, purchased_amount = purchased_amount + ? WHERE month = ? AND asset_id = ? AND account = ?",(month_asset_amount, month_asset_amount, oldest_available,asset_id,account))
+                capital_updates.append((month_amount, oldest_available, account))
+                lot_updates.append((oldest_available, asset_id, account, month_asset_amount, price, month_amount))
                 remaining_amount -= month_amount
                 i += 1
-            # Reset transaction_cur since new assets are available
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            self.data_cur.executemany("UPDATE cohort_data SET capital = capital - ? WHERE month = ? AND account = ?", capital_updates)
+            # A new lot starts with amount and purchased_amount 0, so both averages are the purchase price
+            self.data_cur.executemany("""
+                INSERT INTO cohort_assets(month, asset_id, account, amount, purchased_amount, average_price, average_purchase_price) VALUES (?1, ?2, ?3, ?4, ?4, ?5, ?5)
+                ON CONFLICT(month, asset_id, account) DO UPDATE SET
+                    average_price = ?6/(amount+?6)*?5+amount/(amount+?6)*average_price,
+                    average_purchase_price = ?6/(purchased_amount+?6)*?5+purchased_amount/(purchased_amount+?6)*average_purchase_price,
+                    amount = amount + ?4, purchased_amount = purchased_amount + ?4
+            """, lot_updates)
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_purchase", i)
+            self.record_price(asset_id, price, date)
+            # New assets are available, retry transactions waiting for this asset in this account
+            self.scheduler.mark_processed(row[-1])
+            self.scheduler.release(("asset", account, asset))
+        else:
+            self.scheduler.defer(("capital", account), row)
  
     def handle_sale(self, row: tuple) -> None:
         """
@@ -478,13 +730,12 @@ class DataParser:
         """
         asset = row[3]
         account = row[1]
-        self.data_cur.execute("INSERT OR IGNORE INTO assets (asset) VALUES (?) ",(asset,))
-        asset_id = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()[0]
+        asset_id = self._asset_id(asset)
         asset_amount = -row[4]
         price = row[5]
         total_amount = row[6]
         date = row[0]
-        self.data_cur.execute("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?", (price, date, asset_id))
+        self.set_latest_price(asset_id, price, date)
         remaining_amount = asset_amount
         month_asset_amounts = self.available_asset(asset_id, account)
 
@@ -492,13 +743,13 @@ class DataParser:
         
         # FIX: Check if we are selling an asset with 0 average purchase price (cost_basis=0)
         # If so, retroactively inject the sale total_amount as a deposit in the month the shares were acquired
+        # Cohorts with 0 active base (deposit) for these shares
+        zero_cost_months = {month for (month,) in self.data_cur.execute(
+            "SELECT month FROM cohort_assets WHERE asset_id = ? AND account = ? AND amount > 0 AND average_purchase_price = 0",
+            (asset_id, account)
+        )}
         for (oldest_available, amount) in month_asset_amounts:
-            # Check if this cohort has 0 active base (deposit) for these shares
-            res = self.data_cur.execute(
-                "SELECT average_purchase_price FROM cohort_assets WHERE month = ? AND asset_id = ? AND account = ?",
-                (oldest_available, asset_id, account)
-            ).fetchone()
-            if res and res[0] == 0.0:
+            if oldest_available in zero_cost_months:
                 # Calculate the proportionate sale amount for these specific shares
                 proportionate_sale_amount = (amount / asset_amount) * total_amount if asset_amount > 0 else 0
                 if proportionate_sale_amount > 0:
@@ -516,20 +767,34 @@ class DataParser:
 
         if total_asset_amount + 1e-3 >= asset_amount:
 
+            lot_updates = []
+            capital_updates = []
             i = 0
             while remaining_amount > 1e-3:
                 (oldest_available,amount) = month_asset_amounts[i]
                 month_amount = min(remaining_amount,amount)
                 month_capital_amount = month_amount / asset_amount * total_amount
-                self.data_cur.execute("UPDATE cohort_assets SET average_sale_price = ?/(sold_amount+?)*?+sold_amount/(sold_amount+?)*average_sale_price WHERE month = ? AND asset_id = ? AND account = ?",(month_amount,month_amount,price,month_amount,oldest_available,asset_id,account))
-                self.data_cur.execute("UPDATE cohort_assets SET amount = amount - ?, sold_amount = sold_amount + ? WHERE month = ? AND asset_id = ? AND account = ?",(month_amount, month_amount, oldest_available,asset_id,account))
-                self.data_cur.execute("INSERT OR IGNORE INTO cohort_data(month, account) VALUES(?,?)", (oldest_available, account))
-                self.data_cur.execute("UPDATE cohort_data SET capital = capital + ? WHERE month = ? AND account = ?", (month_capital_amount, oldest_available, account))
+                lot_updates.append((month_amount, price, oldest_available, asset_id, account))
+                capital_updates.append((oldest_available, account, month_capital_amount))
                 remaining_amount -= month_amount
                 i += 1
-            # Reset transaction_cur since new funds are available
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            self.data_cur.executemany("""
+                UPDATE cohort_assets SET average_sale_price = ?1/(sold_amount+?1)*?2+sold_amount/(sold_amount+?1)*average_sale_price,
+                    amount = amount - ?1, sold_amount = sold_amount + ?1
+                WHERE month = ?3 AND asset_id = ?4 AND account = ?5
+            """, lot_updates)
+            self.data_cur.executemany("""
+                INSERT INTO cohort_data(month, account, capital) VALUES (?,?,?)
+                ON CONFLICT(month, account) DO UPDATE SET capital = capital + excluded.capital
+            """, capital_updates)
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_sale", i)
+            self.record_price(asset_id, price, date)
+            # New funds are available, retry transactions waiting for capital in this account
+            self.scheduler.mark_processed(row[-1])
+            self.scheduler.release(("capital", account))
+        else:
+            self.scheduler.defer(("asset", account, asset), row)
 
     def handle_dividend(self, row: tuple) -> None:
         """
@@ -541,11 +806,7 @@ class DataParser:
         dividend_month = self.allocate_to_month(row[0])
         account = row[1]
         asset = row[3]
-        result = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()
-        if result is None:
-            self.data_cur.execute("INSERT OR IGNORE INTO assets (asset) VALUES (?) ",(asset,))
-            result = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()
-        asset_id = result[0]
+        asset_id = self._asset_id(asset)
         remaining_amount = row[4]
         dividend_per_asset = row[5]
         month_asset_amounts = self.available_asset(asset_id, account)
@@ -556,9 +817,9 @@ class DataParser:
         if remaining_amount > 0:
             self.data_cur.execute("INSERT OR IGNORE INTO cohort_data(month, account) VALUES(?,?)", (dividend_month, account))
             self.data_cur.execute("UPDATE cohort_data SET capital = capital + ? WHERE month = ? AND account = ?", (remaining_amount*dividend_per_asset, dividend_month, account))
-        # Reset transaction_cur since new funds are available
-        self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-        self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        # New funds are available, retry transactions waiting for capital in this account
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
 
     def handle_interest(self, row: tuple) -> None:
         """
@@ -583,9 +844,9 @@ class DataParser:
         if remaining_amount > 0:
             self.data_cur.execute("INSERT OR IGNORE INTO cohort_data(month, account) VALUES(?,?)", (dividend_month, account))
             self.data_cur.execute("UPDATE cohort_data SET capital = capital + ? WHERE month = ? AND account = ?", (remaining_amount, dividend_month, account))
-        # Reset transaction_cur since new funds are available
-        self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-        self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        # New funds are available, retry transactions waiting for capital in this account
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
 
     def handle_fees(self, row: tuple) -> None:
         """
@@ -622,8 +883,11 @@ class DataParser:
                 
                 remaining_amount -= month_amount
                 i += 1
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_fees", i)
+            self.scheduler.mark_processed(row[-1])
+        else:
+            self.scheduler.defer(("capital", account), row)
 
     def handle_listing_change(self, row: tuple) -> None:
         """
@@ -641,12 +905,18 @@ class DataParser:
         else:
             asset = row[3]
             amount = -row[4]
-            (asset_id,) = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()
+            asset_ids = self._load_asset_ids()
+            asset_id = asset_ids[asset]
             self.data_cur.execute("UPDATE assets SET asset = ?, amount = ? WHERE asset_id = ?",(self.listing_change["to_asset"],self.listing_change["to_asset_amount"],asset_id))
+            # The asset is renamed for all accounts
+            del asset_ids[asset]
+            asset_ids[self.listing_change["to_asset"]] = asset_id
             change_factor = self.listing_change["to_asset_amount"]/amount
             self.data_cur.execute("UPDATE cohort_assets SET amount = amount * ? WHERE asset_id = ?",(change_factor,asset_id))
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ? OR rowid = ?",(row[-1],self.listing_change["to_rowid"],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            self.scheduler.mark_processed(row[-1], self.listing_change["to_rowid"])
+            # The asset is available under its new name, retry transactions waiting for it
+            for (account,) in self.data_cur.execute("SELECT DISTINCT account FROM cohort_assets WHERE asset_id = ?",(asset_id,)).fetchall():
+                self.scheduler.release(("asset", account, self.listing_change["to_asset"]))
             self.listing_change = {"to_asset":None,"to_asset_amount":None,"to_rowid":None}
     
     def handle_asset_deposit(self, row: tuple) -> None:
@@ -662,21 +932,25 @@ class DataParser:
         asset = row[3]
         amount = row[4]
         price = row[5]
-        self.data_cur.execute("INSERT OR IGNORE INTO assets (asset) VALUES (?) ",(asset,))
-        asset_id = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()[0]
+        asset_id = self._asset_id(asset)
         date = row[0]
-        self.data_cur.execute("UPDATE assets SET latest_price = ?, latest_price_date = ? WHERE asset_id = ?", (price, date, asset_id))
-        self.data_cur.execute("INSERT OR IGNORE INTO cohort_assets(month,asset_id,account) VALUES (?,?,?)",(month,asset_id,account))
-        # Update average price and average purchase price
-        self.data_cur.execute("UPDATE cohort_assets SET average_price = (? * ? + amount * average_price) / (amount + ?) WHERE month = ? AND asset_id = ? AND account = ?", (amount, price, amount, month, asset_id, account))
-        self.data_cur.execute("UPDATE cohort_assets SET average_purchase_price = (? * ? + purchased_amount * average_purchase_price) / (purchased_amount + ?) WHERE month = ? AND asset_id = ? AND account = ?", (amount, price, amount, month, asset_id, account))
-        # Update amount and purchased amount
-        self.data_cur.execute("UPDATE cohort_assets SET amount = amount + ? WHERE month = ? AND asset_id = ? AND account = ?",(amount,month,asset_id,account))
-        self.data_cur.execute("INSERT OR IGNORE INTO cohort_data(month, account) VALUES(?,?)", (month, account))
-        self.data_cur.execute("UPDATE cohort_data SET deposit = deposit + ?, active_base = active_base + ? WHERE month = ? AND account = ?", (amount*price, amount*price, month, account))
-        # Reset transaction_cur since new assets are available
-        self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?",(row[-1],))
-        self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        self.set_latest_price(asset_id, price, date)
+        self.record_price(asset_id, price, date)
+        # Update average price, average purchase price and amount, a new lot starts with amount and purchased_amount 0
+        self.data_cur.execute("""
+            INSERT INTO cohort_assets(month, asset_id, account, amount, average_price, average_purchase_price) VALUES (?1, ?2, ?3, ?4, ?4 * ?5 / ?4, ?4 * ?5 / ?4)
+            ON CONFLICT(month, asset_id, account) DO UPDATE SET
+                average_price = (?4 * ?5 + amount * average_price) / (amount + ?4),
+                average_purchase_price = (?4 * ?5 + purchased_amount * average_purchase_price) / (purchased_amount + ?4),
+                amount = amount + ?4
+        """, (month, asset_id, account, amount, price))
+        self.data_cur.execute("""
+            INSERT INTO cohort_data(month, account, deposit, active_base) VALUES (?,?,?,?)
+            ON CONFLICT(month, account) DO UPDATE SET deposit = deposit + excluded.deposit, active_base = active_base + excluded.active_base
+        """, (month, account, amount*price, amount*price))
+        # New assets are available, retry transactions waiting for this asset in this account
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("asset", account, asset))
 
     def handle_ignore(self, row: tuple) -> None:
         """
@@ -687,8 +961,7 @@ class DataParser:
         row (tuple): A row from the transactions table in the database.
         """
         logging.debug(f"Ignoring transaction {row[0]} {row[2]} {row[3]} with amount {row[6]}")
-        self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?", (row[-1],))
-        self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+        self.scheduler.mark_processed(row[-1])
 
     def handle_internal_transfer(self, row: tuple) -> None:
         """
@@ -712,10 +985,12 @@ class DataParser:
             self.pending_transfer["account"] = row[1]
             self.pending_transfer["amount"] = row[6]
             self.pending_transfer["date"] = row[0]
+            self.pending_transfer["row"] = row
             # Don't mark processed yet
             return
         
         # Second of pair
+        first_row = self.pending_transfer["row"]
         first_rowid = self.pending_transfer["rowid"]
         second_rowid = row[-1]
         
@@ -781,6 +1056,8 @@ class DataParser:
                 
                 remaining -= month_amount
                 i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_internal_transfer", i)
             
             # Add to IN account in same months
             in_transaction_month = self.allocate_to_month(in_date)
@@ -802,11 +1079,9 @@ class DataParser:
                     DO UPDATE SET amount = amount + excluded.amount
                 """, (oldest_available, in_account, in_transaction_month, amount))
             
-            # Mark BOTH processed
-            self.transaction_cur.execute(
-                "UPDATE transactions SET processed = 1 WHERE rowid = ? OR rowid = ?",
-                (first_rowid, second_rowid)
-            )
+            # Mark BOTH processed and retry transactions waiting for capital in the IN account
+            self.scheduler.mark_processed(first_rowid, second_rowid)
+            self.scheduler.release(("capital", in_account))
             logging.debug(f"Internal transfer pair processed: {out_amount} from {out_account} to {in_account}")
         
         else:
@@ -815,30 +1090,26 @@ class DataParser:
                 f"Internal transfer pair deferred: account {out_account} needs {out_amount}, has {total_capital}"
             )
             # Reset pending transfer so both transactions stay unprocessed
-            # They'll be retried later when capital becomes available
-            self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None}
+            # They'll be retried together when capital becomes available in the OUT account
+            self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+            self.scheduler.defer(("capital", out_account), first_row, row)
             return
         
         # Reset pending transfer
-        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None}
-        
-        # Reset cursor since we marked transactions processed
-        self.transaction_cur.execute(
-            "SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC"
-        )
+        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
 
     def handle_remove_shares(self, row: tuple) -> None:
         """
         Removes shares from portfolio without affecting capital (for Byte transactions).
         Used for Värdepappersuttag with negative amount.
+        If there are not enough shares in the account, the transaction is deferred until the asset is available, like a sale.
         
         Parameters:
         row (tuple): A row from the transactions table in the database.
         """
         asset = row[3]
         account = row[1]
-        self.data_cur.execute("INSERT OR IGNORE INTO assets (asset) VALUES (?) ",(asset,))
-        asset_id = self.data_cur.execute("SELECT asset_id FROM assets WHERE asset = ?",(asset,)).fetchone()[0]
+        asset_id = self._asset_id(asset)
         asset_amount = -row[4]  # Convert negative to positive
         remaining_amount = asset_amount
         month_asset_amounts = self.available_asset(asset_id, account)
@@ -854,96 +1125,357 @@ class DataParser:
                                      (month_amount, oldest_available, asset_id, account))
                 remaining_amount -= month_amount
                 i += 1
-            # Reset transaction_cur
-            self.transaction_cur.execute("UPDATE transactions SET processed = 1 WHERE rowid = ?", (row[-1],))
-            self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_remove_shares", i)
+            self.scheduler.mark_processed(row[-1])
         else:
-            # Not enough shares - this shouldn't happen for valid Byte transactions
+            # Not enough shares - this shouldn't happen for valid Byte transactions, wait for the asset like a sale
             logging.warning(f"Not enough shares to remove for {asset}: have {total_asset_amount}, need {asset_amount}")
-            raise AssetDeficit(f"Not enough shares to remove for {asset}", self)
+            self.scheduler.defer(("asset", account, asset), row)
+
+    def dispatch(self, handler, row: tuple) -> None:
+        """
+        Calls the handle_* method of handler that corresponds to the transaction type of row.
 
-    def process_transactions(self) -> None:
+        Parameters:
+        handler (DataParser or LotEngine): Object implementing the handle_* methods.
+        row (tuple): A row from the transactions table in the database.
+        """
+        if row[2] == "Insättning" or row[2] == "Autogiroinsättning":
+            handler.handle_deposit(row)
+        elif row[2] == "Uttag":
+            handler.handle_withdrawal(row)
+        elif row[2] == "Köp":
+            handler.handle_purchase(row)
+        elif row[2] == "Sälj":
+            handler.handle_sale(row)
+        elif row[2] == "Utdelning":
+            handler.handle_dividend(row)
+        elif row[2] == "Räntor" or row[2] == "Ränta" or row[2] == "Inlåningsränta" or row[2] == "Utlåningsränta" or row[2] == "Uttag av riskkostnad":
+            # Interest can either be negative and handled as a fee, or positive and handled like a dividend on capital
+            # Uttag av riskkostnad is a risk premium fee (always negative)
+            if row[6] > 0:
+                handler.handle_interest(row)
+            else:
+                handler.handle_fees(row)
+        elif row[2] == "Utbokning fraktioner":
+            # Tiny fraction write-off, ignore (negligible amount)
+            handler.handle_ignore(row)
+        elif "Utländsk källskatt" in row[2] or "Prelskatt" in row[2] or "Preliminärskatt" in row[2] or "Avkastningsskatt" in row[2]:
+            handler.handle_fees(row)
+        elif "Byte" in row[2] or row[2] == "Övrigt":
+            handler.handle_listing_change(row)
+        elif row[2] == "Tillgångsinsättning":
+            handler.handle_asset_deposit(row)
+        elif row[2] == "Intern överföring":
+            handler.handle_internal_transfer(row)
+        elif row[2] == "Värdepappersinsättning":
+            # Check if this is part of a "Byte" (change) transaction
+            # If amount is positive, it's adding shares (already handled by special cases converting to Tillgångsinsättning)
+            # If it wasn't converted, ignore it
+            handler.handle_ignore(row)
+        elif row[2] == "Värdepappersuttag":
+            # Removing shares (usually part of "Byte" transaction)
+            if row[4] < 0:  # Negative amount means removing shares
+                handler.handle_remove_shares(row)
+            else:
+                handler.handle_ignore(row)
+        else:
+            raise(ValueError)
+
+    def process_transactions(self, in_memory: bool = False) -> None:
         """
         Process transactions all transactions in the database that have not been processed yet.
         After attempting to processing all transactions, the function checks if there are any unprocessed transactions left.
-        If there are, an AssetDeficit exception is raised and the database is rolled back. Otherwise, the changes are committed.
-        """
-        unprocessed_lines = self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
-        row = unprocessed_lines.fetchone()
-        #Consider upgrading to python3.8 to make this more elegant with := statment
-        while row is not None:
-            month = self.allocate_to_month(row[0])
-            if row[2] == "Insättning" or row[2] == "Autogiroinsättning":
-                self.handle_deposit(row)
-            elif row[2] == "Uttag":
-                self.handle_withdrawal(row)
-            elif row[2] == "Köp":
-                self.handle_purchase(row)
-            elif row[2] == "Sälj":
-                self.handle_sale(row)
-            elif row[2] == "Utdelning":
-                self.handle_dividend(row)
-            elif row[2] == "Räntor" or row[2] == "Ränta" or row[2] == "Inlåningsränta" or row[2] == "Utlåningsränta" or row[2] == "Uttag av riskkostnad":
-                # Interest can either be negative and handled as a fee, or positive and handled like a dividend on capital
-                # Uttag av riskkostnad is a risk premium fee (always negative)
-                if row[6] > 0:
-                    self.handle_interest(row)
-                else:
-                    self.handle_fees(row)
-            elif row[2] == "Utbokning fraktioner":
-                # Tiny fraction write-off, ignore (negligible amount)
-                self.handle_ignore(row)
-            elif "Utländsk källskatt" in row[2] or "Prelskatt" in row[2] or "Preliminärskatt" in row[2] or "Avkastningsskatt" in row[2]:
-                self.handle_fees(row)
-            elif "Byte" in row[2] or row[2] == "Övrigt":
-                self.handle_listing_change(row)
-            elif row[2] == "Tillgångsinsättning":
-                self.handle_asset_deposit(row)
-            elif row[2] == "Intern överföring":
-                self.handle_internal_transfer(row)
-            elif row[2] == "Värdepappersinsättning":
-                # Check if this is part of a "Byte" (change) transaction
-                # If amount is positive, it's adding shares (already handled by special cases converting to Tillgångsinsättning)
-                # If it wasn't converted, ignore it
-                self.handle_ignore(row)
-            elif row[2] == "Värdepappersuttag":
-                # Removing shares (usually part of "Byte" transaction)
-                if row[4] < 0:  # Negative amount means removing shares
-                    self.handle_remove_shares(row)
-                else:
-                    self.handle_ignore(row)
+        If there are, an AssetDeficit exception is raised. The transactions before the latest month boundary at which no transaction was waiting,
+        which all remaining transactions are dated after, are kept as processed and committed, the later ones are rolled back and left unprocessed
+        for the next run to resume from. If there is no such boundary after the first transaction, the database is rolled back.
+        Otherwise, the changes are committed.
+        Transactions that cannot be processed yet are deferred by a TransactionScheduler and retried once the capital or asset they need is released.
+
+        Parameters:
+        in_memory (bool): If True, the FIFO allocation is run by a LotEngine on in-memory state
+            which is written back in bulk, instead of issuing SQL statements per lot.
+        """
+        # The assets table may have been changed since the last run, by another DataParser or a rolled back run
+        self._asset_ids = None
+        self._prepare_checkpoints()
+        self._track_dirty = self._last_processed is not None
+        if in_memory:
+            self._process_transactions_in_memory()
+            return
+        # The processed flags are written after all rows have been read so the SELECT is not affected by them
+        self.scheduler = TransactionScheduler(self)
+        # A run that ended with an AssetDeficit can have left the first transaction of a pair
+        self.listing_change = {"to_asset":None,"to_asset_amount":None,"to_rowid":None}
+        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+        self._savepoint = False
+        with self._profile(self), self._dirty_tracking():
+            unprocessed_lines = self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC")
+            unprocessed = self.scheduler.run(self, unprocessed_lines)
+
+            if len(unprocessed) > 0:
+                if len(self.scheduler.boundaries) < 2:
+                    self.db.conn.rollback()
+                    raise AssetDeficit(self._deficit_message(), self)
+                processed_until = self.scheduler.boundaries[-1]
+                self.data_cur.execute("ROLLBACK TO month_boundary")
+                self.data_cur.execute("RELEASE month_boundary")
+                self._asset_ids = None
+                # The transactions of this run dated before the boundary were all processed before it
+                self.data_cur.execute("UPDATE transactions SET processed = 1 WHERE processed = 0 AND date < ?", (processed_until,))
+                if not self._track_dirty:
+                    self._mark_dirty()
+                self.update_asset_summary()
+                self._prune_checkpoints()
+                self.db.commit()
+                raise AssetDeficit(self._deficit_message(), self, processed_until=processed_until)
             else:
-                raise(ValueError)
-            row = unprocessed_lines.fetchone()
+                if self._savepoint:
+                    self.data_cur.execute("RELEASE month_boundary")
+                self.data_cur.executemany("UPDATE transactions SET processed = 1 WHERE rowid = ?", [(rowid,) for rowid in sorted(self.scheduler.processed)])
+                if not self._track_dirty:
+                    self._mark_dirty()
+                self.update_asset_summary()
+                self._prune_checkpoints()
+                #Commit changes
+                self.db.commit()
+
+    def _process_transactions_in_memory(self) -> None:
+        """
+        Runs process_transactions with a LotEngine. The engine state is only written to the database if all transactions could be processed.
+        Otherwise the state at the latest month boundary is rebuilt by processing the transactions before it again with a new engine,
+        which handles them exactly as the first one did, and written instead.
+        """
+        # Imported here since lot_engine depends on this module
+        from lot_engine import LotEngine
+
+        engine = LotEngine(self)
+        with self._profile(engine):
+            engine.load()
+            rows = self.transaction_cur.execute("SELECT *,rowid FROM transactions WHERE processed == 0 ORDER BY date ASC, rowid ASC").fetchall()
+            unprocessed = engine.run(rows)
+            if len(unprocessed) > 0:
+                if len(engine.scheduler.boundaries) < 2:
+                    self.db.conn.rollback()
+                    raise AssetDeficit(self._deficit_message(), self)
+                processed_until = engine.scheduler.boundaries[-1]
+                engine = LotEngine(self)
+                engine.load()
+                engine.run([row for row in rows if row[0] < processed_until])
+                engine.checkpoint(processed_until)
+                engine.flush()
+                self._mark_dirty(engine.changed_cohorts())
+                self.update_asset_summary()
+                self._prune_checkpoints()
+                self.db.commit()
+                raise AssetDeficit(self._deficit_message(), self, processed_until=processed_until)
+            engine.flush()
+            self._mark_dirty(engine.changed_cohorts())
+            self.update_asset_summary()
+            self._prune_checkpoints()
+            self.db.commit()
+
+    def _deficit_message(self) -> str:
+        """
+        Returns:
+        str: The AssetDeficit message with the number of transactions left unprocessed in the database, once the run was rolled back
+            to the last month boundary or entirely. These include the transactions after the boundary that were processed by the run.
+        """
+        (count,) = self.data_cur.execute("SELECT COUNT(*) FROM transactions WHERE processed = 0").fetchone()
+        return "There are {} transaction(s) that could not be processed due to a missmatch of assets in the database".format(count)
+
+    def _profile(self, handler):
+        """
+        Returns:
+        A context manager that records the processing run with self.profiler, or does nothing if there is no profiler.
+        """
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.profile(self.data_cur.connection, handler)
+
+    @contextmanager
+    def _dirty_tracking(self):
+        """
+        Context manager for an SQL processing run that continues from processed transactions. Temporary triggers mark the cohorts
+        whose rows the handlers write dirty and are dropped after the run. A run from the first transaction changes all cohorts,
+        it has no triggers and marks them all with _mark_dirty instead.
+        """
+        if not self._track_dirty:
+            yield
+            return
+        events = {"insert": "NEW", "update": "NEW", "delete": "OLD"}
+        for table, month_column in DIRTY_COHORT_TABLES.items():
+            for event, row in events.items():
+                # OR IGNORE would be overridden by the conflict clause of an UPSERT
+                self.data_cur.execute(f"""
+                    CREATE TEMP TRIGGER IF NOT EXISTS {table}_dirty_{event} AFTER {event.upper()} ON {table} BEGIN
+                        INSERT INTO dirty_cohorts(account, month) SELECT {row}.account, {row}.{month_column}
+                            WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = {row}.account AND month = {row}.{month_column});
+                    END""")
+        try:
+            yield
+        finally:
+            for table in DIRTY_COHORT_TABLES:
+                for event in events:
+                    self.data_cur.execute(f"DROP TRIGGER IF EXISTS temp.{table}_dirty_{event}")
+
+    def _mark_dirty(self, cohorts=None) -> None:
+        """
+        Marks cohorts dirty for StatCalculator.update_stats. Does not commit.
 
-        unprocessed_count = self.transaction_cur.execute("SELECT COUNT(*) FROM transactions WHERE processed == 0").fetchone()[0]
-        if unprocessed_count > 0:
-            raise AssetDeficit("There are {} transaction(s) that could not be processed due to a missmatch of assets in the database".format(unprocessed_count),self)
+        Parameters:
+        cohorts (iterable): (month, account) of the changed cohorts, or None for all cohorts in cohort_data.
+        """
+        if cohorts is None:
+            self.data_cur.execute("INSERT OR IGNORE INTO dirty_cohorts(account, month) SELECT account, month FROM cohort_data")
         else:
-            #Calculate summary data and put it in asset table
-            asset_ids = self.data_cur.execute("SELECT asset_id FROM assets").fetchall()
-            for (id,) in asset_ids:
-                month_asset_data = self.data_cur.execute("SELECT amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount FROM cohort_assets WHERE asset_id = ?",(id,)).fetchall()
-                amount = 0
-                average_price = 0
-                average_purchase_price = 0
-                average_sale_price = 0
-                purchased_amount = 0
-                sold_amount = 0
-                for month_asset in month_asset_data:
-                    month_amount, month_average_price, month_average_purchase_price, month_average_sale_price, month_purchased_amount, month_sold_amount = month_asset
-                    if month_amount > 1e-3:
-                        average_price = month_amount/(month_amount+amount)*month_average_price+amount/(month_amount+amount)*average_price
-                        amount += month_amount
-                    if month_purchased_amount > 1e-3:
-                        average_purchase_price = month_purchased_amount/(month_purchased_amount+purchased_amount)*month_average_purchase_price+purchased_amount/(month_purchased_amount+purchased_amount)*average_purchase_price
-                        purchased_amount += month_purchased_amount
-                    if month_sold_amount > 1e-3:
-                        average_sale_price = month_sold_amount/(month_sold_amount+sold_amount)*month_average_sale_price+sold_amount/(month_sold_amount+sold_amount)*average_sale_price
-                        sold_amount += month_sold_amount
-                self.data_cur.execute("UPDATE assets SET amount = ?, average_price = ?, average_purchase_price = ?, average_sale_price = ?, purchased_amount = ?, sold_amount = ? WHERE asset_id = ?",(amount,average_price,average_purchase_price,average_sale_price,purchased_amount,sold_amount,id,))
-            #Commit changes
-            self.db.commit()
+            self.data_cur.executemany("INSERT OR IGNORE INTO dirty_cohorts(account, month) VALUES (?,?)",
+                                      [(account, month) for month, account in cohorts])
+
+    def _prepare_checkpoints(self) -> None:
+        """
+        Rewinds to a checkpoint if there are unprocessed transactions dated before already processed ones,
+        so that all transactions are applied in date order. Then determines which month boundaries
+        can be saved as checkpoints during this run.
+        """
+        # MIN and MAX return strings even with PARSE_DECLTYPES
+        (first_unprocessed,) = self.data_cur.execute("SELECT MIN(date) FROM transactions WHERE processed = 0").fetchone()
+        (last_processed,) = self.data_cur.execute("SELECT MAX(date) FROM transactions WHERE processed = 1").fetchone()
+        if first_unprocessed is not None and last_processed is not None and first_unprocessed < last_processed:
+            self.rewind(date.fromisoformat(first_unprocessed))
+            (last_processed,) = self.data_cur.execute("SELECT MAX(date) FROM transactions WHERE processed = 1").fetchone()
+        self._last_processed = date.fromisoformat(last_processed) if last_processed is not None else None
+
+        # Only the latest max_checkpoints months are saved
+        (last,) = self.data_cur.execute("SELECT MAX(date) FROM transactions").fetchone()
+        if self.max_checkpoints > 0 and last is not None:
+            last = date.fromisoformat(last)
+            months = last.year * 12 + last.month - 1 - (self.max_checkpoints - 1)
+            self._checkpoint_from = date(months // 12, months % 12 + 1, 1)
+        else:
+            self._checkpoint_from = None
+
+    def should_checkpoint(self, month: date) -> bool:
+        """
+        Returns True if the processing state at the start of month should be saved as a checkpoint,
+        i.e. no processed transaction is dated in or after month, month is one of the latest max_checkpoints months
+        and there is no checkpoint for month yet.
+
+        Parameters:
+        month (date): First day of the month.
+        """
+        if self._checkpoint_from is None or month < self._checkpoint_from:
+            return False
+        if self._last_processed is not None and self._last_processed >= month:
+            return False
+        return self.data_cur.execute("SELECT 1 FROM checkpoints WHERE date = ?", (month,)).fetchone() is None
+
+    def checkpoint(self, month: date) -> None:
+        """
+        Called by the TransactionScheduler at month boundaries. Saves cohort_data, cohort_assets, cohort_cash_flows and assets
+        as a checkpoint for month if should_checkpoint allows it. Then moves the month_boundary savepoint here,
+        process_transactions rolls back to it if later transactions can not be processed.
+
+        Parameters:
+        month (date): First day of the month, all processed transactions are dated before it.
+        """
+        if self.should_checkpoint(month):
+            self.data_cur.execute("INSERT INTO checkpoints(date) VALUES (?)", (month,))
+            checkpoint_id = self.data_cur.lastrowid
+            for table, columns in CHECKPOINT_TABLES.items():
+                self.data_cur.execute(f"INSERT INTO checkpoint_{table}(checkpoint_id, {columns}) SELECT ?, {columns} FROM {table} ORDER BY rowid", (checkpoint_id,))
+        # Only the latest boundary is needed. A savepoint that starts the transaction would commit when it is released
+        if not self.data_cur.connection.in_transaction:
+            self.data_cur.execute("BEGIN")
+        if self._savepoint:
+            self.data_cur.execute("RELEASE month_boundary")
+        self.data_cur.execute("SAVEPOINT month_boundary")
+        self._savepoint = True
+
+    def rewind(self, to_date: date) -> None:
+        """
+        Restores the state saved by the latest checkpoint on or before to_date and marks the transactions from the checkpoint month on
+        as unprocessed, so that they are processed again in date order. Later checkpoints are removed.
+        The cohorts that differ from the checkpoint are marked dirty, the ones of the checkpoint month and later and earlier cohorts
+        changed by later transactions, the processing run marks the cohorts it writes again.
+        Without such a checkpoint, the state is reset, all cohorts are marked dirty and all transactions are processed again. Does not commit.
+
+        Parameters:
+        to_date (date): Date of the earliest transaction that has to be processed again.
+        """
+        row = self.data_cur.execute("SELECT checkpoint_id, date FROM checkpoints WHERE date <= ? ORDER BY date DESC LIMIT 1", (to_date,)).fetchone()
+        self._asset_ids = None
+        if row is None:
+            self._mark_dirty()
+        else:
+            for table, month_column in DIRTY_COHORT_TABLES.items():
+                columns = CHECKPOINT_TABLES[table]
+                self.data_cur.execute(f"""
+                    INSERT OR IGNORE INTO dirty_cohorts(account, month)
+                    SELECT DISTINCT account, {month_column} FROM (
+                        SELECT {columns} FROM {table}
+                        EXCEPT SELECT {columns} FROM checkpoint_{table} WHERE checkpoint_id = ?)
+                """, (row[0],))
+        # Referencing tables are cleared first
+        for table in reversed(CHECKPOINT_TABLES):
+            self.data_cur.execute(f"DELETE FROM {table}")
+        if row is None:
+            logging.info(f"No checkpoint on or before {to_date}, processing all transactions again")
+            self._delete_checkpoints()
+            self.data_cur.execute("DELETE FROM asset_prices")
+            self.data_cur.execute("UPDATE transactions SET processed = 0")
+            return
+        checkpoint_id, month = row
+        logging.info(f"Rewinding to checkpoint {month} to process transactions from {to_date}")
+        self._delete_checkpoints("WHERE date > ?", (month,))
+        for table, columns in CHECKPOINT_TABLES.items():
+            self.data_cur.execute(f"INSERT INTO {table}({columns}) SELECT {columns} FROM checkpoint_{table} WHERE checkpoint_id = ? ORDER BY rowid", (checkpoint_id,))
+        # Prices recorded by the transactions that are processed again, and prices of assets that did not exist yet
+        self.data_cur.execute("DELETE FROM asset_prices WHERE (source = 'transaction' AND date >= ?) OR asset_id NOT IN (SELECT asset_id FROM assets)", (month,))
+        self.data_cur.execute("UPDATE transactions SET processed = 0 WHERE date >= ?", (month,))
+
+    def _prune_checkpoints(self) -> None:
+        """
+        Removes all but the latest max_checkpoints checkpoints.
+        """
+        self._delete_checkpoints("WHERE checkpoint_id NOT IN (SELECT checkpoint_id FROM checkpoints ORDER BY date DESC LIMIT ?)", (self.max_checkpoints,))
+
+    def _delete_checkpoints(self, where: str = "", params: tuple = ()) -> None:
+        """
+        Removes the checkpoints matching where, a WHERE clause on the checkpoints table, together with their saved state.
+        """
+        checkpoint_ids = f"SELECT checkpoint_id FROM checkpoints {where}"
+        for table in CHECKPOINT_TABLES:
+            self.data_cur.execute(f"DELETE FROM checkpoint_{table} WHERE checkpoint_id IN ({checkpoint_ids})", params)
+        self.data_cur.execute(f"DELETE FROM checkpoints {where}", params)
+
+    def update_asset_summary(self) -> None:
+        """
+        Calculates summary data for each asset from cohort_assets and puts it in the assets table.
+        Amounts are summed and prices averaged weighted by amount over the lots with more than 1e-3 of the amount,
+        assets without such lots get 0. All assets are updated by one grouped statement.
+        """
+        self.data_cur.execute("""
+            UPDATE assets SET amount = summary.amount, average_price = summary.average_price, average_purchase_price = summary.average_purchase_price,
+                average_sale_price = summary.average_sale_price, purchased_amount = summary.purchased_amount, sold_amount = summary.sold_amount
+            FROM (
+                SELECT a.asset_id,
+                    TOTAL(CASE WHEN m.amount > 1e-3 THEN m.amount END) AS amount,
+                    COALESCE(SUM(CASE WHEN m.amount > 1e-3 THEN m.amount * m.average_price END)
+                             / SUM(CASE WHEN m.amount > 1e-3 THEN m.amount END), 0) AS average_price,
+                    TOTAL(CASE WHEN m.purchased_amount > 1e-3 THEN m.purchased_amount END) AS purchased_amount,
+                    COALESCE(SUM(CASE WHEN m.purchased_amount > 1e-3 THEN m.purchased_amount * m.average_purchase_price END)
+                             / SUM(CASE WHEN m.purchased_amount > 1e-3 THEN m.purchased_amount END), 0) AS average_purchase_price,
+                    TOTAL(CASE WHEN m.sold_amount > 1e-3 THEN m.sold_amount END) AS sold_amount,
+                    COALESCE(SUM(CASE WHEN m.sold_amount > 1e-3 THEN m.sold_amount * m.average_sale_price END)
+                             / SUM(CASE WHEN m.sold_amount > 1e-3 THEN m.sold_amount END), 0) AS average_sale_price
+                FROM assets a
+                LEFT JOIN cohort_assets m ON m.asset_id = a.asset_id
+                GROUP BY a.asset_id
+            ) AS summary
+            WHERE assets.asset_id = summary.asset_id
+        """)
 
 if __name__ == "__main__":
     # Create DatabaseHandler object
@@ -1,4 +1,6 @@
 import sqlite3
+import hashlib
+from contextlib import contextmanager
 from datetime import date
 
 def adapt_date(val):
@@ -13,48 +15,350 @@ def convert_date(val):
 sqlite3.register_adapter(date, adapt_date)
 sqlite3.register_converter("date", convert_date)
 
+def transaction_key(row: tuple, occurrence: int = 0) -> str:
+    """
+    Returns the natural key of a transaction, used to detect transactions that have already been imported.
+    The key is a hash of date, account, transaction type, asset name, amount and price, where amount and price
+    are rounded to 6 decimals so that float representation differences do not matter.
+    Transactions that are identical on all of these are told apart by occurrence, their order within the import.
+
+    Parameters:
+    row (tuple): Transaction starting with date, account, transaction_type, asset_name, amount, price.
+    occurrence (int): Number of identical transactions preceding this one.
+
+    Returns:
+    str: Hex digest identifying the transaction.
+    """
+    fields = [str(row[0]), row[1], row[2], row[3]]
+    # Adding 0.0 turns -0.0 into 0.0
+    fields += ["%.6f" % (round(value, 6) + 0.0) for value in row[4:6]]
+    fields.append(str(occurrence))
+    return hashlib.sha1("\x1f".join(fields).encode()).hexdigest()
+
+# Schema migrations, applied in order by DatabaseHandler.migrate.
+# PRAGMA user_version holds the number of migrations that have been applied to a database.
+MIGRATIONS = [
+    # 1: Indexes for the processing and stats hot paths
+    [
+        # Unprocessed transactions in processing order (rowid is part of every index)
+        "CREATE INDEX IF NOT EXISTS transactions_unprocessed ON transactions(date) WHERE processed = 0",
+        # available_capital: months with capital per account, covering capital
+        "CREATE INDEX IF NOT EXISTS cohort_data_available_capital ON cohort_data(account, month, capital) WHERE capital > 0",
+        # available_asset: months holding an asset per account, covering amount
+        "CREATE INDEX IF NOT EXISTS cohort_assets_available ON cohort_assets(asset_id, account, month, amount) WHERE amount > 0",
+        # Cash flows of a cohort, covering transaction_month and amount
+        "CREATE INDEX IF NOT EXISTS cohort_cash_flows_cohort ON cohort_cash_flows(cohort_month, account, transaction_month, amount)",
+    ],
+    # 2: Append-only price history, fed by transaction prices and update_prices
+    [
+        """CREATE TABLE IF NOT EXISTS asset_prices(
+            asset_id INTEGER NOT NULL,
+            date DATE NOT NULL,
+            price REAL NOT NULL,
+            source TEXT NOT NULL,
+            FOREIGN KEY (asset_id) REFERENCES assets (asset_id)
+            )""",
+        # Price of an asset as of a date, and price ranges for valuation series
+        "CREATE INDEX IF NOT EXISTS asset_prices_asset_date ON asset_prices(asset_id, date)",
+        # Seed the history with the latest prices of existing databases
+        """INSERT INTO asset_prices(asset_id, date, price, source)
+            SELECT asset_id, latest_price_date, latest_price, 'assets' FROM assets
+            WHERE latest_price IS NOT NULL AND latest_price_date IS NOT NULL""",
+    ],
+    # 3: Snapshots of the processing state at month boundaries, used to rewind for back-dated transactions
+    [
+        """CREATE TABLE IF NOT EXISTS checkpoints(
+            checkpoint_id INTEGER PRIMARY KEY,
+            date DATE UNIQUE NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS checkpoint_cohort_data(
+            checkpoint_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            account TEXT NOT NULL,
+            deposit REAL,
+            withdrawal REAL,
+            capital REAL,
+            active_base REAL,
+            closed_return REAL,
+            transfer_net REAL,
+            FOREIGN KEY (checkpoint_id) REFERENCES checkpoints (checkpoint_id)
+            )""",
+        """CREATE TABLE IF NOT EXISTS checkpoint_cohort_assets(
+            checkpoint_id INTEGER NOT NULL,
+            month DATE NOT NULL,
+            asset_id INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            amount REAL,
+            average_price REAL,
+            average_purchase_price REAL,
+            average_sale_price REAL,
+            purchased_amount REAL,
+            sold_amount REAL,
+            FOREIGN KEY (checkpoint_id) REFERENCES checkpoints (checkpoint_id)
+            )""",
+        """CREATE TABLE IF NOT EXISTS checkpoint_cohort_cash_flows(
+            checkpoint_id INTEGER NOT NULL,
+            cohort_month DATE NOT NULL,
+            account TEXT NOT NULL,
+            transaction_month DATE NOT NULL,
+            amount REAL,
+            FOREIGN KEY (checkpoint_id) REFERENCES checkpoints (checkpoint_id)
+            )""",
+        """CREATE TABLE IF NOT EXISTS checkpoint_assets(
+            checkpoint_id INTEGER NOT NULL,
+            asset_id INTEGER NOT NULL,
+            asset TEXT NOT NULL,
+            amount REAL,
+            average_price REAL,
+            average_purchase_price REAL,
+            average_sale_price REAL,
+            purchased_amount REAL,
+            sold_amount REAL,
+            latest_price REAL,
+            latest_price_date DATE,
+            FOREIGN KEY (checkpoint_id) REFERENCES checkpoints (checkpoint_id)
+            )""",
+        "CREATE INDEX IF NOT EXISTS checkpoint_cohort_data_checkpoint ON checkpoint_cohort_data(checkpoint_id)",
+        "CREATE INDEX IF NOT EXISTS checkpoint_cohort_assets_checkpoint ON checkpoint_cohort_assets(checkpoint_id)",
+        "CREATE INDEX IF NOT EXISTS checkpoint_cohort_cash_flows_checkpoint ON checkpoint_cohort_cash_flows(checkpoint_id)",
+        "CREATE INDEX IF NOT EXISTS checkpoint_assets_checkpoint ON checkpoint_assets(checkpoint_id)",
+    ],
+    # 4: Dirty tracking for incremental stats, changed cohorts and changed asset prices are recorded by triggers.
+    # The triggers check for existing rows, OR IGNORE would be overridden by the conflict clause of an UPSERT.
+    [
+        """CREATE TABLE IF NOT EXISTS dirty_cohorts(
+            account TEXT NOT NULL,
+            month DATE NOT NULL,
+            PRIMARY KEY(account, month)
+            )""",
+        """CREATE TABLE IF NOT EXISTS dirty_assets(
+            asset_id INTEGER PRIMARY KEY
+            )""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_data_dirty_insert AFTER INSERT ON cohort_data BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_data_dirty_update AFTER UPDATE ON cohort_data BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_data_dirty_delete AFTER DELETE ON cohort_data BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT OLD.account, OLD.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = OLD.account AND month = OLD.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_assets_dirty_insert AFTER INSERT ON cohort_assets BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_assets_dirty_update AFTER UPDATE ON cohort_assets BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_assets_dirty_delete AFTER DELETE ON cohort_assets BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT OLD.account, OLD.month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = OLD.account AND month = OLD.month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_cash_flows_dirty_insert AFTER INSERT ON cohort_cash_flows BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.cohort_month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.cohort_month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_cash_flows_dirty_update AFTER UPDATE ON cohort_cash_flows BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT NEW.account, NEW.cohort_month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = NEW.account AND month = NEW.cohort_month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS cohort_cash_flows_dirty_delete AFTER DELETE ON cohort_cash_flows BEGIN
+            INSERT INTO dirty_cohorts(account, month) SELECT OLD.account, OLD.cohort_month
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_cohorts WHERE account = OLD.account AND month = OLD.cohort_month);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS assets_dirty_price AFTER UPDATE OF latest_price ON assets
+            WHEN NEW.latest_price IS NOT OLD.latest_price BEGIN
+            INSERT INTO dirty_assets(asset_id) SELECT NEW.asset_id
+                WHERE NOT EXISTS (SELECT 1 FROM dirty_assets WHERE asset_id = NEW.asset_id);
+            END""",
+        # Stats of existing databases may predate the tracking, recalculate all of them once
+        "INSERT OR IGNORE INTO dirty_cohorts(account, month) SELECT account, month FROM cohort_data",
+    ],
+    # 5: Per account stats tables written by StatCalculator, replacing the global cohort_stats and year_stats tables
+    [
+        "DROP TABLE IF EXISTS cohort_stats",
+        "DROP TABLE IF EXISTS year_stats",
+        """CREATE TABLE IF NOT EXISTS account_cohort_stats(
+            account TEXT NOT NULL,
+            month DATE NOT NULL,
+            deposit REAL,
+            withdrawal REAL,
+            value REAL,
+            total_gainloss REAL,
+            realized_gainloss REAL,
+            unrealized_gainloss REAL,
+            total_gainloss_per REAL,
+            realized_gainloss_per REAL,
+            unrealized_gainloss_per REAL,
+            annual_per_yield REAL,
+            acc_net_deposit REAL,
+            acc_deposit REAL,
+            acc_value REAL,
+            acc_unrealized_gainloss REAL,
+            acc_total_gainloss REAL,
+            PRIMARY KEY (account, month)
+            )""",
+        """CREATE TABLE IF NOT EXISTS account_year_stats(
+            account TEXT NOT NULL,
+            year DATE NOT NULL,
+            deposit REAL,
+            withdrawal REAL,
+            value REAL,
+            total_gainloss REAL,
+            realized_gainloss REAL,
+            unrealized_gainloss REAL,
+            total_gainloss_per REAL,
+            realized_gainloss_per REAL,
+            unrealized_gainloss_per REAL,
+            annual_per_yield REAL,
+            acc_net_deposit REAL,
+            acc_deposit REAL,
+            acc_value REAL,
+            acc_unrealized_gainloss REAL,
+            acc_total_gainloss REAL,
+            PRIMARY KEY (account, year)
+            )""",
+    ],
+    # 6: Holdings matrix of StatCalculator.revalue_stats, kept between runs until calculate_cohort_stats removes it
+    [
+        """CREATE TABLE IF NOT EXISTS stats_holdings(
+            holdings BLOB NOT NULL
+            )""",
+    ],
+    # 7: Changed cohorts are marked dirty by DataParser.process_transactions instead of by triggers on every cohort write
+    [
+        "DROP TRIGGER IF EXISTS cohort_data_dirty_insert",
+        "DROP TRIGGER IF EXISTS cohort_data_dirty_update",
+        "DROP TRIGGER IF EXISTS cohort_data_dirty_delete",
+        "DROP TRIGGER IF EXISTS cohort_assets_dirty_insert",
+        "DROP TRIGGER IF EXISTS cohort_assets_dirty_update",
+        "DROP TRIGGER IF EXISTS cohort_assets_dirty_delete",
+        "DROP TRIGGER IF EXISTS cohort_cash_flows_dirty_insert",
+        "DROP TRIGGER IF EXISTS cohort_cash_flows_dirty_update",
+        "DROP TRIGGER IF EXISTS cohort_cash_flows_dirty_delete",
+    ],
+]
+
+# Tables that are saved in a checkpoint, with the columns that are saved.
+# Each table has a checkpoint_<table> copy with a leading checkpoint_id column.
+CHECKPOINT_TABLES = {
+    "assets": "asset_id, asset, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount, latest_price, latest_price_date",
+    "cohort_data": "month, account, deposit, withdrawal, capital, active_base, closed_return, transfer_net",
+    "cohort_assets": "month, asset_id, account, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount",
+    "cohort_cash_flows": "cohort_month, account, transaction_month, amount",
+}
+
+# Tables whose changes make a cohort dirty for StatCalculator.update_stats, with their cohort month column
+DIRTY_COHORT_TABLES = {
+    "cohort_data": "month",
+    "cohort_assets": "month",
+    "cohort_cash_flows": "cohort_month",
+}
+
+# PRAGMAs set by DatabaseHandler.connect for each connection profile
+CONNECTION_PROFILES = {
+    # SQLite defaults, every commit is synced to disk. The journal mode is stored in the database file,
+    # so it is set back to the rollback journal after a bulk connection switched the file to WAL.
+    "safe": {
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+    },
+    # Imports and replays. WAL journaling with synchronous=NORMAL only syncs at WAL checkpoints, a commit can be lost
+    # on power failure but the database stays consistent. 64 MiB page cache, temporary tables in memory and 256 MiB of memory mapped I/O.
+    # The journal mode is stored in the database file until a safe connection sets it back.
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "temp_store": "MEMORY",
+        "mmap_size": 268435456,
+    },
+}
+
 class DatabaseHandler:
     """
     A class that handles connection to a sqllite3 database.
     """
 
-    def __init__(self, db_file: str):
+    def __init__(self, db_file: str, profile: str = "safe"):
         """
         Parameters:
         db_file (str): Path to the database file.
+        profile (str): Connection profile, a key of CONNECTION_PROFILES.
         """
+        if profile not in CONNECTION_PROFILES:
+            raise Exception("Unknown connection profile {}.".format(profile))
         self.db_file = db_file
+        self.profile = profile
         self.conn = None
+        # Number of active bulk() blocks, commits are deferred while it is above 0
+        self._bulk_depth = 0
+        # The connection is kept open until disconnect is called
         self.connect()
         self.tables = self.create_tables()
-        self.disconnect()
 
     def connect(self) -> None:
         """
-        Connects to the database with PARSE_DECLTYPES and PARSE_COLNAMES enabled.
+        Connects to the database with PARSE_DECLTYPES and PARSE_COLNAMES enabled and sets the PRAGMAs of the connection profile.
+        An open connection is reused.
         """
+        if self.conn:
+            return
         # PARSE_DECLTYPES is used to convert sqlite3 date objects to python datetime objects
         # https://docs.python.org/3/library/sqlite3.html#sqlite3.PARSE_DECLTYPES
         # PARSE_COLNAMES is used to access columns by name
         # https://docs.python.org/3/library/sqlite3.html#sqlite3.PARSE_COLNAMES
         self.conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        for pragma, value in CONNECTION_PROFILES[self.profile].items():
+            # PRAGMA does not accept parameters, the values are constants from CONNECTION_PROFILES
+            self.conn.execute("PRAGMA {} = {}".format(pragma, value))
 
     def disconnect(self) -> None:
         """
-        Disconnects from the database. Sets self.conn to None.
+        Disconnects from the database. Sets self.conn to None. Inside a bulk() block the connection is kept open.
         """
-        if self.conn:
+        if self.conn and not self._bulk_depth:
             self.conn.close()
             self.conn = None
 
     def commit(self) -> None:
         """
         Commits changes to the database. Raises exception if no connection is established.
+        Inside a bulk() block the commit is deferred to the end of the block.
         """
         if self.conn:
-            self.conn.commit()
+            if not self._bulk_depth:
+                self.conn.commit()
         else:
             raise Exception("Cannot commit changes, database connection not established.")
+
+    @contextmanager
+    def bulk(self):
+        """
+        Context manager that batches all commits inside it into one transaction, committed when the block ends.
+        The changes are rolled back if the block raises. Nested blocks join the outermost one.
+
+        Example:
+        with db.bulk():
+            data_parser.process_transactions()
+            db.set_metadata("last_processed", now)
+        """
+        self.connect()
+        self._bulk_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._bulk_depth -= 1
+            if not self._bulk_depth:
+                self.conn.rollback()
+            raise
+        self._bulk_depth -= 1
+        if not self._bulk_depth:
+            self.conn.commit()
         
     def get_cursor(self) -> sqlite3.Cursor:
         """
@@ -69,7 +373,9 @@ class DatabaseHandler:
 
     def create_tables(self) -> list:
         """
-        Creates transaction tables in the database if they do not exist. Raises exception if no connection is established.
+        Creates transaction tables in the database if they do not exist and applies MIGRATIONS.
+        Nothing is executed if PRAGMA user_version shows that the schema is up to date.
+        Raises exception if no connection is established.
 
         Returns:
         list: List of tables in the database (wether existing or created).
@@ -79,8 +385,8 @@ class DatabaseHandler:
 
         cursor = self.conn.cursor()
 
-        # Enable foreign key support, used by cohort_assets table to reference assets and cohort_data
-        cursor.execute("PRAGMA foreign_keys = ON;")
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return self.get_tables()
 
         # transactions contains all raw transactions
         cursor.execute("""
@@ -95,7 +401,8 @@ class DatabaseHandler:
                 courtage REAL NOT NULL,
                 currency TEXT NOT NULL,
                 isin TEXT NOT NULL,
-                processed INT DEFAULT 0
+                processed INT DEFAULT 0,
+                natural_key TEXT
                 )""")
 
         # cohort_data contains the capital, deposits and withdrawals per account per month
@@ -172,68 +479,84 @@ class DatabaseHandler:
                 value TEXT
                 );""")
         
-        # cohort_stats contains statistics about capital transfers and gain/loss for each month
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS cohort_stats(
-                month DATE NOT NULL,
-                deposit REAL DEFAULT 0,
-                withdrawal REAL DEFAULT 0,
-                capital REAL DEFAULT 0,
-                value REAL DEFAULT 0,
-                total_gainloss REAL DEFAULT 0,
-                realized_gainloss REAL DEFAULT 0,
-                unrealized_gainloss REAL DEFAULT 0,
-                total_gainloss_per REAL DEFAULT 0,
-                realized_gainloss_per REAL DEFAULT 0,
-                unrealized_gainloss_per REAL DEFAULT 0,
-                annual_per_yield REAL DEFAULT NULL,
-                acc_deposit REAL DEFAULT 0,
-                acc_value REAL DEFAULT 0,
-                acc_withdrawal REAL DEFAULT 0,
-                acc_net_deposit REAL DEFAULT 0,
-                acc_total_gainloss REAL DEFAULT 0,
-                acc_realized_gainloss REAL DEFAULT 0,
-                acc_unrealized_gainloss REAL DEFAULT 0,
-                PRIMARY KEY(month)
-                );""")
-        
-        # year_stats contains statistics about capital transfers and gain/loss for each year
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS year_stats(
-                year DATE NOT NULL,
-                deposit REAL DEFAULT 0,
-                withdrawal REAL DEFAULT 0,
-                capital REAL DEFAULT 0,
-                value REAL DEFAULT 0,
-                total_gainloss REAL DEFAULT 0,
-                realized_gainloss REAL DEFAULT 0,
-                unrealized_gainloss REAL DEFAULT 0,
-                total_gainloss_per REAL DEFAULT 0,
-                realized_gainloss_per REAL DEFAULT 0,
-                unrealized_gainloss_per REAL DEFAULT 0,
-                annual_per_yield REAL DEFAULT NULL,
-                acc_deposit REAL DEFAULT 0,
-                acc_value REAL DEFAULT 0,
-                acc_withdrawal REAL DEFAULT 0,
-                acc_net_deposit REAL DEFAULT 0,
-                acc_total_gainloss REAL DEFAULT 0,
-                acc_realized_gainloss REAL DEFAULT 0,
-                acc_unrealized_gainloss REAL DEFAULT 0,
-                PRIMARY KEY(year)
-                );""")
-
         # Migrate: add transfer_net column if missing (existing databases)
         try:
             cursor.execute("ALTER TABLE cohort_data ADD COLUMN transfer_net REAL DEFAULT 0")
         except Exception:
             pass  # Column already exists
 
+        # Migrate: add natural_key column if missing (existing databases)
+        try:
+            cursor.execute("ALTER TABLE transactions ADD COLUMN natural_key TEXT")
+        except Exception:
+            pass  # Column already exists
+        self.backfill_natural_keys(cursor)
+        # Unique index used by add_data to skip transactions that have already been imported
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS transactions_natural_key ON transactions(natural_key)")
+
+        self.migrate(cursor)
+
         self.conn.commit()
 
-        # Return a list of tables in the database
+        return self.get_tables()
+
+    def get_tables(self) -> list:
+        """
+        Returns:
+        list: List of tables in the database.
+        """
+        cursor = self.get_cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         return [table[0] for table in cursor.fetchall()]
 
+    def migrate(self, cursor: sqlite3.Cursor = None) -> int:
+        """
+        Applies the migrations in MIGRATIONS that have not been applied to the database yet and updates PRAGMA user_version.
+        Does not commit.
+
+        Parameters:
+        cursor (sqlite3.Cursor, optional): Cursor to use. If None, a new cursor is created.
+
+        Returns:
+        int: The schema version of the database after migrating.
+        """
+        if cursor is None:
+            cursor = self.get_cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                cursor.execute(statement)
+            # PRAGMA does not accept parameters, version is always an int
+            cursor.execute("PRAGMA user_version = {:d}".format(version))
+        return version
+
+    def backfill_natural_keys(self, cursor: sqlite3.Cursor) -> int:
+        """
+        Sets natural_key for transactions that do not have one, e.g. transactions added before the column existed.
+        Identical transactions get increasing occurrence numbers in rowid order.
+
+        Parameters:
+        cursor (sqlite3.Cursor): Cursor to use for the update.
+
+        Returns:
+        int: Number of transactions that were updated.
+        """
+        missing = cursor.execute("SELECT date, account, transaction_type, asset_name, amount, price, rowid FROM transactions WHERE natural_key IS NULL ORDER BY rowid").fetchall()
+        if not missing:
+            return 0
+        existing_keys = {key for (key,) in cursor.execute("SELECT natural_key FROM transactions WHERE natural_key IS NOT NULL")}
+        updates = []
+        for row in missing:
+            occurrence = 0
+            key = transaction_key(row, occurrence)
+            while key in existing_keys:
+                occurrence += 1
+                key = transaction_key(row, occurrence)
+            existing_keys.add(key)
+            updates.append((key, row[-1]))
+        cursor.executemany("UPDATE transactions SET natural_key = ? WHERE rowid = ?", updates)
+        return len(updates)
+
     def reset_table(self, table: str) -> int:
         """
         Deletes all rows from the specified table. Raises exception if the table does not exist.
@@ -358,7 +681,7 @@ class DatabaseHandler:
             "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
             (key, value)
         )
-        self.conn.commit()
+        self.commit()
 
     def get_metadata(self, key: str, default: str = None) -> str:
         """
@@ -409,7 +732,7 @@ class DatabaseHandler:
             "INSERT OR REPLACE INTO accounts (account_id, nickname) VALUES (?, ?)",
             (account_id, nickname)
         )
-        self.conn.commit()
+        self.commit()
 
     def get_account_nickname(self, account_id: str) -> str:
         """
@@ -444,7 +767,7 @@ class DatabaseHandler:
         
         cursor = self.conn.cursor()
         cursor.execute("DELETE FROM accounts WHERE account_id = ?", (account_id,))
-        self.conn.commit()
+        self.commit()
         return cursor.rowcount > 0
 
     def get_all_account_nicknames(self) -> dict:
@@ -0,0 +1,651 @@
+import sqlite3
+import logging
+
+from bisect import bisect_left
+from data_parser import TransactionScheduler
+from database_handler import CHECKPOINT_TABLES
+
+# Column positions in the in-memory cohort_data rows
+DEPOSIT, WITHDRAWAL, CAPITAL, ACTIVE_BASE, CLOSED_RETURN, TRANSFER_NET = range(6)
+# Column positions in the in-memory cohort_assets rows (lots)
+AMOUNT, AVERAGE_PRICE, AVERAGE_PURCHASE_PRICE, AVERAGE_SALE_PRICE, PURCHASED_AMOUNT, SOLD_AMOUNT = range(6)
+# Column positions in the in-memory assets rows
+ASSET_NAME, ASSET_AMOUNT, LATEST_PRICE, LATEST_PRICE_DATE = 0, 1, 7, 8
+
+
+class LotEngine:
+    """
+    In-memory FIFO lot engine used by DataParser.process_transactions(in_memory=True).
+
+    The engine loads cohort_data, cohort_assets, cohort_cash_flows and assets once, runs the same
+    handlers as DataParser against Python dicts and sorted month indexes instead of issuing SQL per lot,
+    and writes the final state back with executemany in a single transaction.
+    The handlers mirror the DataParser handlers statement for statement so both modes produce the same results.
+    """
+    def __init__(self, data_parser):
+        """
+        Parameters:
+        data_parser (DataParser): The DataParser whose database the engine reads from and writes to.
+        """
+        self.data_parser = data_parser
+        self.db = data_parser.db
+        self.allocate_to_month = data_parser.allocate_to_month
+        self.profiler = data_parser.profiler
+        self.listing_change = {"to_asset":None,"to_asset_amount":None,"to_rowid":None}
+        self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+        self.scheduler = TransactionScheduler(data_parser)
+        # (month, account) -> [deposit, withdrawal, capital, active_base, closed_return, transfer_net]
+        self.cohorts = {}
+        # account -> sorted list of months with capital > 0
+        self.capital_months = {}
+        # (month, asset_id, account) -> [amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount]
+        self.lots = {}
+        # (account, asset_id) -> sorted list of months with amount > 0
+        self.asset_months = {}
+        # (month, account) -> sorted list of asset_ids with amount > 0 in that cohort, the holdings valued by cohort_value
+        self.held_assets = {}
+        # asset_id -> list of (month, asset_id, account) lot keys of that asset
+        self.asset_lots = {}
+        # asset_id -> [asset, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount, latest_price, latest_price_date]
+        self.assets = {}
+        self.asset_ids = {}
+        # (cohort_month, account, transaction_month) -> amount
+        self.cash_flows = {}
+        # (asset_id, date, price) rows to append to asset_prices
+        self.prices = []
+        # (month, {table: rows}) checkpoints to write, rows in the column order of CHECKPOINT_TABLES
+        self.checkpoints = []
+        self._dirty_cohorts = set()
+        self._dirty_lots = set()
+        self._dirty_assets = set()
+        self._dirty_cash_flows = set()
+
+    def load(self, checkpoint_id: int = None) -> None:
+        """
+        Loads the current cohort, lot, cash flow and asset state from the database.
+
+        Parameters:
+        checkpoint_id (int): Load the state saved by this checkpoint instead, see DataParser.checkpoint.
+        """
+        cur = self.db.get_cursor()
+        prefix, where, params = "", "", ()
+        if checkpoint_id is not None:
+            prefix, where, params = "checkpoint_", " WHERE checkpoint_id = ? ORDER BY rowid", (checkpoint_id,)
+        for (month, account, *values) in cur.execute(f"SELECT month, account, deposit, withdrawal, capital, active_base, closed_return, transfer_net FROM {prefix}cohort_data{where}", params):
+            self.cohorts[(month, account)] = values
+            self._track(self.capital_months, account, month, values[CAPITAL] > 0)
+        for (month, asset_id, account, *values) in cur.execute(f"SELECT month, asset_id, account, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount FROM {prefix}cohort_assets{where}", params):
+            self._add_lot(month, asset_id, account, values)
+        for (cohort_month, account, transaction_month, amount) in cur.execute(f"SELECT cohort_month, account, transaction_month, amount FROM {prefix}cohort_cash_flows{where}", params):
+            self.cash_flows[(cohort_month, account, transaction_month)] = amount
+        for (asset_id, *values) in cur.execute(f"SELECT asset_id, asset, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount, latest_price, latest_price_date FROM {prefix}assets{where}", params):
+            self.assets[asset_id] = values
+            self.asset_ids[values[ASSET_NAME]] = asset_id
+
+    def flush(self) -> None:
+        """
+        Writes all changed cohorts, lots, cash flows and assets, the recorded prices and the processed flags back to the database
+        using one executemany per table. Rows are written in creation order so new rows get the same rowids
+        as when processing with SQL. Does not commit.
+        """
+        cur = self.db.get_cursor()
+        cur.executemany("""
+            INSERT INTO assets(asset_id, asset, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount, latest_price, latest_price_date)
+            VALUES (?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(asset_id) DO UPDATE SET asset = excluded.asset, amount = excluded.amount,
+                latest_price = excluded.latest_price, latest_price_date = excluded.latest_price_date
+        """, [(asset_id, *self.assets[asset_id]) for asset_id in sorted(self._dirty_assets)])
+        cur.executemany("""
+            INSERT INTO cohort_data(month, account, deposit, withdrawal, capital, active_base, closed_return, transfer_net)
+            VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT(month, account) DO UPDATE SET deposit = excluded.deposit, withdrawal = excluded.withdrawal,
+                capital = excluded.capital, active_base = excluded.active_base,
+                closed_return = excluded.closed_return, transfer_net = excluded.transfer_net
+        """, [(*key, *self.cohorts[key]) for key in self.cohorts if key in self._dirty_cohorts])
+        cur.executemany("""
+            INSERT INTO cohort_assets(month, asset_id, account, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount)
+            VALUES (?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(month, asset_id, account) DO UPDATE SET amount = excluded.amount,
+                average_price = excluded.average_price, average_purchase_price = excluded.average_purchase_price,
+                average_sale_price = excluded.average_sale_price, purchased_amount = excluded.purchased_amount,
+                sold_amount = excluded.sold_amount
+        """, [(*key, *self.lots[key]) for key in self.lots if key in self._dirty_lots])
+        cur.executemany("""
+            INSERT INTO cohort_cash_flows(cohort_month, account, transaction_month, amount)
+            VALUES (?,?,?,?)
+            ON CONFLICT(cohort_month, account, transaction_month) DO UPDATE SET amount = excluded.amount
+        """, [(*key, self.cash_flows[key]) for key in self.cash_flows if key in self._dirty_cash_flows])
+        cur.executemany("INSERT INTO asset_prices(asset_id, date, price, source) VALUES (?,?,?,'transaction')", self.prices)
+        for month, tables in self.checkpoints:
+            cur.execute("INSERT INTO checkpoints(date) VALUES (?)", (month,))
+            checkpoint_id = cur.lastrowid
+            for table, columns in CHECKPOINT_TABLES.items():
+                placeholders = ",".join("?" * (columns.count(",") + 2))
+                cur.executemany(f"INSERT INTO checkpoint_{table}(checkpoint_id, {columns}) VALUES ({placeholders})",
+                                [(checkpoint_id, *row) for row in tables[table]])
+        cur.executemany("UPDATE transactions SET processed = 1 WHERE rowid = ?", [(rowid,) for rowid in sorted(self.scheduler.processed)])
+
+    def changed_cohorts(self) -> set:
+        """
+        Returns:
+        set: (month, account) of the cohorts whose cohort_data, cohort_assets or cohort_cash_flows rows are written by flush.
+        """
+        return (self._dirty_cohorts
+                | {(month, account) for month, _, account in self._dirty_lots}
+                | {(cohort_month, account) for cohort_month, account, _ in self._dirty_cash_flows})
+
+    def checkpoint(self, month) -> None:
+        """
+        See DataParser.checkpoint. The state is copied in memory and written by flush.
+        Dicts keep creation order, which is the rowid order of the tables.
+        """
+        if not self.data_parser.should_checkpoint(month):
+            return
+        self.checkpoints.append((month, {
+            "assets": [(asset_id, *values) for asset_id, values in self.assets.items()],
+            "cohort_data": [(*key, *values) for key, values in self.cohorts.items()],
+            "cohort_assets": [(*key, *values) for key, values in self.lots.items()],
+            "cohort_cash_flows": [(*key, amount) for key, amount in self.cash_flows.items()],
+        }))
+
+    def run(self, rows: list) -> list:
+        """
+        Processes rows with the same TransactionScheduler as DataParser.process_transactions.
+
+        Parameters:
+        rows (list): Unprocessed rows from the transactions table ordered by date and rowid, with rowid as the last element.
+
+        Returns:
+        list: Rows that could not be processed.
+        """
+        return self.scheduler.run(self, rows)
+
+    @staticmethod
+    def _track(index: dict, key, value, available: bool) -> None:
+        """
+        Keeps index[key] as a sorted list of the values, months or asset_ids, for which available is True.
+        """
+        values = index.setdefault(key, [])
+        i = bisect_left(values, value)
+        present = i < len(values) and values[i] == value
+        if available and not present:
+            values.insert(i, value)
+        elif not available and present:
+            del values[i]
+
+    def _add_lot(self, month, asset_id, account, values: list) -> list:
+        self.lots[(month, asset_id, account)] = values
+        self.asset_lots.setdefault(asset_id, []).append((month, asset_id, account))
+        self._track(self.asset_months, (account, asset_id), month, values[AMOUNT] > 0)
+        self._track(self.held_assets, (month, account), asset_id, values[AMOUNT] > 0)
+        return values
+
+    def _cohort(self, month, account) -> list:
+        """
+        Equivalent of INSERT OR IGNORE INTO cohort_data(month, account). Returns the cohort row.
+        """
+        key = (month, account)
+        cohort = self.cohorts.get(key)
+        if cohort is None:
+            cohort = self.cohorts[key] = [0.0, 0.0, 0.0, 0.0, None, 0.0]
+        self._dirty_cohorts.add(key)
+        return cohort
+
+    def _add_capital(self, month, account, amount: float) -> None:
+        """
+        Equivalent of UPDATE cohort_data SET capital = capital + ? WHERE month = ? AND account = ?.
+        """
+        cohort = self.cohorts.get((month, account))
+        if cohort is not None:
+            cohort[CAPITAL] = cohort[CAPITAL] + amount
+            self._dirty_cohorts.add((month, account))
+            self._track(self.capital_months, account, month, cohort[CAPITAL] > 0)
+
+    def _lot(self, month, asset_id, account) -> list:
+        """
+        Equivalent of INSERT OR IGNORE INTO cohort_assets(month, asset_id, account). Returns the lot row.
+        """
+        key = (month, asset_id, account)
+        lot = self.lots.get(key)
+        if lot is None:
+            lot = self._add_lot(month, asset_id, account, [0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        self._dirty_lots.add(key)
+        return lot
+
+    def _set_lot_amount(self, month, asset_id, account, lot: list, amount: float) -> None:
+        lot[AMOUNT] = amount
+        self._dirty_lots.add((month, asset_id, account))
+        self._track(self.asset_months, (account, asset_id), month, amount > 0)
+        self._track(self.held_assets, (month, account), asset_id, amount > 0)
+
+    def _add_cash_flow(self, cohort_month, account, transaction_month, amount: float) -> None:
+        key = (cohort_month, account, transaction_month)
+        self.cash_flows[key] = self.cash_flows[key] + amount if key in self.cash_flows else amount
+        self._dirty_cash_flows.add(key)
+
+    def _asset_id(self, asset: str) -> int:
+        """
+        Equivalent of INSERT OR IGNORE INTO assets (asset) followed by SELECT asset_id.
+        """
+        asset_id = self.asset_ids.get(asset)
+        if asset_id is None:
+            asset_id = max(self.assets, default=0) + 1
+            self.assets[asset_id] = [asset, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, None, None]
+            self.asset_ids[asset] = asset_id
+            self._dirty_assets.add(asset_id)
+        return asset_id
+
+    def _set_latest_price(self, asset_id: int, price: float, date) -> None:
+        self.assets[asset_id][LATEST_PRICE] = price
+        self.assets[asset_id][LATEST_PRICE_DATE] = date
+        self._dirty_assets.add(asset_id)
+
+    def _record_price(self, asset_id: int, price: float, date) -> None:
+        self.prices.append((asset_id, date, price))
+
+    def cohort_value(self, cohort_month, account: str) -> float:
+        """
+        See DataParser.cohort_value. Only the lots in held_assets are visited, in asset_id order like the SQL SUM.
+        """
+        cohort = self.cohorts.get((cohort_month, account))
+        cash = cohort[CAPITAL] if cohort else 0.0
+        asset_value = 0
+        for asset_id in self.held_assets.get((cohort_month, account), ()):
+            lot = self.lots[(cohort_month, asset_id, account)]
+            latest_price = self.assets[asset_id][LATEST_PRICE]
+            asset_value += lot[AMOUNT] * (latest_price if latest_price is not None else lot[AVERAGE_PRICE])
+        return cash + asset_value
+
+    def available_capital(self, account: str) -> list:
+        """
+        See DataParser.available_capital.
+        """
+        res = [(month, self.cohorts[(month, account)][CAPITAL]) for month in self.capital_months.get(account, ())]
+        return res if res else [(None, 0)]
+
+    def available_asset(self, asset_id: int, account: str) -> list:
+        """
+        See DataParser.available_asset.
+        """
+        res = [(month, self.lots[(month, asset_id, account)][AMOUNT]) for month in self.asset_months.get((account, asset_id), ())]
+        return res if res else [(None,0)]
+
+    def handle_deposit(self, row: tuple) -> None:
+        """
+        See DataParser.handle_deposit.
+        """
+        month = self.allocate_to_month(row[0])
+        amount = row[6]
+        account = row[1]
+        cohort = self._cohort(month, account)
+        cohort[DEPOSIT] = cohort[DEPOSIT] + amount
+        cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] + amount
+        self._add_capital(month, account, amount)
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
+
+    def handle_withdrawal(self, row: tuple) -> None:
+        """
+        See DataParser.handle_withdrawal.
+        """
+        total_amount = -row[6]
+        remaining_amount = total_amount
+        account = row[1]
+        transaction_month = self.allocate_to_month(row[0])
+
+        month_capital = self.available_capital(account)
+        total_capital = sum(e[1] for e in month_capital)
+        if total_capital + 1e-4 >= total_amount:
+            i = 0
+            while remaining_amount > 1e-4:
+                (oldest_available,capital) = month_capital[i]
+                month_amount = min(remaining_amount,capital)
+                cohort = self.cohorts[(oldest_available, account)]
+
+                cv = self.cohort_value(oldest_available, account)
+                if cv > 1e-4:
+                    r = month_amount / cv
+                    r = min(r, 1.0)
+                    if r >= 1.0 - 1e-6:
+                        ab = cohort[ACTIVE_BASE] if cohort[ACTIVE_BASE] else 0.0
+                        if ab > 1e-4:
+                            cohort[CLOSED_RETURN] = cv / ab
+                    cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] * (1 - r)
+
+                cohort[WITHDRAWAL] = cohort[WITHDRAWAL] + month_amount
+                self._add_capital(oldest_available, account, -month_amount)
+                self._add_cash_flow(oldest_available, account, transaction_month, -month_amount)
+
+                remaining_amount -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_withdrawal", i)
+            self.scheduler.mark_processed(row[-1])
+        else:
+            self.scheduler.defer(("capital", account), row)
+
+    def handle_purchase(self, row: tuple) -> None:
+        """
+        See DataParser.handle_purchase.
+        """
+        asset = row[3]
+        account = row[1]
+        asset_id = self._asset_id(asset)
+        asset_amount = row[4]
+        price = row[5]
+        total_amount = -row[6]
+        self._set_latest_price(asset_id, price, row[0])
+        remaining_amount = total_amount
+        month_capital = self.available_capital(account)
+        total_capital = sum(e[1] for e in month_capital)
+        if total_capital + 1e-3 >= total_amount:
+            i = 0
+            while remaining_amount > 1e-3:
+                (oldest_available,capital) = month_capital[i]
+                month_amount = min(remaining_amount,capital)
+                month_asset_amount = month_amount / total_amount * asset_amount
+                self._add_capital(oldest_available, account, -month_amount)
+                lot = self._lot(oldest_available, asset_id, account)
+                lot[AVERAGE_PRICE] = month_amount/(lot[AMOUNT]+month_amount)*price+lot[AMOUNT]/(lot[AMOUNT]+month_amount)*lot[AVERAGE_PRICE]
+                lot[AVERAGE_PURCHASE_PRICE] = month_amount/(lot[PURCHASED_AMOUNT]+month_amount)*price+lot[PURCHASED_AMOUNT]/(lot[PURCHASED_AMOUNT]+month_amount)*lot[AVERAGE_PURCHASE_PRICE]
+                lot[PURCHASED_AMOUNT] = lot[PURCHASED_AMOUNT] + month_asset_amount
+                self._set_lot_amount(oldest_available, asset_id, account, lot, lot[AMOUNT] + month_asset_amount)
+                remaining_amount -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_purchase", i)
+            self._record_price(asset_id, price, row[0])
+            self.scheduler.mark_processed(row[-1])
+            self.scheduler.release(("asset", account, asset))
+        else:
+            self.scheduler.defer(("capital", account), row)
+
+    def handle_sale(self, row: tuple) -> None:
+        """
+        See DataParser.handle_sale.
+        """
+        asset = row[3]
+        account = row[1]
+        asset_id = self._asset_id(asset)
+        asset_amount = -row[4]
+        price = row[5]
+        total_amount = row[6]
+        self._set_latest_price(asset_id, price, row[0])
+        remaining_amount = asset_amount
+        month_asset_amounts = self.available_asset(asset_id, account)
+
+        total_asset_amount = sum(e[1] for e in month_asset_amounts)
+
+        # Retroactively inject the sale amount as a deposit for shares with 0 average purchase price
+        for (oldest_available, amount) in month_asset_amounts:
+            lot = self.lots.get((oldest_available, asset_id, account))
+            if lot is not None and lot[AVERAGE_PURCHASE_PRICE] == 0.0:
+                proportionate_sale_amount = (amount / asset_amount) * total_amount if asset_amount > 0 else 0
+                if proportionate_sale_amount > 0:
+                    cohort = self.cohorts.get((oldest_available, account))
+                    if cohort is not None:
+                        cohort[DEPOSIT] = cohort[DEPOSIT] + proportionate_sale_amount
+                        cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] + proportionate_sale_amount
+                        self._dirty_cohorts.add((oldest_available, account))
+                    lot[AVERAGE_PURCHASE_PRICE] = proportionate_sale_amount / amount
+                    self._dirty_lots.add((oldest_available, asset_id, account))
+
+        if total_asset_amount + 1e-3 >= asset_amount:
+            i = 0
+            while remaining_amount > 1e-3:
+                (oldest_available,amount) = month_asset_amounts[i]
+                month_amount = min(remaining_amount,amount)
+                month_capital_amount = month_amount / asset_amount * total_amount
+                lot = self.lots[(oldest_available, asset_id, account)]
+                lot[AVERAGE_SALE_PRICE] = month_amount/(lot[SOLD_AMOUNT]+month_amount)*price+lot[SOLD_AMOUNT]/(lot[SOLD_AMOUNT]+month_amount)*lot[AVERAGE_SALE_PRICE]
+                lot[SOLD_AMOUNT] = lot[SOLD_AMOUNT] + month_amount
+                self._set_lot_amount(oldest_available, asset_id, account, lot, lot[AMOUNT] - month_amount)
+                self._cohort(oldest_available, account)
+                self._add_capital(oldest_available, account, month_capital_amount)
+                remaining_amount -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_sale", i)
+            self._record_price(asset_id, price, row[0])
+            self.scheduler.mark_processed(row[-1])
+            self.scheduler.release(("capital", account))
+        else:
+            self.scheduler.defer(("asset", account, asset), row)
+
+    def handle_dividend(self, row: tuple) -> None:
+        """
+        See DataParser.handle_dividend.
+        """
+        dividend_month = self.allocate_to_month(row[0])
+        account = row[1]
+        asset_id = self._asset_id(row[3])
+        remaining_amount = row[4]
+        dividend_per_asset = row[5]
+        month_asset_amounts = self.available_asset(asset_id, account)
+        for (month,asset_amount) in month_asset_amounts:
+            # A month of None is skipped, like INSERT OR IGNORE does with the NOT NULL constraint
+            if month is not None:
+                self._cohort(month, account)
+                self._add_capital(month, account, asset_amount*dividend_per_asset)
+            remaining_amount -= asset_amount
+        if remaining_amount > 0:
+            self._cohort(dividend_month, account)
+            self._add_capital(dividend_month, account, remaining_amount*dividend_per_asset)
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
+
+    def handle_interest(self, row: tuple) -> None:
+        """
+        See DataParser.handle_interest.
+        """
+        dividend_month = self.allocate_to_month(row[0])
+        account = row[1]
+        remaining_amount = row[6]
+        month_capital = self.available_capital(account)
+        total_capital = sum([month[1] for month in month_capital])
+        dividend_per_capital = remaining_amount / total_capital
+        for (month, capital) in month_capital:
+            amount_added = capital * dividend_per_capital
+            self._cohort(month, account)
+            self._add_capital(month, account, amount_added)
+            remaining_amount -= amount_added
+        if remaining_amount > 0:
+            self._cohort(dividend_month, account)
+            self._add_capital(dividend_month, account, remaining_amount)
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", account))
+
+    def handle_fees(self, row: tuple) -> None:
+        """
+        See DataParser.handle_fees.
+        """
+        total_amount = -row[6]
+        remaining_amount = total_amount
+        account = row[1]
+        transaction_month = self.allocate_to_month(row[0])
+
+        month_capital = self.available_capital(account)
+        total_capital = sum(e[1] for e in month_capital)
+        if total_capital + 1e-4 >= total_amount:
+            i = 0
+            while remaining_amount > 1e-4:
+                (oldest_available,capital) = month_capital[i]
+                month_amount = min(remaining_amount,capital)
+                self._add_capital(oldest_available, account, -month_amount)
+                self._add_cash_flow(oldest_available, account, transaction_month, -month_amount)
+                remaining_amount -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_fees", i)
+            self.scheduler.mark_processed(row[-1])
+        else:
+            self.scheduler.defer(("capital", account), row)
+
+    def handle_listing_change(self, row: tuple) -> None:
+        """
+        See DataParser.handle_listing_change.
+        """
+        if self.listing_change["to_asset"] is None:
+            self.listing_change["to_asset"] = row[3]
+            self.listing_change["to_asset_amount"] = row[4]
+            self.listing_change["to_rowid"] = row[-1]
+        else:
+            asset = row[3]
+            amount = -row[4]
+            asset_id = self.asset_ids[asset]
+            to_asset = self.listing_change["to_asset"]
+            if to_asset in self.asset_ids and self.asset_ids[to_asset] != asset_id:
+                raise sqlite3.IntegrityError("UNIQUE constraint failed: assets.asset")
+            del self.asset_ids[asset]
+            self.asset_ids[to_asset] = asset_id
+            self.assets[asset_id][ASSET_NAME] = to_asset
+            self.assets[asset_id][ASSET_AMOUNT] = self.listing_change["to_asset_amount"]
+            self._dirty_assets.add(asset_id)
+            change_factor = self.listing_change["to_asset_amount"]/amount
+            for (month, _, account) in self.asset_lots.get(asset_id, ()):
+                lot = self.lots[(month, asset_id, account)]
+                self._set_lot_amount(month, asset_id, account, lot, lot[AMOUNT] * change_factor)
+            self.scheduler.mark_processed(row[-1], self.listing_change["to_rowid"])
+            for account in sorted({account for (_, _, account) in self.asset_lots.get(asset_id, ())}):
+                self.scheduler.release(("asset", account, to_asset))
+            self.listing_change = {"to_asset":None,"to_asset_amount":None,"to_rowid":None}
+
+    def handle_asset_deposit(self, row: tuple) -> None:
+        """
+        See DataParser.handle_asset_deposit.
+        """
+        month = self.allocate_to_month(row[0])
+        account = row[1]
+        asset = row[3]
+        amount = row[4]
+        price = row[5]
+        asset_id = self._asset_id(asset)
+        self._set_latest_price(asset_id, price, row[0])
+        self._record_price(asset_id, price, row[0])
+        lot = self._lot(month, asset_id, account)
+        lot[AVERAGE_PRICE] = (amount * price + lot[AMOUNT] * lot[AVERAGE_PRICE]) / (lot[AMOUNT] + amount)
+        lot[AVERAGE_PURCHASE_PRICE] = (amount * price + lot[PURCHASED_AMOUNT] * lot[AVERAGE_PURCHASE_PRICE]) / (lot[PURCHASED_AMOUNT] + amount)
+        self._set_lot_amount(month, asset_id, account, lot, lot[AMOUNT] + amount)
+        cohort = self._cohort(month, account)
+        cohort[DEPOSIT] = cohort[DEPOSIT] + amount*price
+        cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] + amount*price
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("asset", account, asset))
+
+    def handle_ignore(self, row: tuple) -> None:
+        """
+        See DataParser.handle_ignore.
+        """
+        logging.debug(f"Ignoring transaction {row[0]} {row[2]} {row[3]} with amount {row[6]}")
+        self.scheduler.mark_processed(row[-1])
+
+    def handle_internal_transfer(self, row: tuple) -> None:
+        """
+        See DataParser.handle_internal_transfer.
+        """
+        if row[6] > 0 and "Insättning från" in str(row[3]):
+            self.handle_deposit(row)
+            return
+
+        if self.pending_transfer["rowid"] is None:
+            self.pending_transfer["rowid"] = row[-1]
+            self.pending_transfer["account"] = row[1]
+            self.pending_transfer["amount"] = row[6]
+            self.pending_transfer["date"] = row[0]
+            self.pending_transfer["row"] = row
+            return
+
+        first_row = self.pending_transfer["row"]
+        first_rowid = self.pending_transfer["rowid"]
+        second_rowid = row[-1]
+
+        if self.pending_transfer["amount"] < 0:
+            out_account = self.pending_transfer["account"]
+            out_amount = -self.pending_transfer["amount"]
+            out_date = self.pending_transfer["date"]
+            in_account = row[1]
+            in_date = row[0]
+        else:
+            out_account = row[1]
+            out_amount = -row[6]
+            out_date = row[0]
+            in_account = self.pending_transfer["account"]
+            in_date = self.pending_transfer["date"]
+
+        month_capital = self.available_capital(out_account)
+        total_capital = sum(e[1] for e in month_capital)
+
+        if total_capital + 1e-4 >= out_amount:
+            allocations = []
+            remaining = out_amount
+            i = 0
+
+            out_transaction_month = self.allocate_to_month(out_date)
+
+            while remaining > 1e-4:
+                (oldest_available, capital) = month_capital[i]
+                month_amount = min(remaining, capital)
+                allocations.append((oldest_available, month_amount))
+                cohort = self.cohorts[(oldest_available, out_account)]
+
+                cv = self.cohort_value(oldest_available, out_account)
+                if cv > 1e-4:
+                    r = month_amount / cv
+                    r = min(r, 1.0)
+                    cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] * (1 - r)
+
+                cohort[TRANSFER_NET] = cohort[TRANSFER_NET] - month_amount
+                self._add_capital(oldest_available, out_account, -month_amount)
+                self._add_cash_flow(oldest_available, out_account, out_transaction_month, -month_amount)
+
+                remaining -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_internal_transfer", i)
+
+            in_transaction_month = self.allocate_to_month(in_date)
+            for oldest_available, amount in allocations:
+                cohort = self._cohort(oldest_available, in_account)
+                cohort[ACTIVE_BASE] = cohort[ACTIVE_BASE] + amount
+                cohort[TRANSFER_NET] = cohort[TRANSFER_NET] + amount
+                self._add_capital(oldest_available, in_account, amount)
+                self._add_cash_flow(oldest_available, in_account, in_transaction_month, amount)
+
+            self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+            self.scheduler.mark_processed(first_rowid, second_rowid)
+            self.scheduler.release(("capital", in_account))
+            logging.debug(f"Internal transfer pair processed: {out_amount} from {out_account} to {in_account}")
+        else:
+            logging.debug(
+                f"Internal transfer pair deferred: account {out_account} needs {out_amount}, has {total_capital}"
+            )
+            self.pending_transfer = {"rowid": None, "account": None, "amount": None, "date": None, "row": None}
+            self.scheduler.defer(("capital", out_account), first_row, row)
+
+    def handle_remove_shares(self, row: tuple) -> None:
+        """
+        See DataParser.handle_remove_shares.
+        """
+        asset = row[3]
+        account = row[1]
+        asset_id = self._asset_id(asset)
+        asset_amount = -row[4]
+        remaining_amount = asset_amount
+        month_asset_amounts = self.available_asset(asset_id, account)
+        total_asset_amount = sum(e[1] for e in month_asset_amounts)
+
+        if total_asset_amount + 1e-3 >= asset_amount:
+            i = 0
+            while remaining_amount > 1e-3:
+                (oldest_available, amount) = month_asset_amounts[i]
+                month_amount = min(remaining_amount, amount)
+                lot = self.lots[(oldest_available, asset_id, account)]
+                self._set_lot_amount(oldest_available, asset_id, account, lot, lot[AMOUNT] - month_amount)
+                remaining_amount -= month_amount
+                i += 1
+            if self.profiler is not None:
+                self.profiler.lot_walk("handle_remove_shares", i)
+            self.scheduler.mark_processed(row[-1])
+        else:
+            logging.warning(f"Not enough shares to remove for {asset}: have {total_asset_amount}, need {asset_amount}")
+            self.scheduler.defer(("asset", account, asset), row)
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Current working endpoint (discovered 2026-02-27)
+DEFAULT_URL = "https://www.avanza.se/_api/search/filtered-search"
+
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+    ),
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter. Holds up to capacity tokens that are refilled at rate tokens per second,
+    acquire() blocks until a token is available.
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        Parameters:
+        rate (float): Tokens added per second, i.e. the sustained request rate.
+        capacity (int): Maximum number of tokens, i.e. the largest burst of requests.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, waiting until one has been refilled if the bucket is empty."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PriceFetcher:
+    """
+    Fetches latest prices for many assets concurrently from the search endpoint.
+    Requests share one keep-alive session, at most concurrency requests are in flight and the request rate
+    is limited by a token bucket. Timeouts, connection errors and 5xx responses are retried with exponential backoff.
+    """
+    def __init__(self, url: str = DEFAULT_URL, concurrency: int = 8, rate: float = 20.0, burst: int = 4,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 10):
+        """
+        Parameters:
+        url (str): Search endpoint to post the asset name queries to.
+        concurrency (int): Maximum number of concurrent requests.
+        rate (float): Maximum sustained number of requests per second.
+        burst (int): Maximum number of requests sent at once before the rate limit applies.
+        retries (int): Number of retries after a timeout, connection error or 5xx response.
+        backoff (float): Delay in seconds before the first retry, doubled for every following retry.
+        timeout (float): Timeout in seconds of each request.
+        """
+        self.url = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+
+    @staticmethod
+    def parse_price(resp: dict, asset: str):
+        """
+        Returns the last price of the first hit in a search response, or None if there is no usable price.
+
+        Parameters:
+        resp (dict): Decoded JSON response.
+        asset (str): Asset name, used for logging.
+        """
+        # Check if we have hits and price data
+        if "hits" not in resp or len(resp["hits"]) == 0:
+            logging.warning(f"No hits in response for asset {asset}")
+            return None
+        hit = resp["hits"][0]
+        if not ("price" in hit and hit["price"] and "last" in hit["price"]):
+            logging.warning(f"No price field in response for asset {asset}")
+            return None
+        price_str = hit["price"]["last"]
+        # Strip non-breaking spaces used as thousands separator, spaces, replace comma with dot
+        raw_price = price_str.replace("\u00a0", "").replace(" ", "").replace(",", ".")
+        try:
+            return float(raw_price)
+        except ValueError:
+            logging.warning(f"Could not parse price '{price_str}' for asset {asset}")
+            return None
+
+    def fetch_price(self, session: requests.Session, asset: str):
+        """
+        Fetches the latest price of one asset, retrying transient failures.
+
+        Parameters:
+        session (requests.Session): Session to send the request with.
+        asset (str): Asset name to search for.
+
+        Returns:
+        float or None: The price, or None if it could not be fetched.
+        """
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.bucket.acquire()
+            try:
+                r = session.post(self.url, headers=HEADERS, json={"query": asset, "limit": 5}, timeout=self.timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                logging.debug(f"Request for asset {asset} failed (attempt {attempt + 1}): {e}")
+                continue
+            if r.status_code >= 500:
+                logging.debug(f"HTTP {r.status_code} for asset {asset} (attempt {attempt + 1})")
+                continue
+            if r.status_code != 200:
+                logging.warning(f"HTTP {r.status_code} for asset {asset}")
+                return None
+            return self.parse_price(r.json(), asset)
+        logging.warning(f"Giving up on asset {asset} after {self.retries + 1} attempts")
+        return None
+
+    def fetch_prices(self, assets: list) -> dict:
+        """
+        Fetches the latest prices of many assets concurrently.
+
+        Parameters:
+        assets (list): (asset, asset_id) tuples.
+
+        Returns:
+        dict: asset_id -> price for the assets whose price could be fetched.
+        """
+        if not assets:
+            return {}
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                prices = executor.map(lambda asset: self.fetch_price(session, asset[0]), assets)
+                return {asset_id: price for (_, asset_id), price in zip(assets, prices) if price is not None}
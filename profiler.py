@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+
+class ProcessingProfiler:
+    """
+    Opt-in instrumentation of DataParser.process_transactions, enabled by passing a profiler to DataParser.
+    Records call counts and cumulative wall time per handle_* method, the number of SQL statements and changed rows,
+    the number of lots each FIFO walk visits and how often transactions were deferred and retried.
+    Without a profiler the handlers and the scheduler only check for it when a lot walk ends or a transaction is deferred.
+    """
+    def __init__(self):
+        # handle_* name -> [calls, seconds]
+        self.handlers = {}
+        # handle_* name -> [walks, lots visited, longest walk]
+        self.lot_walks = {}
+        self.statements = 0
+        self.rows_changed = 0
+        self.deferrals = 0
+        self.retries = 0
+        self.runs = 0
+        self.seconds = 0.0
+        # Time spent in handlers that were not called by another handler, e.g. handle_deposit called by handle_asset_deposit
+        self.handler_seconds = 0.0
+        self._depth = 0
+        self._conn = None
+        self._start = None
+        self._start_changes = 0
+        # (handler, names) of the handlers with wrapped handle_* methods
+        self._instrumented = []
+
+    def start(self, conn: sqlite3.Connection, handler) -> None:
+        """
+        Starts recording a processing run.
+
+        Parameters:
+        conn (sqlite3.Connection): Connection to count SQL statements and changed rows on.
+        handler (DataParser or LotEngine): Object whose handle_* methods are timed.
+        """
+        self._conn = conn
+        self._start_changes = conn.total_changes
+        conn.set_trace_callback(self._count_statement)
+        self.instrument(handler)
+        self._start = time.perf_counter()
+
+    def stop(self) -> None:
+        """
+        Stops recording, restores the handle_* methods and the connection.
+        """
+        if self._start is None:
+            return
+        self.seconds += time.perf_counter() - self._start
+        self.runs += 1
+        self._start = None
+        self.rows_changed += self._conn.total_changes - self._start_changes
+        self._conn.set_trace_callback(None)
+        self._conn = None
+        for handler, names in self._instrumented:
+            for name in names:
+                del handler.__dict__[name]
+        self._instrumented = []
+
+    @contextmanager
+    def profile(self, conn: sqlite3.Connection, handler):
+        """
+        Records a processing run for the duration of the with block, see start.
+        """
+        self.start(conn, handler)
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def instrument(self, handler) -> None:
+        """
+        Replaces the handle_* methods of handler with timed wrappers on the instance.
+
+        Parameters:
+        handler (DataParser or LotEngine): Object implementing the handle_* methods.
+        """
+        if any(instrumented is handler for instrumented, _ in self._instrumented):
+            return
+        names = [name for name in dir(type(handler)) if name.startswith("handle_")]
+        for name in names:
+            setattr(handler, name, self._timed(name, getattr(handler, name)))
+        self._instrumented.append((handler, names))
+
+    def _timed(self, name: str, method):
+        totals = self.handlers.setdefault(name, [0, 0.0])
+
+        @wraps(method)
+        def timed(row):
+            start = time.perf_counter()
+            self._depth += 1
+            try:
+                return method(row)
+            finally:
+                self._depth -= 1
+                elapsed = time.perf_counter() - start
+                totals[0] += 1
+                totals[1] += elapsed
+                if self._depth == 0:
+                    self.handler_seconds += elapsed
+        return timed
+
+    def _count_statement(self, statement: str) -> None:
+        self.statements += 1
+
+    def lot_walk(self, name: str, length: int) -> None:
+        """
+        Records the number of lots or cohort months a FIFO walk visited.
+
+        Parameters:
+        name (str): The handle_* method that walked the lots.
+        length (int): Number of lots visited.
+        """
+        walks = self.lot_walks.setdefault(name, [0, 0, 0])
+        walks[0] += 1
+        walks[1] += length
+        walks[2] = max(walks[2], length)
+
+    def to_dict(self) -> dict:
+        """
+        Returns:
+        dict: The recorded counters, as written by dump.
+        """
+        return {
+            "runs": self.runs,
+            "seconds": self.seconds,
+            "handler_seconds": self.handler_seconds,
+            "statements": self.statements,
+            "rows_changed": self.rows_changed,
+            "deferrals": self.deferrals,
+            "retries": self.retries,
+            "handlers": {name: {"calls": calls, "seconds": seconds}
+                         for name, (calls, seconds) in sorted(self.handlers.items()) if calls},
+            "lot_walks": {name: {"walks": walks, "lots": lots, "longest": longest}
+                          for name, (walks, lots, longest) in sorted(self.lot_walks.items())},
+        }
+
+    def dump(self, file_path: str) -> None:
+        """
+        Writes the recorded counters to a JSON file.
+
+        Parameters:
+        file_path (str): Path of the JSON file.
+        """
+        with open(file_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self) -> str:
+        """
+        Returns:
+        str: A table of the handlers by cumulative time followed by the SQL, lot walk and scheduler counters.
+        """
+        lines = ["{:28s} {:>9s} {:>10s} {:>10s} {:>7s}".format("Handler", "Calls", "Total s", "Mean ms", "Share")]
+        handlers = sorted(((name, calls, seconds) for name, (calls, seconds) in self.handlers.items() if calls),
+                          key=lambda handler: -handler[2])
+        for name, calls, seconds in handlers:
+            lines.append("{:28s} {:9d} {:10.3f} {:10.3f} {:6.1f}%".format(
+                name, calls, seconds, seconds * 1000 / calls, 100 * seconds / self.seconds if self.seconds else 0))
+        lines.append("{:28s} {:9s} {:10.3f}".format("Outside handlers", "", self.seconds - self.handler_seconds))
+        lines.append("")
+        lines.append("Processing: {:.3f}s, {} SQL statements, {} rows changed".format(self.seconds, self.statements, self.rows_changed))
+        lines.append("Deferred transactions: {}, retries: {}".format(self.deferrals, self.retries))
+        for name, (walks, lots, longest) in sorted(self.lot_walks.items()):
+            lines.append("Lot walks in {}: {}, mean {:.1f} lots, longest {}".format(name, walks, lots / walks, longest))
+        return "\n".join(lines)
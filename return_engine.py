@@ -0,0 +1,82 @@
+import numpy as np
+
+
+def cohort_apy(apy_mode, start_dates, deposits, values, total_gainlosses, active_bases, closed_returns,
+               cf_offsets, cf_dates, cf_amounts, today) -> list:
+    """
+    Calculate the annual percentage yield of many cohorts at once.
+    This is the batched equivalent of StatCalculator._calc_apy, computing Modified Dietz or TWRR returns for
+    all cohorts of all accounts with array operations instead of one Python call per cohort.
+
+    The cash flows of all cohorts are passed as one flattened table: the flows of cohort i are
+    cf_dates[cf_offsets[i]:cf_offsets[i + 1]] and cf_amounts[cf_offsets[i]:cf_offsets[i + 1]].
+
+    Parameters:
+    apy_mode (str): 'modified-dietz' or 'twrr'
+    start_dates (list): Start date for time-weighting of each cohort (date).
+    deposits (list): Total deposits of each cohort.
+    values (list): Current value of each cohort (cash and assets).
+    total_gainlosses (list): Total gain/loss of each cohort.
+    active_bases (list): TWRR active base of each cohort.
+    closed_returns (list): Snapshot of value/active_base at time of closure of each cohort, or None.
+    cf_offsets (list): Offsets of each cohort's cash flows in cf_dates and cf_amounts, one more than the number of cohorts.
+    cf_dates (list): Dates of the cash flows (date).
+    cf_amounts (list): Amounts of the cash flows.
+    today (date): Current date used as end date for open positions.
+
+    Returns:
+    list: APY percentage (float) of each cohort, or None where it is not computable.
+    """
+    n = len(start_dates)
+    if n == 0:
+        return []
+    start = np.fromiter((d.toordinal() for d in start_dates), dtype=np.int64, count=n)
+    deposit = np.asarray(deposits, dtype=np.float64)
+    value = np.asarray(values, dtype=np.float64)
+    today = today.toordinal()
+
+    if apy_mode == 'twrr':
+        active_base = np.asarray(active_bases, dtype=np.float64)
+        closed_return = np.array([np.nan if r is None else r for r in closed_returns], dtype=np.float64)
+        total_days = today - start
+        open_position = (active_base > 1e-4) & (value > 0)
+        closed_position = ~open_position & (closed_return > 0)
+        total_return = np.where(open_position, value / np.where(open_position, active_base, 1.0),
+                                np.where(closed_position, closed_return, 1.0))
+        valid = (open_position | closed_position) & (total_days > 0)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            apy = 100 * (total_return ** (365.0 / total_days) - 1)
+        return np.where(valid, apy, 0.0).tolist()
+
+    # Modified Dietz
+    total_gainloss = np.asarray(total_gainlosses, dtype=np.float64)
+    offsets = np.asarray(cf_offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    cohort = np.repeat(np.arange(n), counts)
+    cf_day = np.fromiter((d.toordinal() for d in cf_dates), dtype=np.int64, count=len(cf_dates))
+    cf_amount = np.asarray(cf_amounts, dtype=np.float64)
+
+    # Closed positions end at their last cash flow, open positions today
+    has_cfs = counts > 0
+    last_cf = np.full(n, today, dtype=np.int64)
+    if len(cf_day):
+        last_cf[has_cfs] = np.maximum.reduceat(cf_day, offsets[:-1][has_cfs])
+    closed = (value <= 0.001) & has_cfs
+    end = np.where(closed, np.maximum(last_cf, start + 1), today)
+    total_days = end - start
+    safe_days = np.where(total_days > 0, total_days, 1)
+
+    # Weight each cash flow by the share of the period it was invested,
+    # bincount adds the weighted flows in table order just like the scalar loop
+    days_elapsed = np.clip(cf_day - start[cohort], 0, np.maximum(total_days[cohort], 0))
+    weight = (safe_days[cohort] - days_elapsed) / safe_days[cohort]
+    sum_w_cf = np.bincount(cohort, weights=weight * cf_amount, minlength=n)
+
+    hpr_denominator = deposit + sum_w_cf
+    hpr = total_gainloss / np.where(hpr_denominator > 0, hpr_denominator, 1.0)
+    years_elapsed = safe_days / 365.25
+    valid = (total_days > 0) & (hpr_denominator > 0) & (1 + hpr >= 0)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        apy = 100 * ((1 + hpr) ** (1 / years_elapsed) - 1)
+
+    return [0.0 if d <= 0 else (a if v else None) for d, a, v in zip(deposits, apy.tolist(), valid.tolist())]
@@ -1,6 +1,8 @@
 import pytest
+import sqlite3
 
-from database_handler import DatabaseHandler
+from datetime import date
+from database_handler import DatabaseHandler, transaction_key
 from data_parser import SpecialCases, DataParser
 
 @pytest.fixture(scope='function')
@@ -67,3 +69,58 @@ def test_data_adder_new_format(db):
     # Add same data again — should add 0 rows (dedup check)
     new_rows_added = data_adder.add_data("./test/data/new_format_data.csv")
     assert new_rows_added == 0
+
+def test_data_adder_identical_rows(db, tmp_path):
+    # Two identical transactions on the same day are both added, and only once
+    csv_content = """Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat
+2020-01-15;1111;Köp;Asset A;10;100;-1000;0;SEK;TESTA;-
+2020-01-15;1111;Köp;Asset A;10;100;-1000;0;SEK;TESTA;-
+2020-01-14;1111;Insättning;Deposit;-;-;2000;0;SEK;;-
+"""
+    csv_file = tmp_path / "identical_rows.csv"
+    csv_file.write_text(csv_content, encoding="utf-8")
+    data_adder = DataParser(db)
+    assert data_adder.add_data(str(csv_file)) == 3
+    assert data_adder.add_data(str(csv_file)) == 0
+
+    # An overlapping export with a third identical transaction only adds the new one
+    csv_file.write_text(csv_content.replace("2020-01-14", "2020-01-15;1111;Köp;Asset A;10;100;-1000;0;SEK;TESTA;-\n2020-01-14"), encoding="utf-8")
+    assert data_adder.add_data(str(csv_file)) == 1
+
+def test_transaction_key():
+    row = (date(2020, 1, 15), "1111", "Köp", "Asset A", 10.0, 100.0)
+    # Amount and price are compared with a tolerance
+    assert transaction_key(row) == transaction_key(row[:4] + (10.0000000001, 99.99999999999))
+    assert transaction_key(row) != transaction_key(row[:4] + (10.001, 100.0))
+    assert transaction_key((date(2020, 1, 15), "1111", "Ränta", "", -0.0, 0.0)) == transaction_key((date(2020, 1, 15), "1111", "Ränta", "", 0.0, 0.0))
+    # Identical transactions are told apart by occurrence
+    assert transaction_key(row, 0) != transaction_key(row, 1)
+
+def test_data_adder_legacy_database(tmp_path):
+    # Transactions added before natural_key existed are backfilled, so importing them again adds nothing
+    db_file = tmp_path / "legacy.db"
+    conn = sqlite3.connect(db_file)
+    conn.execute("""CREATE TABLE transactions(date DATE NOT NULL, account TEXT NOT NULL, transaction_type TEXT NOT NULL,
+        asset_name TEXT NOT NULL, amount REAL NOT NULL, price REAL NOT NULL, total REAL NOT NULL, courtage REAL NOT NULL,
+        currency TEXT NOT NULL, isin TEXT NOT NULL, processed INT DEFAULT 0)""")
+    conn.execute("INSERT INTO transactions VALUES('2019-01-14', 'A', 'Insättning', 'Deposit', 0, 0, 1000, 0, 'SEK', '', 0)")
+    conn.commit()
+    conn.close()
+
+    db = DatabaseHandler(str(db_file))
+    db.connect()
+    assert db.conn.execute("SELECT COUNT(*) FROM transactions WHERE natural_key IS NULL").fetchone()[0] == 0
+    db.disconnect()
+
+    csv_file = tmp_path / "legacy.csv"
+    csv_file.write_text("""Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat
+2019-01-14;A;Insättning;Deposit;-;-;1000;0;SEK;;-
+""", encoding="utf-8")
+    assert DataParser(db).add_data(str(csv_file)) == 0
+
+def test_data_adder_batch_size(db, special_cases):
+    # Batches that do not divide the file evenly add the same rows
+    data_adder = DataParser(db, special_cases)
+    assert data_adder.add_data("./test/data/small_data.csv", batch_size=3) == 8
+    assert data_adder.rows_read == 8
+    assert data_adder.add_data("./test/data/small_data_plus.csv", batch_size=5) == 6
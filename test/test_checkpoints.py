@@ -0,0 +1,122 @@
+import logging
+import pytest
+from datetime import date
+from database_handler import DatabaseHandler
+from data_parser import DataParser, AssetDeficit
+
+HEADER = "Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat\n"
+
+HISTORY = """2023-01-15;1111;Insättning;Deposit;-;-;1000;0;SEK;;-
+2023-01-20;1111;Köp;Asset A;10;50;-500;0;SEK;TESTA;-
+2023-02-15;1111;Insättning;Deposit;-;-;500;0;SEK;;-
+2023-02-20;1111;Köp;Asset B;5;100;-500;0;SEK;TESTB;-
+2023-03-15;1111;Sälj;Asset A;-5;60;300;0;SEK;TESTA;-
+2023-04-15;1111;Insättning;Deposit;-;-;200;0;SEK;;-
+2023-04-20;1111;Köp;Asset A;4;55;-220;0;SEK;TESTA;-
+2023-05-15;1111;Uttag;;-;-;-300;0;SEK;;-
+2023-06-15;1111;Sälj;Asset B;-5;110;550;0;SEK;TESTB;-
+"""
+
+# Back-dated transactions that arrive in a later import
+LATE = """2023-03-20;1111;Insättning;Deposit;-;-;400;0;SEK;;-
+2023-03-25;1111;Köp;Asset C;2;150;-300;0;SEK;TESTC;-
+"""
+
+# A purchase the account can not pay for, and the deposit for it that arrives in a later import
+BLOCKED = """2023-05-20;1111;Köp;Asset C;20;100;-2000;0;SEK;TESTC;-
+"""
+FUNDING = """2023-05-18;1111;Insättning;Deposit;-;-;2000;0;SEK;;-
+"""
+
+# Shares removed from an asset the account does not hold, and the asset deposit of them that arrives in a later import
+REMOVED = """2023-07-10;1111;Värdepappersuttag;Asset D;-3;-;-;0;SEK;TESTD;-
+"""
+DEPOSITED = """2023-07-05;1111;Tillgångsinsättning;Asset D;3;80;-;0;SEK;TESTD;-
+"""
+
+tables = {
+    "cohort_data": "SELECT * FROM cohort_data ORDER BY month, account",
+    "cohort_assets": "SELECT * FROM cohort_assets ORDER BY month, asset_id, account",
+    "cohort_cash_flows": "SELECT * FROM cohort_cash_flows ORDER BY cohort_month, account, transaction_month",
+    "assets": "SELECT * FROM assets ORDER BY asset_id",
+    "asset_prices": "SELECT asset_id, date, price, source FROM asset_prices ORDER BY asset_id, date, price",
+    "processed": "SELECT COUNT(*) FROM transactions WHERE processed = 0"}
+
+def process(tmp_path, name, csv_contents, in_memory, max_checkpoints=24):
+    db = DatabaseHandler(str(tmp_path / name))
+    for i, content in enumerate(csv_contents):
+        csv_file = tmp_path / f"{name}_{i}.csv"
+        csv_file.write_text(HEADER + content, encoding="utf-8")
+        data_parser = DataParser(db, max_checkpoints=max_checkpoints)
+        data_parser.add_data(str(csv_file))
+        data_parser.process_transactions(in_memory=in_memory)
+    db.connect()
+    return db
+
+def state(db):
+    cur = db.get_cursor()
+    return {table: cur.execute(query).fetchall() for table, query in tables.items()}
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_checkpoints__back_dated_import(tmp_path, caplog, in_memory):
+    # Back-dated transactions rewind to the checkpoint of their month and give the same state as processing everything at once
+    expected = state(process(tmp_path, "full.db", [HISTORY + LATE], in_memory))
+    with caplog.at_level(logging.INFO):
+        db = process(tmp_path, "incremental.db", [HISTORY, LATE], in_memory)
+    assert "Rewinding to checkpoint 2023-03-01" in caplog.text
+    assert state(db) == expected
+    checkpoints = [row[0] for row in db.get_cursor().execute("SELECT date FROM checkpoints ORDER BY date")]
+    assert checkpoints == [date(2023, month, 1) for month in range(1, 7)]
+
+def test_checkpoints__same_state_in_both_modes(tmp_path):
+    # Checkpoints saved by the LotEngine are identical to the ones saved when processing with SQL
+    sql_db = process(tmp_path, "sql.db", [HISTORY], in_memory=False)
+    db = process(tmp_path, "memory.db", [HISTORY], in_memory=True)
+    for table in ["checkpoints", "checkpoint_cohort_data", "checkpoint_cohort_assets", "checkpoint_cohort_cash_flows", "checkpoint_assets"]:
+        query = f"SELECT * FROM {table} ORDER BY rowid"
+        assert db.get_cursor().execute(query).fetchall() == sql_db.get_cursor().execute(query).fetchall(), table
+
+def test_checkpoints__before_first_checkpoint(tmp_path, caplog):
+    # Only the latest two months are kept, so an older back-dated transaction processes everything again
+    expected = state(process(tmp_path, "full.db", [HISTORY + LATE], False, max_checkpoints=2))
+    with caplog.at_level(logging.INFO):
+        db = process(tmp_path, "incremental.db", [HISTORY, LATE], False, max_checkpoints=2)
+    assert "processing all transactions again" in caplog.text
+    assert state(db) == expected
+    checkpoints = [row[0] for row in db.get_cursor().execute("SELECT date FROM checkpoints ORDER BY date")]
+    assert checkpoints == [date(2023, 5, 1), date(2023, 6, 1)]
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_checkpoints__deficit_keeps_earlier_months(tmp_path, caplog, in_memory):
+    # The months before the purchase that can not be paid for stay processed and the import with the deposit resumes from there
+    expected = state(process(tmp_path, "full.db", [HISTORY + BLOCKED + FUNDING], in_memory))
+    with pytest.raises(AssetDeficit) as deficit:
+        process(tmp_path, "incremental.db", [HISTORY + BLOCKED], in_memory)
+    assert deficit.value.processed_until == date(2023, 5, 1)
+    # The withdrawal and the sale around the purchase are left unprocessed with it
+    assert str(deficit.value).startswith("There are 3 transaction(s)")
+    db = DatabaseHandler(str(tmp_path / "incremental.db"))
+    db.connect()
+    # MAX and MIN return strings even with PARSE_DECLTYPES
+    assert db.get_cursor().execute("SELECT MAX(date) FROM transactions WHERE processed = 1").fetchone()[0] == "2023-04-20"
+    assert db.get_cursor().execute("SELECT MIN(date) FROM transactions WHERE processed = 0").fetchone()[0] == "2023-05-15"
+    db.disconnect()
+    with caplog.at_level(logging.INFO):
+        db = process(tmp_path, "incremental.db", [FUNDING], in_memory)
+    assert "Rewinding" not in caplog.text
+    assert state(db) == expected
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_checkpoints__share_removal_deficit_keeps_earlier_months(tmp_path, in_memory):
+    # Shares that can not be removed wait for the asset like a sale, the months before them stay processed
+    expected = state(process(tmp_path, "full.db", [HISTORY + DEPOSITED + REMOVED], in_memory))
+    with pytest.raises(AssetDeficit) as deficit:
+        process(tmp_path, "incremental.db", [HISTORY + REMOVED], in_memory)
+    assert deficit.value.processed_until == date(2023, 7, 1)
+    assert str(deficit.value).startswith("There are 1 transaction(s)")
+    db = DatabaseHandler(str(tmp_path / "incremental.db"))
+    db.connect()
+    assert db.get_cursor().execute("SELECT COUNT(*) FROM transactions WHERE processed = 1").fetchone()[0] == 9
+    db.disconnect()
+    db = process(tmp_path, "incremental.db", [DEPOSITED], in_memory)
+    assert state(db) == expected
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def test_cli__lazy_imports():
+    """
+    Tests that importing the CLI does not load numpy, requests or the modules that import them,
+    they are only needed by the commands that calculate stats or fetch prices.
+    """
+    modules = ["numpy", "requests", "return_engine", "price_fetcher", "calculate_stats", "data_parser"]
+    result = subprocess.run([sys.executable, "-c", "import sys, cli; print(' '.join(m for m in {} if m in sys.modules))".format(modules)],
+                            capture_output=True, text=True, cwd=ROOT, check=True)
+    assert result.stdout.split() == []
+
+def test_cli__status_imports(tmp_path):
+    """
+    Tests that the status command runs without loading numpy or requests.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, "cli.py"), "--database", str(tmp_path / "test_cli_startup.db"), "status"],
+                            capture_output=True, text=True, cwd=ROOT, check=True)
+    imported = {line.split("|")[-1].strip() for line in result.stderr.splitlines() if line.startswith("import time:")}
+    assert "sqlite3" in imported
+    assert not imported & {"numpy", "requests"}
+
+def test_cli__startup_baseline(tmp_path):
+    """
+    Tests that the status command does not import more modules than recorded in the checked in startup baseline,
+    see benchmarks/bench_startup.py. The module count is only compared with the Python version of the baseline.
+    """
+    with open(os.path.join(ROOT, "benchmarks", "results", "startup.json")) as f:
+        baseline = json.load(f)
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, "cli.py"), "--database", str(tmp_path / "test_cli_startup.db"), "status"],
+                            capture_output=True, text=True, cwd=ROOT, check=True)
+    modules = [line for line in result.stderr.splitlines() if line.startswith("import time:") and "|" in line and "self [us]" not in line]
+    status = baseline["results"]["status"]
+    assert not status["numpy"] and not status["requests"]
+    if baseline["python"].split(".")[:2] == sys.version.split()[0].split(".")[:2]:
+        assert len(modules) <= status["modules"]
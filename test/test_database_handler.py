@@ -1,6 +1,6 @@
 import pytest
 
-from database_handler import DatabaseHandler
+from database_handler import DatabaseHandler, MIGRATIONS, CONNECTION_PROFILES
 
 @pytest.fixture(scope='function')
 def db_handler(tmp_path) -> DatabaseHandler:
@@ -99,4 +99,80 @@ def test_database_handler__reset_all_tables(db_handler):
     db_handler.reset_tables()
     # Check that the number of rows is 0
     assert db_handler.get_db_stat("Transactions") == 0
-    db_handler.disconnect()
\ No newline at end of file
+    db_handler.disconnect()
+# Test that the schema migrations are applied once and recorded in user_version
+def test_database_handler__migrate(db_handler):
+    db_handler.connect()
+    cursor = db_handler.get_cursor()
+    assert cursor.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    indexes = [row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert "transactions_unprocessed" in indexes
+    assert "cohort_data_available_capital" in indexes
+    assert "asset_prices_asset_date" in indexes
+    # Migrating an up to date database does nothing
+    assert db_handler.migrate() == len(MIGRATIONS)
+    # The hot queries use the partial indexes
+    plan = cursor.execute("EXPLAIN QUERY PLAN SELECT month, capital FROM cohort_data WHERE account = ? AND capital > 0 ORDER BY month ASC", ("A",)).fetchall()
+    assert "cohort_data_available_capital" in plan[0][-1]
+    db_handler.disconnect()
+
+# Test that the PRAGMAs of the connection profile are set on connect
+def test_database_handler__bulk_profile(tmp_path):
+    db_handler = DatabaseHandler(str(tmp_path / "test_bulk_profile.db"), profile="bulk")
+    db_handler.connect()
+    cursor = db_handler.get_cursor()
+    assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # NORMAL
+    assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert cursor.execute("PRAGMA cache_size").fetchone()[0] == CONNECTION_PROFILES["bulk"]["cache_size"]
+    # MEMORY
+    assert cursor.execute("PRAGMA temp_store").fetchone()[0] == 2
+    db_handler.disconnect()
+    with pytest.raises(Exception):
+        DatabaseHandler(str(tmp_path / "test_bulk_profile.db"), profile="fast")
+    # WAL is stored in the file, the safe profile sets the rollback journal again
+    db_handler = DatabaseHandler(str(tmp_path / "test_bulk_profile.db"))
+    cursor = db_handler.get_cursor()
+    assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    # FULL
+    assert cursor.execute("PRAGMA synchronous").fetchone()[0] == 2
+    db_handler.disconnect()
+
+# Test that bulk() defers commits to the end of the block and rolls back everything if the block raises
+def test_database_handler__bulk(db_handler):
+    db_handler.connect()
+    with db_handler.bulk():
+        db_handler.set_metadata("first", "1")
+        db_handler.set_account_nickname("1111", "Savings")
+        # connect and disconnect keep the connection of the block
+        db_handler.disconnect()
+        db_handler.connect()
+        db_handler.set_metadata("second", "2")
+        assert db_handler.conn.in_transaction
+    assert not db_handler.conn.in_transaction
+    assert db_handler.get_all_metadata() == {"first": "1", "second": "2"}
+
+    with pytest.raises(RuntimeError):
+        with db_handler.bulk():
+            db_handler.set_metadata("first", "changed")
+            db_handler.remove_account_nickname("1111")
+            raise RuntimeError("failed")
+    assert db_handler.get_metadata("first") == "1"
+    assert db_handler.get_account_nickname("1111") == "Savings"
+    db_handler.disconnect()
+
+# Test that an up to date database is opened without DDL and that the handler keeps one connection
+def test_database_handler__schema_up_to_date(tmp_path):
+    db_file = str(tmp_path / "test_schema.db")
+    DatabaseHandler(db_file).disconnect()
+    db_handler = DatabaseHandler(db_file)
+    statements = []
+    db_handler.conn.set_trace_callback(statements.append)
+    db_handler.create_tables()
+    assert statements == ["PRAGMA user_version", "SELECT name FROM sqlite_master WHERE type='table'"]
+    assert "account_cohort_stats" in db_handler.tables
+    assert "cohort_stats" not in db_handler.tables
+    conn = db_handler.conn
+    db_handler.connect()
+    assert db_handler.conn is conn
+    db_handler.disconnect()
@@ -0,0 +1,158 @@
+import logging
+import pytest
+from datetime import date
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from calculate_stats import StatCalculator
+
+HEADER = "Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat\n"
+
+HISTORY = """2022-11-15;1111;Insättning;Deposit;-;-;1000;0;SEK;;-
+2022-11-20;1111;Köp;Asset A;10;50;-500;0;SEK;TESTA;-
+2022-11-25;2222;Insättning;Deposit;-;-;400;0;SEK;;-
+2022-11-28;2222;Köp;Asset B;4;100;-400;0;SEK;TESTB;-
+2023-01-15;1111;Insättning;Deposit;-;-;500;0;SEK;;-
+2023-01-20;1111;Köp;Asset C;5;100;-500;0;SEK;TESTC;-
+2023-02-15;2222;Insättning;Deposit;-;-;300;0;SEK;;-
+2023-03-15;1111;Sälj;Asset A;-5;60;300;0;SEK;TESTA;-
+"""
+
+# Only touches account 2222
+LATER = """2023-04-10;2222;Insättning;Deposit;-;-;200;0;SEK;;-
+2023-04-12;2222;Köp;Asset D;2;110;-220;0;SEK;TESTD;-
+"""
+
+# A back-dated deposit of 1111, processed with a rewind to the February checkpoint
+BACK_DATED = """2023-02-20;1111;Insättning;Deposit;-;-;100;0;SEK;;-
+"""
+
+def import_csv(db, tmp_path, name, content, in_memory=False):
+    csv_file = tmp_path / name
+    csv_file.write_text(HEADER + content, encoding="utf-8")
+    data_parser = DataParser(db)
+    data_parser.add_data(str(csv_file))
+    data_parser.process_transactions(in_memory=in_memory)
+
+def stats(db):
+    db.connect()
+    cur = db.get_cursor()
+    return (cur.execute("SELECT * FROM account_cohort_stats ORDER BY account, month").fetchall(),
+            cur.execute("SELECT * FROM account_year_stats ORDER BY account, year").fetchall())
+
+@pytest.mark.parametrize("apy_mode", ["modified-dietz", "twrr"])
+def test_update_stats__dirty_accounts(tmp_path, apy_mode):
+    """
+    Tests that update_stats only recalculates the accounts and months that changed since the last calculation,
+    and that the result is the same as recalculating all stats.
+    """
+    db = DatabaseHandler(tmp_path / "test_incremental_stats.db")
+    import_csv(db, tmp_path, "history.csv", HISTORY)
+    stat_calculator = StatCalculator(db)
+    stat_calculator.calculate_stats(apy_mode=apy_mode)
+    assert stat_calculator.get_dirty_accounts() == {}
+    kept = [row for row in stats(db)[0] if row[0] == "1111"]
+
+    import_csv(db, tmp_path, "later.csv", LATER)
+    # Asset D is paid with the February cash of 2222, the earlier stats are kept
+    assert stat_calculator.get_dirty_accounts() == {"2222": date(2023, 2, 1)}
+    assert stat_calculator.update_stats(apy_mode=apy_mode) == {"2222": date(2023, 2, 1)}
+    assert stat_calculator.get_dirty_accounts() == {}
+    incremental = stats(db)
+    assert [row for row in incremental[0] if row[0] == "1111"] == kept
+
+    # A new price for Asset C only affects the cohorts of 1111 that paid for it, starting with the November cash
+    db.connect()
+    db.get_cursor().execute("UPDATE assets SET latest_price = 120 WHERE asset = 'Asset C'")
+    db.commit()
+    assert stat_calculator.update_stats(apy_mode=apy_mode) == {"1111": date(2022, 11, 1)}
+    incremental = stats(db)
+
+    stat_calculator.calculate_stats(apy_mode=apy_mode)
+    assert incremental == stats(db)
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_update_stats__back_dated_import(tmp_path, caplog, in_memory):
+    """
+    Tests that processing marks the cohorts it changes dirty without triggers on the cohort tables,
+    all of them for a first import and only the changed ones when rewinding to a checkpoint.
+    """
+    db = DatabaseHandler(tmp_path / "test_back_dated_stats.db")
+    import_csv(db, tmp_path, "history.csv", HISTORY + LATER, in_memory)
+    stat_calculator = StatCalculator(db)
+    assert db.get_cursor().execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall() == [("assets_dirty_price",)]
+    assert stat_calculator.get_dirty_accounts() == {"1111": date(2022, 11, 1), "2222": date(2022, 11, 1)}
+    stat_calculator.calculate_stats()
+
+    with caplog.at_level(logging.INFO):
+        import_csv(db, tmp_path, "back_dated.csv", BACK_DATED, in_memory)
+    assert "Rewinding to checkpoint 2023-02-01" in caplog.text
+    # The sale of 1111 in March takes Asset A from the November cohort again, 2222 is processed again from its February deposit
+    assert stat_calculator.update_stats() == {"1111": date(2022, 11, 1), "2222": date(2023, 2, 1)}
+    incremental = stats(db)
+    stat_calculator.calculate_stats()
+    assert incremental == stats(db)
+
+@pytest.mark.parametrize("apy_mode", ["modified-dietz", "twrr"])
+def test_update_stats__revalue_prices(tmp_path, caplog, apy_mode):
+    """
+    Tests that update_stats revalues the stats when only prices changed, and that the result matches recalculating all stats.
+    """
+    db = DatabaseHandler(tmp_path / "test_revalue_stats.db")
+    import_csv(db, tmp_path, "history.csv", HISTORY + LATER)
+    stat_calculator = StatCalculator(db)
+    stat_calculator.calculate_stats(apy_mode=apy_mode)
+
+    for prices in ({"Asset A": 65, "Asset C": 90}, {"Asset B": 130}):
+        db.connect()
+        db.get_cursor().executemany("UPDATE assets SET latest_price = ? WHERE asset = ?",
+                                    [(price, asset) for asset, price in prices.items()])
+        db.commit()
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            stat_calculator.update_stats(apy_mode=apy_mode)
+        assert "Revalued stats" in caplog.text
+        revalued = stats(db)
+
+        # A separate calculator, stat_calculator keeps its holdings for the next revaluation
+        StatCalculator(db).calculate_stats(apy_mode=apy_mode)
+        for revalued_rows, rows in zip(revalued, stats(db)):
+            assert len(revalued_rows) == len(rows)
+            for revalued_row, row in zip(revalued_rows, rows):
+                assert revalued_row == pytest.approx(row, rel=1e-12)
+
+def test_update_stats__stored_holdings(tmp_path, monkeypatch):
+    """
+    Tests that the holdings of a revaluation are stored for the revaluations of later StatCalculators,
+    and that they are not used once cohorts changed.
+    """
+    db = DatabaseHandler(tmp_path / "test_stored_holdings.db")
+    import_csv(db, tmp_path, "history.csv", HISTORY)
+    StatCalculator(db).calculate_stats()
+
+    def set_price(asset, price):
+        db.connect()
+        db.get_cursor().execute("UPDATE assets SET latest_price = ? WHERE asset = ?", (price, asset))
+        db.commit()
+
+    set_price("Asset A", 65)
+    StatCalculator(db).update_stats()
+    loaded = []
+    load_holdings = StatCalculator._load_holdings
+    monkeypatch.setattr(StatCalculator, "_load_holdings", lambda self: loaded.append(1) or load_holdings(self))
+
+    set_price("Asset C", 90)
+    StatCalculator(db).update_stats()
+    assert loaded == []
+    revalued = stats(db)
+    StatCalculator(db).calculate_stats()
+    for revalued_rows, rows in zip(revalued, stats(db)):
+        assert len(revalued_rows) == len(rows)
+        for revalued_row, row in zip(revalued_rows, rows):
+            assert revalued_row == pytest.approx(row, rel=1e-12)
+
+    # The stats of the new cohorts are calculated, the next revaluation loads the holdings again
+    import_csv(db, tmp_path, "later.csv", LATER)
+    StatCalculator(db).update_stats()
+    set_price("Asset D", 120)
+    StatCalculator(db).update_stats()
+    assert loaded == [1]
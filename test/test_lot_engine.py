@@ -0,0 +1,66 @@
+import pytest
+
+from database_handler import DatabaseHandler
+from data_parser import DataParser, AssetDeficit, SpecialCases
+
+datasets = [
+    "./test/data/small_data.csv",
+    "./test/data/listing_change.csv",
+    "./test/data/reordered_data.csv",
+    "./test/data/asset_deposit.csv",
+    "./test/data/interest_fees.csv",
+    "./test/data/fraction_writeoff.csv",
+    "./test/data/new_transaction_types.csv",
+    "./test/data/transfer_deferral.csv",
+    "./test/data/transfer_attribution_two_accounts.csv",
+    "./test/data/multiple_transfers_same_day.csv"]
+
+tables = {
+    "cohort_data": "SELECT * FROM cohort_data ORDER BY month, account",
+    "cohort_assets": "SELECT * FROM cohort_assets ORDER BY month, asset_id, account",
+    "cohort_cash_flows": "SELECT * FROM cohort_cash_flows ORDER BY cohort_month, account, transaction_month",
+    "assets": "SELECT * FROM assets ORDER BY asset_id",
+    "transactions": "SELECT rowid, processed FROM transactions ORDER BY rowid"}
+
+def process(tmp_path, name, csv_files, in_memory):
+    db = DatabaseHandler(str(tmp_path / name))
+    for csv_file in csv_files:
+        data_parser = DataParser(db, SpecialCases("./test/data/special_cases_test.json"))
+        data_parser.add_data(csv_file)
+        data_parser.process_transactions(in_memory=in_memory)
+    db.connect()
+    cur = db.get_cursor()
+    return {table: cur.execute(query).fetchall() for table, query in tables.items()}
+
+@pytest.mark.parametrize("dataset", datasets)
+def test_lot_engine__same_result_as_sql(tmp_path, dataset):
+    # The in-memory engine should produce exactly the same tables as processing with SQL
+    sql_result = process(tmp_path, "sql.db", [dataset], in_memory=False)
+    memory_result = process(tmp_path, "memory.db", [dataset], in_memory=True)
+    for table in tables:
+        assert memory_result[table] == sql_result[table], table
+
+def test_lot_engine__incremental_import(tmp_path):
+    # State from an earlier run is loaded by the engine before new transactions are processed
+    csv_files = ["./test/data/small_data.csv", "./test/data/small_data_plus.csv"]
+    sql_result = process(tmp_path, "sql.db", csv_files, in_memory=False)
+    memory_result = process(tmp_path, "memory.db", csv_files, in_memory=True)
+    for table in tables:
+        assert memory_result[table] == sql_result[table], table
+
+def test_lot_engine__deficit(tmp_path):
+    # On a deficit the transactions before the month that could not be processed are written, as when processing with SQL
+    results = []
+    for in_memory in [False, True]:
+        db = DatabaseHandler(str(tmp_path / "{}.db".format(in_memory)))
+        data_parser = DataParser(db, SpecialCases("./test/data/special_cases_test.json"))
+        data_parser.add_data("./test/data/small_data_wrong_accounts.csv")
+        db.connect()
+        unprocessed = db.get_db_stat("Unprocessed")
+        with pytest.raises(AssetDeficit):
+            data_parser.process_transactions(in_memory=in_memory)
+        assert 0 < db.get_db_stat("Processed") < unprocessed
+        cur = db.get_cursor()
+        results.append({table: cur.execute(query).fetchall() for table, query in tables.items()})
+    for table in tables:
+        assert results[1][table] == results[0][table], table
@@ -0,0 +1,59 @@
+import pytest
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from calculate_stats import StatCalculator
+
+HEADER = "Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat\n"
+
+TRANSACTIONS = """2023-06-15;2222;Sälj;Asset B;-4;120;480;0;SEK;TESTB;-
+2023-05-15;1111;Uttag;;-;-;-200;0;SEK;;-
+2023-03-15;1111;Sälj;Asset A;-5;60;300;0;SEK;TESTA;-
+2023-02-15;2222;Insättning;Deposit;-;-;300;0;SEK;;-
+2023-01-20;1111;Köp;Asset C;5;100;-500;0;SEK;TESTC;-
+2023-01-15;1111;Insättning;Deposit;-;-;500;0;SEK;;-
+2022-11-28;2222;Köp;Asset B;4;100;-400;0;SEK;TESTB;-
+2022-11-25;2222;Insättning;Deposit;-;-;400;0;SEK;;-
+2022-11-20;1111;Köp;Asset A;10;50;-500;0;SEK;TESTA;-
+2022-11-15;1111;Insättning;Deposit;-;-;1000;0;SEK;;-
+"""
+
+@pytest.fixture
+def merged_stats_db(tmp_path):
+    csv_file = tmp_path / "merged_stats.csv"
+    csv_file.write_text(HEADER + TRANSACTIONS, encoding="utf-8")
+    db = DatabaseHandler(tmp_path / "test_merged_stats.db")
+    data_parser = DataParser(db)
+    data_parser.add_data(str(csv_file))
+    data_parser.process_transactions()
+    return db
+
+@pytest.mark.parametrize("apy_mode", ["modified-dietz", "twrr"])
+@pytest.mark.parametrize("period", ["month", "year"])
+def test_get_stats__merged_apy(merged_stats_db, apy_mode, period):
+    """
+    Tests that the APY of merged stats, which is calculated for all periods with one grouped query,
+    is the same as the stored APY when the merged accounts only have stats for one account.
+    """
+    stat_calculator = StatCalculator(merged_stats_db)
+    stat_calculator.calculate_stats(apy_mode=apy_mode)
+    for account in ["1111", "2222"]:
+        stats = stat_calculator.get_stats(accounts=[account], period=period, deposits="all", apy_mode=apy_mode)
+        merged = stat_calculator.get_stats(accounts=[account, "9999"], period=period, deposits="all", apy_mode=apy_mode)
+        assert len(merged) == len(stats) > 0
+        for merged_row, row in zip(merged, stats):
+            assert merged_row[:10] == pytest.approx(row[:10], rel=1e-12)
+            assert merged_row[10] == pytest.approx(row[10], rel=1e-9)
+
+@pytest.mark.parametrize("apy_mode", ["modified-dietz", "twrr"])
+def test_get_stats__merged_queries(merged_stats_db, apy_mode):
+    """
+    Tests that merged stats read the stats and the APY inputs with one query each, however many months there are.
+    """
+    stat_calculator = StatCalculator(merged_stats_db)
+    stat_calculator.calculate_stats(apy_mode=apy_mode)
+    statements = []
+    merged_stats_db.conn.set_trace_callback(statements.append)
+    stats = stat_calculator.get_stats(accounts=["1111", "2222"], period="month", deposits="all", apy_mode=apy_mode)
+    merged_stats_db.conn.set_trace_callback(None)
+    assert [row[0].month for row in stats] == [11, 1, 2]
+    assert len(statements) == 2
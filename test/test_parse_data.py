@@ -1,4 +1,5 @@
 import pytest
+from datetime import date
 
 from database_handler import DatabaseHandler
 from data_parser import DataParser, AssetDeficit, SpecialCases
@@ -144,6 +145,26 @@ def test_data_parser__reparse(databases):
     assert databases.get_db_stat("Processed" ) == unprocessed
     assert databases.get_db_stat("Unprocessed" ) == 0
 
+@pytest.mark.parametrize("databases", ["./test/data/listing_change.csv"], indirect=True)
+def test_data_parser__asset_ids(databases):
+    data_parser = DataParser(databases, SpecialCases("./test/data/special_cases_test.json"))
+    databases.connect()
+    data_parser.process_transactions()
+    # The renamed asset is resolved under its new name
+    assets = dict(databases.get_cursor().execute("SELECT asset, asset_id FROM assets").fetchall())
+    assert data_parser._load_asset_ids() == assets
+    # Known assets are resolved without SQL statements
+    statements = []
+    databases.conn.set_trace_callback(statements.append)
+    for asset, asset_id in assets.items():
+        assert data_parser._asset_id(asset) == asset_id
+    databases.conn.set_trace_callback(None)
+    assert statements == []
+    # Assets are added again after a reset
+    data_parser.reset_processed_transactions()
+    data_parser.process_transactions()
+    assert data_parser._load_asset_ids() == dict(databases.get_cursor().execute("SELECT asset, asset_id FROM assets").fetchall())
+
 
 def test_data_parser__wrong_accounts(database_small_wrong_accounts):
     # Create DataParser object
@@ -151,12 +172,18 @@ def test_data_parser__wrong_accounts(database_small_wrong_accounts):
     # Connect to database and get number of unprocessed transactions
     database_small_wrong_accounts.connect()
     unprocessed = database_small_wrong_accounts.get_db_stat("Unprocessed" )
-    # Process transactions, since there is a deficit, an exception should be raised
-    with pytest.raises(AssetDeficit):
+    # Process transactions, since there is a deficit in November 2017, an exception should be raised
+    with pytest.raises(AssetDeficit) as deficit:
+        data_parser.process_transactions()
+    # Check that the six transactions before November are processed and the later ones are still unprocessed
+    assert deficit.value.processed_until == date(2017, 11, 1)
+    assert database_small_wrong_accounts.get_db_stat("Processed" ) == 6
+    assert database_small_wrong_accounts.get_db_stat("Unprocessed" ) == unprocessed - 6
+    # Processing again starts from November, where nothing can be kept, so only that run is rolled back
+    with pytest.raises(AssetDeficit) as deficit:
         data_parser.process_transactions()
-    # Check that all previously unprocessed transactions are still unprocessed
-    assert database_small_wrong_accounts.get_db_stat("Processed" ) == 0
-    assert database_small_wrong_accounts.get_db_stat("Unprocessed" ) == unprocessed
+    assert deficit.value.processed_until is None
+    assert database_small_wrong_accounts.get_db_stat("Processed" ) == 6
 
 def test_cohort_cash_flows_aggregation(database_cohort_aggregation):
     db, parser = database_cohort_aggregation
@@ -181,4 +208,41 @@ def test_cohort_cash_flows_aggregation(database_cohort_aggregation):
     assert str(cohort_month) == "2020-01-31"
     assert account == "1111"
     assert str(transaction_month) == "2021-05-31"
-    assert amount == -350.0  # -100 - 200 - 50 = -350
\ No newline at end of file
+    assert amount == -350.0  # -100 - 200 - 50 = -350
+def test_data_parser__asset_summary(tmp_path):
+    db = DatabaseHandler(tmp_path / "test_asset_data.db")
+    data_parser = DataParser(db)
+    cur = db.get_cursor()
+    cur.executemany("INSERT INTO assets(asset_id, asset, amount) VALUES (?,?,?)", [(1, "A", 99), (2, "B", 99)])
+    cur.executemany("INSERT INTO cohort_data(month, account) VALUES (?,?)", [("2020-01-31", "1111"), ("2020-02-29", "1111"), ("2020-03-31", "1111")])
+    # Lots as (month, asset_id, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount)
+    cur.executemany("""
+        INSERT INTO cohort_assets(month, asset_id, account, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount)
+        VALUES (?,?,'1111',?,?,?,?,?,?)""", [
+        ("2020-01-31", 1, 10, 100, 100, 0, 10, 0),
+        ("2020-02-29", 1, 30, 200, 150, 300, 40, 10),
+        # Fractions of at most 1e-3 are left out of the sums and averages
+        ("2020-03-31", 1, 1e-4, 1000, 1000, 1000, 1e-4, 1e-4),
+        ("2020-01-31", 2, 0, 100, 100, 120, 5, 5),
+    ])
+    data_parser.update_asset_summary()
+    summary = cur.execute("SELECT asset_id, amount, average_price, average_purchase_price, average_sale_price, purchased_amount, sold_amount FROM assets ORDER BY asset_id").fetchall()
+    assert summary[0] == pytest.approx((1, 40, 175, 140, 300, 50, 10))
+    # Assets without holdings keep their purchase and sale history
+    assert summary[1] == pytest.approx((2, 0, 0, 100, 120, 5, 5))
+
+def test_data_parser__cohort_value(tmp_path):
+    db = DatabaseHandler(tmp_path / "test_cohort_value.db")
+    data_parser = DataParser(db)
+    cur = db.get_cursor()
+    cur.executemany("INSERT INTO assets(asset_id, asset, latest_price) VALUES (?,?,?)", [(1, "A", 10), (2, "B", 20), (3, "C", None)])
+    cur.execute("INSERT INTO cohort_data(month, account, capital) VALUES ('2020-01-31', '1111', 50)")
+    cur.executemany("INSERT INTO cohort_assets(month, asset_id, account, amount, average_price) VALUES ('2020-01-31',?,'1111',?,?)", [
+        (1, 2, 9), (2, 0, 19), (3, 4, 5),
+    ])
+    # Assets without a latest price are valued at the average price of the lot
+    assert data_parser.cohort_value(date(2020, 1, 31), "1111") == 50 + 2 * 10 + 4 * 5
+    data_parser.set_latest_price(1, 15, date(2020, 2, 1))
+    assert data_parser.cohort_value(date(2020, 1, 31), "1111") == 50 + 2 * 15 + 4 * 5
+    # Cohorts without capital or holdings are worth nothing
+    assert data_parser.cohort_value(date(2020, 2, 29), "1111") == 0
@@ -1,3 +1,4 @@
+import json
 import pytest
 
 from datetime import datetime
@@ -34,4 +35,39 @@ def test_handle_special_cases__replacements(special_cases):
 
     # Test that the function replaces two values when matching "Two Replacements"
     matching_two_replacements = (datetime(2019, 1, 1).date(),"Two Replacements",3,4,5)
-    assert special_cases.handle_special_cases(matching_two_replacements) == (datetime(2019, 1, 1).date(),"Two Replacements","Replaced1","Replaced2",5)
\ No newline at end of file
+    assert special_cases.handle_special_cases(matching_two_replacements) == (datetime(2019, 1, 1).date(),"Two Replacements","Replaced1","Replaced2",5)
+def test_handle_special_cases__chained_replacements(tmp_path):
+    # Replacements are applied in file order and a replaced value can match a later case, but not an earlier one
+    cases = [
+        {"condition": [{"index": 3, "value": "B"}], "replacement": [{"index": 3, "value": "C"}]},
+        {"condition": [{"index": 3, "value": "A"}], "replacement": [{"index": 3, "value": "B"}]},
+        {"condition": [{"index": 0, "value": "2020-01-01", "operator": ">="}], "replacement": [{"index": 4, "value": "New"}]},
+        {"condition": [{"index": 0, "value": "2021-01-01", "operator": "<"}, {"index": 3, "value": "B"}],
+         "replacement": [{"index": 2, "value": "Old B"}]},
+    ]
+    special_cases_file = tmp_path / "special_cases.json"
+    special_cases_file.write_text(json.dumps(cases))
+    special_cases = SpecialCases(str(special_cases_file))
+    row = (datetime(2020, 6, 1).date(), "X", "Y", "A", "Z")
+    assert special_cases.handle_special_cases(row) == (datetime(2020, 6, 1).date(), "X", "Old B", "B", "New")
+    row = (datetime(2019, 6, 1).date(), "X", "Y", "B", "Z")
+    assert special_cases.handle_special_cases(row) == (datetime(2019, 6, 1).date(), "X", "Y", "C", "Z")
+
+def test_handle_special_cases__same_as_checking_all_cases(tmp_path):
+    # The indexed lookup gives the same rows as checking every case in order
+    cases = []
+    for i in range(200):
+        cases.append({"condition": [{"index": 9, "value": f"ISIN{i}"}], "replacement": [{"index": 3, "value": f"Asset {i}"}]})
+        cases.append({"condition": [{"index": 0, "value": "2021-01-01", "operator": "<"}, {"index": 3, "value": f"Asset {i}"}],
+                      "replacement": [{"index": 3, "value": f"Asset {i} old"}, {"index": 9, "value": f"ISIN{i + 1}"}]})
+    special_cases_file = tmp_path / "special_cases.json"
+    special_cases_file.write_text(json.dumps(cases))
+    special_cases = SpecialCases(str(special_cases_file))
+    for year in (2020, 2022):
+        for i in range(0, 220, 7):
+            row = (datetime(year, 1, 1).date(), "1111", "Köp", "Name", 1.0, 10.0, -10.0, 0.0, "SEK", f"ISIN{i}", "-")
+            expected = row
+            for condition, replacement in special_cases.special_cases:
+                if condition(expected):
+                    expected = replacement(expected)
+            assert special_cases.handle_special_cases(row) == expected
@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+import pytest
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from calculate_stats import StatCalculator
+from price_fetcher import PriceFetcher, TokenBucket
+
+
+class StubSearchHandler(BaseHTTPRequestHandler):
+    """
+    Answers search queries like the price endpoint. "Asset A" fails with 503 on its first request,
+    "Asset C" has no hits and every other asset gets a price.
+    """
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["query"]
+        server = self.server
+        with server.lock:
+            server.queries.append(query)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first_request = server.queries.count(query) == 1
+        time.sleep(0.02)
+        if query == "Asset A" and first_request:
+            status, body = 503, {}
+        elif query == "Asset C":
+            status, body = 200, {"hits": []}
+        else:
+            status, body = 200, {"hits": [{"price": {"last": "1 234,5" if query == "Asset B" else "42,25"}}]}
+        with server.lock:
+            server.in_flight -= 1
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubSearchHandler)
+    server.lock = threading.Lock()
+    server.queries = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def held_assets_db(tmp_path):
+    """Creates a database holding Asset A-F in one account."""
+    csv_content = "Datum;Konto;Typ av transaktion;Värdepapper/beskrivning;Antal;Kurs;Belopp;Courtage;Valuta;ISIN;Resultat\n"
+    csv_content += "2023-01-01;1111;Insättning;Deposit;-;-;10000;0;SEK;;-\n"
+    for i, asset in enumerate("ABCDEF"):
+        csv_content += f"2023-01-{i + 2:02d};1111;Köp;Asset {asset};10;10;-100;0;SEK;TEST{asset};-\n"
+    csv_file = tmp_path / "held_assets.csv"
+    csv_file.write_text(csv_content, encoding="utf-8")
+    db = DatabaseHandler(tmp_path / "test_price_fetcher.db")
+    parser = DataParser(db)
+    parser.add_data(str(csv_file))
+    parser.process_transactions()
+    return db
+
+
+def test_update_prices__concurrent_fetch(stub_server, held_assets_db):
+    """
+    Tests that update_prices fetches all held assets through the fetcher, retries 5xx responses,
+    keeps the old price when no price is found and respects the concurrency limit.
+    """
+    fetcher = PriceFetcher(url=f"http://127.0.0.1:{stub_server.server_port}/search",
+                           concurrency=3, rate=1000, burst=10, backoff=0.01)
+    StatCalculator(held_assets_db).update_prices(force=True, fetcher=fetcher)
+
+    held_assets_db.connect()
+    prices = dict(held_assets_db.get_cursor().execute("SELECT asset, latest_price FROM assets").fetchall())
+    dates = {row[0] for row in held_assets_db.get_cursor().execute(
+        "SELECT latest_price_date FROM assets WHERE asset != 'Asset C'").fetchall()}
+    assert prices == {"Asset A": 42.25, "Asset B": 1234.5, "Asset C": 10.0,
+                      "Asset D": 42.25, "Asset E": 42.25, "Asset F": 42.25}
+    assert dates == {date.today()}
+    history = held_assets_db.get_cursor().execute(
+        "SELECT COUNT(*), MIN(date) FROM asset_prices WHERE source = 'update_prices'").fetchone()
+    assert history == (5, date.today().isoformat())
+    assert sorted(stub_server.queries) == ["Asset A", "Asset A", "Asset B", "Asset C", "Asset D", "Asset E", "Asset F"]
+    assert 1 < stub_server.max_in_flight <= 3
+
+
+def test_token_bucket__limits_rate():
+    """
+    Tests that the token bucket allows a burst of capacity tokens and then one token per 1/rate seconds.
+    """
+    bucket = TokenBucket(rate=50, capacity=2)
+    start = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    # 2 tokens from the burst, the 5 remaining take at least 5/50 seconds
+    assert time.monotonic() - start >= 0.09
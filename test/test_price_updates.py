@@ -1,6 +1,8 @@
 import pytest
+from datetime import date
 from database_handler import DatabaseHandler
-from data_parser import DataParser
+from data_parser import DataParser, SpecialCases
+from calculate_stats import StatCalculator
 
 
 @pytest.fixture
@@ -57,3 +59,81 @@ def test_data_parser__price_updates(database_price_updates):
     assert "Asset B" in asset_dict
     assert asset_dict["Asset B"]["price"] == 50.0
     assert str(asset_dict["Asset B"]["date"]) == "2023-01-05"
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_data_parser__price_history(database_price_updates, in_memory):
+    """
+    Tests that every transaction price is appended to asset_prices, in both processing modes.
+    """
+    parser = DataParser(database_price_updates)
+    parser.process_transactions(in_memory=in_memory)
+
+    database_price_updates.connect()
+    cur = database_price_updates.get_cursor()
+    history = cur.execute("""
+        SELECT a.asset, p.date, p.price, p.source FROM asset_prices p JOIN assets a ON p.asset_id = a.asset_id
+        ORDER BY p.rowid
+    """).fetchall()
+    assert [(asset, str(day), price, source) for asset, day, price, source in history] == [
+        ("Asset A", "2023-01-02", 100.0, "transaction"),
+        ("Asset A", "2023-01-03", 120.0, "transaction"),
+        ("Asset A", "2023-01-04", 150.0, "transaction"),
+        ("Asset B", "2023-01-05", 50.0, "transaction"),
+    ]
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+@pytest.mark.parametrize("csv_file", ["./test/data/reordered_data.csv", "./test/data/interest_fees.csv", "./test/data/transfer_deferral.csv"])
+def test_data_parser__price_history_deferred(tmp_path, csv_file, in_memory):
+    """
+    Tests that trades that are deferred and retried add one row to asset_prices, when they are processed.
+    """
+    db = DatabaseHandler(str(tmp_path / "test_price_history_deferred.db"))
+    parser = DataParser(db, SpecialCases("./test/data/special_cases_test.json"))
+    parser.add_data(csv_file)
+    parser.process_transactions(in_memory=in_memory)
+    db.connect()
+    cur = db.get_cursor()
+    (trades,) = cur.execute("SELECT COUNT(*) FROM transactions WHERE transaction_type IN ('Köp', 'Sälj', 'Tillgångsinsättning')").fetchone()
+    assert cur.execute("SELECT COUNT(*) FROM asset_prices").fetchone()[0] == trades
+    assert cur.execute("SELECT COUNT(*) FROM (SELECT DISTINCT asset_id, date, price FROM asset_prices)").fetchone()[0] == trades
+
+
+@pytest.mark.parametrize("max_checkpoints", [0, 24])
+def test_stat_calculator__value_as_of(database_price_updates, max_checkpoints):
+    """
+    Tests valuation with historical prices and the holdings of that date, for a date, a cohort and as a month-end series,
+    with the holdings rebuilt from the first transaction or from a checkpoint.
+    """
+    DataParser(database_price_updates, max_checkpoints=max_checkpoints).process_transactions()
+    database_price_updates.connect()
+    cur = database_price_updates.get_cursor()
+    asset_a = cur.execute("SELECT asset_id FROM assets WHERE asset = 'Asset A'").fetchone()[0]
+    # A later price, e.g. from update_prices
+    cur.execute("INSERT INTO asset_prices(asset_id, date, price, source) VALUES (?, '2023-03-15', 200, 'update_prices')", (asset_a,))
+    database_price_updates.commit()
+
+    stat_calculator = StatCalculator(database_price_updates)
+    assert stat_calculator.get_prices_as_of(date(2023, 1, 3)) == {asset_a: 120.0}
+    assert stat_calculator.get_prices_as_of(date(2022, 12, 31)) == {}
+
+    # Only the transactions up to the date are held: 10 A bought at 100, then 5 more at 120
+    assert stat_calculator.get_value_as_of(date(2023, 1, 2)) == (9000.0, 10 * 100.0, 10000.0)
+    assert stat_calculator.get_value_as_of(date(2023, 1, 3)) == (8400.0, 15 * 120.0, 10200.0)
+    # 10 A and 10 B held, cash 10000 - 1000 - 600 + 750 = 9150, all in the December 2022 cohort
+    assert stat_calculator.get_value_as_of(date(2023, 1, 31)) == (9150.0, 10 * 150.0 + 10 * 50.0, 11150.0)
+    assert stat_calculator.get_value_as_of(date(2023, 1, 31), accounts=["1111"], cohort_month=date(2022, 12, 31))[2] == 11150.0
+    assert stat_calculator.get_value_as_of(date(2023, 1, 31), accounts=["2222"]) == (0.0, 0.0, 0.0)
+
+    holdings = stat_calculator.get_holdings_as_of([date(2023, 1, 3)])[date(2023, 1, 3)][1]
+    assert holdings == {(date(2022, 12, 31), asset_a, "1111"): 15.0}
+
+    series = stat_calculator.get_month_end_values(date(2022, 12, 1), date(2023, 3, 31))
+    assert [(str(month_end), total) for month_end, _, _, total in series] == [
+        # Nothing was deposited before 2023
+        ("2022-12-31", 0.0),
+        ("2023-01-31", 11150.0),
+        ("2023-02-28", 11150.0),
+        ("2023-03-31", 9150.0 + 10 * 200.0 + 10 * 50.0),
+    ]
@@ -1,7 +1,8 @@
 import pytest
 
+from datetime import date
 from database_handler import DatabaseHandler
-from data_parser import DataParser
+from data_parser import DataParser, TransactionScheduler
 
 
 @pytest.fixture
@@ -96,3 +97,51 @@ def test_process_data__transfer_proper_order(database_transfer_proper_order):
     assert abs(capital_1111 - 25.0) < 0.01, f"Account 1111 capital should be 25, got {capital_1111}"
     assert abs(capital_2222 - 25.0) < 0.01, f"Account 2222 capital should be 25, got {capital_2222}"
     assert abs(asset_amount) < 0.001, f"No assets should be held, got {asset_amount}"
+
+
+class CapitalHandler:
+    """
+    Minimal handler that only tracks capital per account and records which rows were attempted.
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.capital = {}
+        self.attempts = []
+
+    def checkpoint(self, month):
+        pass
+
+    def handle_deposit(self, row):
+        self.attempts.append(row[-1])
+        self.capital[row[1]] = self.capital.get(row[1], 0) + row[6]
+        self.scheduler.mark_processed(row[-1])
+        self.scheduler.release(("capital", row[1]))
+
+    def handle_withdrawal(self, row):
+        self.attempts.append(row[-1])
+        if self.capital.get(row[1], 0) >= -row[6]:
+            self.capital[row[1]] += row[6]
+            self.scheduler.mark_processed(row[-1])
+        else:
+            self.scheduler.defer(("capital", row[1]), row)
+
+
+def test_transaction_scheduler__retries_only_released_rows(tmp_path):
+    """
+    A deferred withdrawal is retried when its own account receives capital, not when another account does.
+    """
+    scheduler = TransactionScheduler(DataParser(DatabaseHandler(tmp_path / "test_asset_data.db")))
+    handler = CapitalHandler(scheduler)
+    rows = [
+        (date(2020, 1, 1), "1111", "Uttag", "", 0, 0, -50, 1),
+        (date(2020, 1, 2), "2222", "Insättning", "", 0, 0, 100, 2),
+        (date(2020, 1, 3), "1111", "Insättning", "", 0, 0, 100, 3),
+        (date(2020, 1, 4), "2222", "Uttag", "", 0, 0, -500, 4),
+    ]
+
+    unprocessed = scheduler.run(handler, rows)
+
+    assert handler.attempts == [1, 2, 3, 1, 4]
+    assert unprocessed == [rows[3]]
+    assert scheduler.processed == {1, 2, 3}
+    assert handler.capital == {"1111": 50, "2222": 100}
@@ -0,0 +1,60 @@
+import json
+import pytest
+
+from database_handler import DatabaseHandler
+from data_parser import DataParser
+from profiler import ProcessingProfiler
+
+
+def profile_processing(tmp_path, csv_file, in_memory):
+    db_file = tmp_path / "test_profiler_{}.db".format("memory" if in_memory else "sql")
+    profiler = ProcessingProfiler()
+    data_parser = DataParser(DatabaseHandler(db_file), profiler=profiler)
+    data_parser.add_data(csv_file)
+    data_parser.process_transactions(in_memory=in_memory)
+    return data_parser, profiler
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_profiler__transfer_deferral(tmp_path, in_memory):
+    """
+    Tests that the profiler counts handler calls, lot walks, deferrals and retries,
+    and that the handlers and the connection are restored after processing.
+    """
+    data_parser, profiler = profile_processing(tmp_path, "./test/data/transfer_deferral.csv", in_memory)
+    counters = profiler.to_dict()
+    assert counters["runs"] == 1
+    assert counters["deferrals"] > 0
+    # Every deferred transaction is retried once the capital or asset it waits for is released
+    assert counters["retries"] == counters["deferrals"]
+    calls = sum(handler["calls"] for handler in counters["handlers"].values())
+    assert calls == 8 + counters["retries"]
+    assert counters["handlers"]["handle_internal_transfer"]["calls"] >= 4
+    assert counters["lot_walks"]["handle_internal_transfer"]["walks"] == 2
+    assert counters["statements"] > 0
+    assert counters["rows_changed"] > 0
+    assert 0 < counters["handler_seconds"] <= counters["seconds"]
+    assert not any(name.startswith("handle_") for name in vars(data_parser))
+
+    # The trace callback is removed, statements after processing are not counted
+    data_parser.db.get_cursor().execute("SELECT COUNT(*) FROM transactions")
+    assert profiler.statements == counters["statements"]
+
+    summary = profiler.summary()
+    assert "handle_internal_transfer" in summary
+    assert "Deferred transactions: {}".format(counters["deferrals"]) in summary
+
+def test_profiler__same_counts_in_both_modes(tmp_path):
+    """
+    Tests that the in-memory engine reports the same handler calls and lot walks as processing with SQL, and that the JSON dump matches.
+    """
+    _, sql_profiler = profile_processing(tmp_path, "./test/data/transfer_deferral.csv", False)
+    _, profiler = profile_processing(tmp_path, "./test/data/transfer_deferral.csv", True)
+    assert {name: handler["calls"] for name, handler in profiler.to_dict()["handlers"].items()} == \
+        {name: handler["calls"] for name, handler in sql_profiler.to_dict()["handlers"].items()}
+    assert profiler.lot_walks == sql_profiler.lot_walks
+    # The in-memory engine writes lots in bulk instead of issuing statements per lot
+    assert profiler.statements < sql_profiler.statements
+
+    profiler.dump(tmp_path / "profile.json")
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f) == profiler.to_dict()